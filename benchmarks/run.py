@@ -0,0 +1,218 @@
+"""Benchmarks for signing, index building, querying and accuracy on synthetic data.
+
+    PYTHONPATH=. python benchmarks/run.py --out results.json
+    PYTHONPATH=. python benchmarks/run.py --out new.json --baseline results.json
+
+Results are written as JSON, one record per (benchmark, backend). With
+`--baseline` the timings are compared to an earlier results file.
+"""
+import sys
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+import numpy as np
+import quick_knn
+from quick_knn import LSH, MinHash, OnePermutationMinHash, RandomHyperplanes
+from synthetic import overlap_sets, angular_vectors, exact_jaccard, exact_angular
+
+BACKENDS = ("pickle", "array", "sql")
+# Metrics where a larger value is better, used when comparing to a baseline.
+HIGHER_IS_BETTER = ("items_per_second", "queries_per_second", "recall", "precision", "rerank_recall", "rerank_precision")
+LOWER_IS_BETTER = ("seconds", "p50_ms", "p99_ms", "peak_bytes")
+
+
+def timed(func, *args, **kwargs):
+    t0 = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - t0
+
+
+def peak_memory(func, *args, **kwargs) -> int:
+    """Peak bytes allocated while running func, measured separately since tracing slows things down."""
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def rate(benchmark, items, seconds, **extra):
+    return dict(benchmark=benchmark, items=items, seconds=seconds, items_per_second=items / seconds, **extra)
+
+
+def bench_signing(sets, vectors, args):
+    results = []
+    mh = MinHash(args.bits)
+    _, seconds = timed(mh.signature_batch, sets)
+    results.append(rate("sign/minhash-int", len(sets), seconds))
+    strings = [{str(t) for t in s.tolist()} for s in sets[:args.string_docs]]
+    _, seconds = timed(mh.signature_batch, strings)
+    results.append(rate("sign/minhash-str", len(strings), seconds))
+    # Few large documents signed with long signatures, where `MinHash.CHUNK` matters most.
+    rng = np.random.RandomState(args.seed)
+    large = [
+        [str(t) for t in rng.randint(0, 1 << 32, size=args.large_tokens, dtype=np.uint64).tolist()]
+        for _ in range(args.large_docs)
+    ]
+    wide = MinHash(args.large_bits)
+    _, seconds = timed(lambda: [wide(doc) for doc in large])
+    results.append(rate("sign/minhash-large", len(large), seconds, tokens=args.large_tokens, bits=args.large_bits))
+    oph = OnePermutationMinHash(args.bits)
+    _, seconds = timed(lambda: [oph(s) for s in sets])
+    results.append(rate("sign/one-permutation", len(sets), seconds))
+    for projection in ("gaussian", "sparse"):
+        rh = RandomHyperplanes(args.bits, vectors.shape[1], packed=True, projection=projection)
+        _, seconds = timed(rh.signature, vectors)
+        results.append(rate(f"sign/hyperplanes-{projection}", len(vectors), seconds))
+    return results
+
+
+def accuracy(found, truth):
+    """Micro averaged recall and precision of found keys against the true neighbours, ignoring the query itself."""
+    tp = sum(len(f & t) for f, t in zip(found, truth))
+    n_found = sum(len(f) for f in found)
+    n_true = sum(len(t) for t in truth)
+    return tp / max(n_true, 1), tp / max(n_found, 1)
+
+
+def bench_hashing(name, sigs, threshold, bits, packed, args):
+    """Band hashing one row at a time (what `LSH.insert` and `LSH.query` pay per item) and all rows at once."""
+    lsh = LSH(threshold, bits, packed=packed)
+    n = min(len(sigs), args.insert_docs)
+    _, seconds = timed(lambda: [lsh.band_hashes(sig) for sig in sigs[:n]])
+    results = [rate(f"{name}/hash-single", n, seconds, b=lsh.b, r=lsh.r)]
+    _, seconds = timed(lsh.band_hashes, sigs)
+    results.append(rate(f"{name}/hash-batch", len(sigs), seconds, b=lsh.b, r=lsh.r))
+    return results
+
+
+def bench_index(name, sigs, queries, truth, threshold, bits, packed, args):
+    results = []
+    for backend in BACKENDS:
+        def build(suffix, store=False):
+            lsh = LSH(threshold, bits, t=backend, packed=packed, name=f"bench-{name}-{backend}-{suffix}", store_signatures=store)
+            lsh.insert_many(range(len(sigs)), sigs)
+            return lsh
+
+        loop = LSH(threshold, bits, t=backend, packed=packed, name=f"bench-{name}-{backend}-loop")
+        n = min(len(sigs), args.insert_docs)
+        _, seconds = timed(lambda: [loop.insert(i, sig) for i, sig in enumerate(sigs[:n])])
+        record = rate(f"{name}/insert", n, seconds, backend=backend)
+        lsh, seconds = timed(build, "bulk", True)
+        record["insert_many_items_per_second"] = len(sigs) / seconds
+        record["peak_bytes"] = peak_memory(build, "traced") if args.memory else None
+        results.append(record)
+
+        latencies = []
+        found = []
+        for q in queries:
+            res, seconds = timed(lsh.query, sigs[q])
+            latencies.append(seconds)
+            found.append(set(res) - {q})
+        _, batch_seconds = timed(lsh.query_many, sigs[queries])
+        reranked = [set(k for k, _ in res) - {q} for q, res in zip(queries, lsh.query_many(sigs[queries], min_similarity=threshold))]
+        recall, precision = accuracy(found, truth)
+        rerank_recall, rerank_precision = accuracy(reranked, truth)
+        p50, p99 = np.percentile(np.array(latencies) * 1000, [50, 99])
+        results.append(dict(
+            benchmark=f"{name}/query", backend=backend, queries=len(queries),
+            p50_ms=p50, p99_ms=p99, queries_per_second=len(queries) / batch_seconds,
+            mean_candidates=float(np.mean([len(f) for f in found])),
+            recall=recall, precision=precision,
+            rerank_recall=rerank_recall, rerank_precision=rerank_precision,
+        ))
+    return results
+
+
+def jaccard_benchmarks(sets, labels, queries, args):
+    sigs = MinHash(args.bits).signature_batch(sets)
+    truth = [
+        set(int(m) for m, s in pairs if s >= args.jaccard_threshold) - {q}
+        for q, pairs in zip(queries, exact_jaccard(sets, labels, queries))
+    ]
+    results = bench_hashing("jaccard", sigs, args.jaccard_threshold, args.bits, False, args)
+    return results + bench_index("jaccard", sigs, queries, truth, args.jaccard_threshold, args.bits, False, args)
+
+
+def cosine_benchmarks(vectors, queries, args):
+    sigs = RandomHyperplanes(args.bits, vectors.shape[1], packed=True).signature(vectors)
+    similarity = exact_angular(vectors, queries)
+    truth = [set(np.flatnonzero(row >= args.cosine_threshold).tolist()) - {q} for q, row in zip(queries, similarity)]
+    results = bench_hashing("cosine", sigs, args.cosine_threshold, args.bits, True, args)
+    return results + bench_index("cosine", sigs, queries, truth, args.cosine_threshold, args.bits, True, args)
+
+
+def compare(baseline, results):
+    """Print how each metric moved relative to a baseline results file."""
+    old = {(r["benchmark"], r.get("backend")): r for r in baseline["results"]}
+    for record in results:
+        before = old.get((record["benchmark"], record.get("backend")))
+        if before is None:
+            continue
+        for metric in HIGHER_IS_BETTER + LOWER_IS_BETTER:
+            if record.get(metric) is None or not before.get(metric):
+                continue
+            ratio = record[metric] / before[metric]
+            better = ratio >= 1 if metric in HIGHER_IS_BETTER else ratio <= 1
+            label = f"{record['benchmark']}[{record.get('backend', '-')}].{metric}"
+            print(f"{label:<60} {before[metric]:>12.4g} -> {record[metric]:>12.4g} ({ratio:.2f}x{'' if better else ', worse'})", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bits", "-b", type=int, default=128)
+    parser.add_argument("--clusters", type=int, default=500)
+    parser.add_argument("--copies", type=int, default=4)
+    parser.add_argument("--set-size", type=int, default=200)
+    parser.add_argument("--dim", type=int, default=128)
+    parser.add_argument("--jaccard-similarity", type=float, default=0.8, help="Similarity of each copy to its base set")
+    parser.add_argument("--jaccard-threshold", type=float, default=0.6)
+    parser.add_argument("--cosine-similarity", type=float, default=0.9, help="Angular similarity of each copy to its base vector")
+    parser.add_argument("--cosine-threshold", type=float, default=0.85)
+    parser.add_argument("--queries", "-q", type=int, default=200)
+    parser.add_argument("--string-docs", type=int, default=500, help="Documents signed through the sha1 string path")
+    parser.add_argument("--large-docs", type=int, default=20, help="Documents in the large token set signing benchmark")
+    parser.add_argument("--large-tokens", type=int, default=5000, help="Tokens per document in that benchmark")
+    parser.add_argument("--large-bits", type=int, default=1024, help="Signature length in that benchmark")
+    parser.add_argument("--insert-docs", type=int, default=2000, help="Documents inserted one at a time")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="Skip the traced peak memory builds")
+    parser.add_argument("--seed", "-s", type=int, default=1337)
+    parser.add_argument("--out", "-o", help="Write the JSON results here instead of stdout")
+    parser.add_argument("--baseline", help="An earlier results file to compare against")
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    sets, labels = overlap_sets(args.clusters, args.copies, args.set_size, args.jaccard_similarity, rng)
+    vectors, _ = angular_vectors(args.clusters, args.copies, args.dim, args.cosine_similarity, rng)
+    queries = rng.choice(len(sets), size=min(args.queries, len(sets)), replace=False)
+
+    results = bench_signing(sets, vectors, args)
+    results += jaccard_benchmarks(sets, labels, queries, args)
+    results += cosine_benchmarks(vectors, queries, args)
+    output = {
+        "meta": {
+            "quick_knn": quick_knn.__version__,
+            "numpy": np.__version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    text = json.dumps(output, indent=2, default=lambda x: x.item())
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+from typing import List, Tuple
+import numpy as np
+
+
+def overlap_sets(
+        clusters: int,
+        copies: int,
+        size: int,
+        similarity: float,
+        rng: np.random.RandomState
+) -> Tuple[List[np.ndarray], np.ndarray]:
+    """Integer token sets in clusters of near-duplicates with a controlled Jaccard similarity.
+
+    Each cluster has a base set of `size` random tokens, every copy keeps
+    `k = 2 * size * similarity / (1 + similarity)` of them and replaces the
+    rest with fresh tokens so it has Jaccard `similarity` with the base.
+    Tokens are drawn from 2^32 values so sets from different clusters are
+    effectively disjoint.
+
+    :returns: The sets (the base first in each cluster) and their cluster ids.
+    """
+    keep = int(round(2 * size * similarity / (1 + similarity)))
+    sets, labels = [], []
+    for cluster in range(clusters):
+        base = np.unique(rng.randint(0, 1 << 32, size=size, dtype=np.uint64)).astype(np.uint32)
+        sets.append(base)
+        labels.append(cluster)
+        for _ in range(copies):
+            kept = rng.choice(base, size=min(keep, len(base)), replace=False)
+            fresh = rng.randint(0, 1 << 32, size=len(base) - len(kept), dtype=np.uint64).astype(np.uint32)
+            sets.append(np.unique(np.concatenate([kept, fresh])))
+            labels.append(cluster)
+    return sets, np.array(labels)
+
+
+def angular_vectors(
+        clusters: int,
+        copies: int,
+        dim: int,
+        similarity: float,
+        rng: np.random.RandomState
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Unit vectors in clusters whose copies have a controlled angular similarity to the base.
+
+    Angular similarity is `1 - angle / pi`, the quantity `RandomHyperplanes`
+    signatures estimate. Each copy is rotated away from its base by
+    `(1 - similarity) * pi` towards a random orthogonal direction.
+
+    :returns: A (clusters * (copies + 1)) x dim matrix and the cluster ids.
+    """
+    angle = (1 - similarity) * np.pi
+    base = rng.randn(clusters, dim)
+    base /= np.linalg.norm(base, axis=1, keepdims=True)
+    rows = []
+    for b in base:
+        rows.append(b)
+        noise = rng.randn(copies, dim)
+        noise -= np.outer(noise @ b, b)
+        noise /= np.linalg.norm(noise, axis=1, keepdims=True)
+        rows.extend(np.cos(angle) * b + np.sin(angle) * noise)
+    return np.array(rows), np.repeat(np.arange(clusters), copies + 1)
+
+
+def exact_jaccard(sets: List[np.ndarray], labels: np.ndarray, queries: np.ndarray) -> List[np.ndarray]:
+    """Exact Jaccard similarity of each query set with every set in its own cluster.
+
+    Sets in different clusters don't share tokens (see `overlap_sets`), their
+    similarity is taken to be 0.
+
+    :returns: For each query the (index, similarity) pairs as a (n x 2) array.
+    """
+    results = []
+    for q in queries:
+        members = np.flatnonzero(labels == labels[q])
+        scores = [
+            len(np.intersect1d(sets[q], sets[m], assume_unique=True)) / len(np.union1d(sets[q], sets[m]))
+            for m in members
+        ]
+        results.append(np.stack([members, scores], axis=1))
+    return results
+
+
+def exact_angular(vectors: np.ndarray, queries: np.ndarray) -> np.ndarray:
+    """Exact angular similarity between each query row and every row, a (queries x rows) matrix."""
+    unit = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    cos = np.clip(unit[queries] @ unit.T, -1.0, 1.0)
+    return 1 - np.arccos(cos) / np.pi
@@ -1,5 +1,6 @@
 __version__ = '0.1.4'
 
-from quick_knn.min_hash import MinHash
+from quick_knn.min_hash import MinHash, OnePermutationMinHash
 from quick_knn.random_hyperplane import RandomHyperplanes
 from quick_knn.lsh import LSH
+from quick_knn.forest import LSHForest
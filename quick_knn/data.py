@@ -1,11 +1,52 @@
+import os
+import sys
+import copy
+import json
 import pickle
 import struct
 import sqlite3
-from typing import Iterable, Set, Union
-from itertools import cycle
+import importlib
+import threading
+import itertools
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 from collections import defaultdict
+from collections.abc import Mapping
+from contextlib import contextmanager
+import numpy as np
 from quick_knn.type_hints import Key
 
+# Every array in a frozen index starts at a multiple of this many bytes.
+ALIGN = 64
+FROZEN_MAGIC = b"QKNNIDX1"
+SQL_STRING = b"SQLite format 3\x00"
+# Band tables as returned by `Data.export`, (band hashes, key ids) per band and the id -> key table.
+Exported = Tuple[List[np.ndarray], List[np.ndarray], List[Key]]
+# A sorted run of `ArrayData` entries, (band hashes, key ids) per band.
+Run = Tuple[List[np.ndarray], List[np.ndarray]]
+# A newer `ArrayData` run is merged into the one before it while that one is less than this many times bigger.
+RUN_RATIO = 4
+# Numbers the shared cache in memory SQLite databases, `id()` can be reused while an old database is still open.
+MEMORY_DBS = itertools.count()
+
+
+def to_keys(hashes: np.ndarray) -> List[bytes]:
+    """Convert a row of 64 bit band hashes into the byte keys the backends store."""
+    buf = np.ascontiguousarray(hashes, dtype='<u8').tobytes()
+    return [buf[i:i + 8] for i in range(0, len(buf), 8)]
+
+
+def from_keys(keys: Iterable[bytes]) -> np.ndarray:
+    """Inverse of `to_keys`."""
+    return np.frombuffer(b''.join(keys), dtype='<u8').astype(np.uint64)
+
+
+def unsort_bands(tables: List[Tuple[np.ndarray, np.ndarray]], n: int) -> np.ndarray:
+    """Turn sorted band tables (see `Data.load_bands`) back into a (n x b) band hash matrix."""
+    hashes = np.empty((n, len(tables)), dtype=np.uint64)
+    for band, (h, rows) in enumerate(tables):
+        hashes[rows, band] = h
+    return hashes
+
 
 class Data(object):
     def __init__(self, name: str):
@@ -18,6 +59,72 @@ class Data(object):
     def get(self, keys: Iterable[bytes]) -> Set[Key]:
         pass
 
+    def insert_many(self, keys: np.ndarray, values: List[Key]) -> None:
+        """Insert many values, `keys` is a (len(values) x b) matrix of band hashes."""
+        for row, value in zip(keys, values):
+            self.insert(to_keys(row), value)
+
+    def get_many(self, keys: np.ndarray) -> List[Set[Key]]:
+        """Look up many queries, `keys` is a (n x b) matrix of band hashes."""
+        return [self.get(to_keys(row)) for row in keys]
+
+    def load_bands(self, tables: List[Tuple[np.ndarray, np.ndarray]], values: List[Key]) -> None:
+        """Bulk load whole bands, `tables` has each band's hashes sorted and the row of `values` for each hash."""
+        self.insert_many(unsort_bands(tables, len(values)), values)
+
+    def get_bands(self, bands: np.ndarray, hashes: np.ndarray) -> Set[Key]:
+        """Union of the buckets for arbitrary (band, band hash) pairs, used for multi-probe queries."""
+        raise NotImplementedError(f"{type(self).__name__} can't look up single bands")
+
+    def insert_bands(self, bands: np.ndarray, hashes: np.ndarray, values: List[Key]) -> None:
+        """Add each value to the bucket for its (band, band hash) pair."""
+        raise NotImplementedError(f"{type(self).__name__} can't insert single bands")
+
+    def remove_bands(self, bands: np.ndarray, hashes: np.ndarray, values: List[Key]) -> None:
+        """Take each value out of the bucket for its (band, band hash) pair."""
+        raise NotImplementedError(f"{type(self).__name__} can't remove single bands")
+
+    def bucket_sizes(self, bands: np.ndarray, hashes: np.ndarray) -> np.ndarray:
+        """The number of entries in the bucket of each (band, band hash) pair."""
+        raise NotImplementedError(f"{type(self).__name__} can't count buckets")
+
+    def key_ids(self, values: List[Key]) -> List[Optional[int]]:
+        """The id each value is interned under, or None, ids grow in the order values were first inserted."""
+        raise NotImplementedError(f"{type(self).__name__} doesn't intern keys")
+
+    def remove(self, value: Key, keys: Optional[np.ndarray]=None) -> None:
+        """Remove a value so lookups no longer return it.
+
+        :param keys: The value's band hashes if they are known, backends can use
+            them to drop its entries right away instead of leaving a tombstone.
+        """
+        raise NotImplementedError(f"{type(self).__name__} can't remove items")
+
+    def compact(self) -> None:
+        """Rewrite the tables without the entries of removed values.
+
+        Backends that intern keys also forget removed keys and renumber the
+        remaining ids densely, so churn doesn't grow the key list.
+        """
+        pass
+
+    @contextmanager
+    def bulk(self, batch: int=10000, keep_index: bool=False):
+        """Bulk load session, backends can batch or defer work until it ends.
+
+        :param keep_index: Keep lookup structures up to date during the session,
+            needed when inserts look up bucket sizes (see `LSH` `bucket_cap`).
+        """
+        yield self
+
+    def export(self) -> Exported:
+        """Dump the band tables as arrays, used to write a `FrozenData` index."""
+        raise NotImplementedError(f"{type(self).__name__} can't be exported")
+
+    def nbytes(self) -> int:
+        """Approximate number of bytes used by the tables."""
+        raise NotImplementedError(f"{type(self).__name__} can't report its size")
+
     def save(self, lsh, hasher):
         pass
 
@@ -26,90 +133,1191 @@ class Data(object):
         pass
 
 class SQLData(Data):
+    """SQLite backed tables.
+
+    Each row of `lsh` is (band, band hash, key id) and the pickled keys are
+    stored once in `keys`. Band hashes are stored as signed 64 bit integers.
+
+    Removed keys are listed in `tombstones` and skipped by lookups until
+    `compact` deletes their rows.
+
+    `save` stores the pickled `LSH` and hasher in `meta`, an in memory
+    database is first copied to the file it was named after.
+
+    Writes go through `self.conn`. Lookups use a separate autocommit
+    connection per thread (see `reader`) so several threads can query the
+    same database at once. During a `bulk` session lookups go through
+    `self.conn` instead, one at a time, so they see the rows added so far
+    (and a shared cache in memory database, which is locked while the
+    session writes to it, can still be queried).
+    """
+
     def __init__(self, name: str, *args, in_memory: bool=False, **kwargs):
+        # Where `save` writes an in memory database.
+        self.path = name
         if in_memory:
-            name = ':memory:'
+            # A named, shared cache in memory database so reader connections see the same data.
+            name = f'file:quick_knn-{os.getpid()}-{next(MEMORY_DBS)}?mode=memory&cache=shared'
         super().__init__(name)
-        self.conn = sqlite3.connect(name, isolation_level='EXCLUSIVE')
+        # Writes may come from different threads, `LSH` makes sure only one runs at a time.
+        self.conn = sqlite3.connect(name, isolation_level='EXCLUSIVE', uri=in_memory, check_same_thread=False)
+        self.uri = in_memory
+        self.local = threading.local()
+        # Serializes lookups on `self.conn` during a bulk session.
+        self.bulk_lock = threading.Lock()
+        self.in_bulk = False
+        self.batch = 0
+        self.pending = 0
         try:
             c = self.conn.cursor()
-            c.execute('PRAGMA journal_model = WAL')
-            c.execute('''CREATE TABLE lsh (key BLOB NOT NULL, value BLOB NOT NULL)''')
-            c.execute('''CREATE INDEX keys ON lsh (key)''')
+            c.execute('PRAGMA journal_mode = WAL')
+            c.execute('PRAGMA synchronous = NORMAL')
+            c.execute('''CREATE TABLE IF NOT EXISTS lsh (band INTEGER NOT NULL, hash INTEGER NOT NULL, id INTEGER NOT NULL)''')
+            c.execute('''CREATE TABLE IF NOT EXISTS keys (id INTEGER PRIMARY KEY, value BLOB NOT NULL)''')
+            c.execute('''CREATE TABLE IF NOT EXISTS tombstones (id INTEGER PRIMARY KEY)''')
+            c.execute('''CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value BLOB NOT NULL)''')
+            c.execute('''CREATE INDEX IF NOT EXISTS bands ON lsh (band, hash, id)''')
             self.conn.commit()
         except sqlite3.OperationalError:
             self.conn.rollback()
         finally:
             c.close()
+        self.ids = self._load_ids()
+
+    def _load_ids(self) -> Dict[Key, int]:
+        c = self.conn.cursor()
+        try:
+            self.next_id = c.execute('''SELECT COALESCE(MAX(id) + 1, 0) FROM keys''').fetchone()[0]
+            return {
+                pickle.loads(value): idx for idx, value in
+                c.execute('''SELECT id, value FROM keys WHERE id NOT IN (SELECT id FROM tombstones)''')
+            }
+        finally:
+            c.close()
+
+    @contextmanager
+    def bulk(self, batch: int=10000, keep_index: bool=False):
+        """Bulk load session.
+
+        The band index is dropped until the end of the session (unless
+        `keep_index` is set, `bucket_sizes` joins against it), inserts are
+        committed every `batch` items instead of on each call, and SQLite
+        doesn't sync to disk until the session finishes.
+        """
+        c = self.conn.cursor()
+        try:
+            if not keep_index:
+                c.execute('''DROP INDEX IF EXISTS bands''')
+            c.execute('PRAGMA synchronous = OFF')
+            self.conn.commit()
+            self.in_bulk, self.batch, self.pending = True, batch, 0
+            yield self
+        finally:
+            self.in_bulk = False
+            self.conn.commit()
+            c.execute('''CREATE INDEX IF NOT EXISTS bands ON lsh (band, hash, id)''')
+            c.execute('PRAGMA synchronous = NORMAL')
+            self.conn.commit()
+            c.close()
+
+    def _intern(self, values: List[Key]) -> Tuple[List[int], List[Key]]:
+        """Get the id of each key, keys without one are assigned the next id and returned."""
+        ids = []
+        new = []
+        for value in values:
+            idx = self.ids.get(value)
+            if idx is None:
+                idx = self.ids[value] = self.next_id
+                self.next_id += 1
+                new.append(value)
+            ids.append(idx)
+        return ids, new
+
+    def _commit(self, n: int) -> None:
+        if not self.in_bulk:
+            self.conn.commit()
+            return
+        self.pending += n
+        if self.pending >= self.batch:
+            self.conn.commit()
+            self.pending = 0
 
     def insert(self, keys: Iterable[bytes], value: Key) -> None:
+        self.insert_many(from_keys(keys)[np.newaxis], [value])
+
+    def insert_many(self, keys: np.ndarray, values: List[Key]) -> None:
+        keys = np.asarray(keys, dtype=np.uint64)
+        n, b = keys.shape
+        ids, new = self._intern(values)
         try:
             c = self.conn.cursor()
             c.executemany(
-                '''INSERT INTO lsh (key, value) VALUES (?, ?)''',
+                '''INSERT INTO keys (id, value) VALUES (?, ?)''',
+                ((self.ids[value], pickle.dumps(value)) for value in new)
+            )
+            c.executemany(
+                '''INSERT INTO lsh (band, hash, id) VALUES (?, ?, ?)''',
                 zip(
-                    [key + struct.pack('<I', i) for i, key in enumerate(keys)],
-                    cycle([pickle.dumps(value)])
+                    np.tile(np.arange(b), n).tolist(),
+                    keys.view(np.int64).ravel().tolist(),
+                    np.repeat(ids, b).tolist()
                 )
             )
-            self.conn.commit()
+            self._commit(n)
         except:
             self.conn.rollback()
+            # Anything since the last commit is gone, including uncommitted keys from earlier calls.
+            self.ids = self._load_ids()
+            raise
         finally:
             c.close()
 
+    def insert_bands(self, bands: np.ndarray, hashes: np.ndarray, values: List[Key]) -> None:
+        ids, new = self._intern(values)
+        try:
+            c = self.conn.cursor()
+            c.executemany(
+                '''INSERT INTO keys (id, value) VALUES (?, ?)''',
+                ((self.ids[value], pickle.dumps(value)) for value in new)
+            )
+            c.executemany(
+                '''INSERT INTO lsh (band, hash, id) VALUES (?, ?, ?)''',
+                zip(
+                    np.asarray(bands).tolist(),
+                    np.asarray(hashes, dtype=np.uint64).view(np.int64).tolist(),
+                    ids
+                )
+            )
+            self._commit(len(set(ids)))
+        except:
+            self.conn.rollback()
+            self.ids = self._load_ids()
+            raise
+        finally:
+            c.close()
+
+    def remove_bands(self, bands: np.ndarray, hashes: np.ndarray, values: List[Key]) -> None:
+        try:
+            c = self.conn.cursor()
+            c.executemany(
+                '''DELETE FROM lsh WHERE band = ? AND hash = ? AND id = ?''',
+                (
+                    (band, h, self.ids[value]) for band, h, value in
+                    zip(np.asarray(bands).tolist(), np.asarray(hashes, dtype=np.uint64).view(np.int64).tolist(), values)
+                    if value in self.ids
+                )
+            )
+            self._commit(0)
+        except:
+            self.conn.rollback()
+            self.ids = self._load_ids()
+            raise
+        finally:
+            c.close()
+
+    def bucket_sizes(self, bands: np.ndarray, hashes: np.ndarray) -> np.ndarray:
+        # Counted on the writer connection so rows from an unfinished `bulk` session are included.
+        c = self.conn.cursor()
+        try:
+            c.execute('''CREATE TEMP TABLE IF NOT EXISTS cells (cell INTEGER NOT NULL, band INTEGER NOT NULL, hash INTEGER NOT NULL)''')
+            c.execute('''DELETE FROM cells''')
+            c.executemany(
+                '''INSERT INTO cells (cell, band, hash) VALUES (?, ?, ?)''',
+                zip(
+                    range(len(bands)),
+                    np.asarray(bands).tolist(),
+                    np.asarray(hashes, dtype=np.uint64).view(np.int64).tolist()
+                )
+            )
+            rows = c.execute(
+                '''SELECT cells.cell, COUNT(lsh.id) FROM cells
+                JOIN lsh ON lsh.band = cells.band AND lsh.hash = cells.hash
+                GROUP BY cells.cell'''
+            ).fetchall()
+        finally:
+            c.close()
+        sizes = np.zeros(len(bands), dtype=np.int64)
+        if rows:
+            rows = np.array(rows, dtype=np.int64)
+            sizes[rows[:, 0]] = rows[:, 1]
+        return sizes
+
+    def reader(self) -> sqlite3.Connection:
+        """The lookup connection for the current thread."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.name, isolation_level=None, uri=self.uri)
+            conn.execute('''CREATE TEMP TABLE queries (query INTEGER NOT NULL, band INTEGER NOT NULL, hash INTEGER NOT NULL)''')
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def lookup_cursor(self):
+        """A cursor for lookups, on the writer connection during a bulk session."""
+        if not self.in_bulk:
+            c = self.reader().cursor()
+            try:
+                yield c
+            finally:
+                c.close()
+            return
+        with self.bulk_lock:
+            c = self.conn.cursor()
+            try:
+                c.execute('''CREATE TEMP TABLE IF NOT EXISTS queries (query INTEGER NOT NULL, band INTEGER NOT NULL, hash INTEGER NOT NULL)''')
+                yield c
+            finally:
+                c.close()
+
     def get(self, keys: Iterable[bytes]) -> Set[Key]:
-        values = set()
+        return self.get_many(from_keys(keys)[np.newaxis])[0]
+
+    def get_ids_many(self, keys: np.ndarray) -> List[np.ndarray]:
+        """Look up many queries in one round trip and return the candidate key ids of each."""
+        keys = np.asarray(keys, dtype=np.uint64)
+        n, b = keys.shape
+        return self._query_ids(np.repeat(np.arange(n), b), np.tile(np.arange(b), n), keys.ravel(), n)
+
+    def _query_ids(self, queries: np.ndarray, bands: np.ndarray, hashes: np.ndarray, n: int) -> List[np.ndarray]:
+        """Join (query, band, hash) rows against the tables, returns the ids found for each query."""
+        with self.lookup_cursor() as c:
+            c.execute('''DELETE FROM queries''')
+            c.executemany(
+                '''INSERT INTO queries (query, band, hash) VALUES (?, ?, ?)''',
+                zip(
+                    np.asarray(queries).tolist(),
+                    np.asarray(bands).tolist(),
+                    np.asarray(hashes, dtype=np.uint64).view(np.int64).tolist()
+                )
+            )
+            rows = c.execute(
+                '''SELECT DISTINCT queries.query, lsh.id FROM queries
+                JOIN lsh ON lsh.band = queries.band AND lsh.hash = queries.hash
+                WHERE lsh.id NOT IN (SELECT id FROM tombstones)
+                ORDER BY queries.query'''
+            ).fetchall()
+        rows = np.array(rows, dtype=np.int64).reshape(-1, 2)
+        return np.split(rows[:, 1], np.searchsorted(rows[:, 0], np.arange(1, n)))
+
+    def get_bands(self, bands: np.ndarray, hashes: np.ndarray) -> Set[Key]:
+        ids = self._query_ids(np.zeros(len(bands), dtype=np.int64), bands, hashes, 1)[0].tolist()
+        return set(self.lookup(ids).values())
+
+    def lookup(self, ids: Iterable[int]) -> Dict[int, Key]:
+        """Unpickle the keys for some ids, each key is loaded once."""
+        ids = sorted(set(ids))
+        with self.lookup_cursor() as c:
+            values = {}
+            # Stay under SQLite's limit on the number of parameters.
+            for start in range(0, len(ids), 900):
+                chunk = ids[start:start + 900]
+                c.execute(f'''SELECT id, value FROM keys WHERE id IN ({",".join(["?"] * len(chunk))})''', chunk)
+                values.update((idx, pickle.loads(value)) for idx, value in c.fetchall())
+            return values
+
+    def get_many(self, keys: np.ndarray) -> List[Set[Key]]:
+        ids = self.get_ids_many(keys)
+        values = self.lookup(np.concatenate(ids).tolist() if ids else [])
+        return [set(values[i] for i in cands.tolist()) for cands in ids]
+
+    def key_ids(self, values: List[Key]) -> List[Optional[int]]:
+        return [self.ids.get(value) for value in values]
+
+    def remove(self, value: Key, keys: Optional[np.ndarray]=None) -> None:
+        idx = self.ids.pop(value, None)
+        if idx is None:
+            return
+        try:
+            c = self.conn.cursor()
+            c.execute('''INSERT INTO tombstones (id) VALUES (?)''', (idx,))
+            self._commit(1)
+        except:
+            self.conn.rollback()
+            self.ids = self._load_ids()
+            raise
+        finally:
+            c.close()
+
+    def compact(self) -> None:
+        try:
+            c = self.conn.cursor()
+            c.execute('''DELETE FROM lsh WHERE id IN (SELECT id FROM tombstones)''')
+            c.execute('''DELETE FROM keys WHERE id IN (SELECT id FROM tombstones)''')
+            c.execute('''DELETE FROM tombstones''')
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+        finally:
+            c.close()
+
+    def nbytes(self) -> int:
+        c = self.conn.cursor()
+        try:
+            pages = c.execute('''PRAGMA page_count''').fetchone()[0]
+            return pages * c.execute('''PRAGMA page_size''').fetchone()[0]
+        finally:
+            c.close()
+
+    def save(self, lsh, hasher):
+        # The LSH is stored without its backend, which is this database.
+        lsh = copy.copy(lsh)
+        lsh.data = None
         try:
             c = self.conn.cursor()
-            c.execute(
-                f'''SELECT value FROM lsh WHERE key in ({",".join(['?'] * len(keys))});''',
-                [key + struct.pack('<I', i) for i, key in enumerate(keys)]
+            c.executemany(
+                '''INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)''',
+                [('lsh', pickle.dumps(lsh)), ('hasher', pickle.dumps(hasher))]
             )
-            values = c.fetchall()
-            values = set(pickle.loads(val[0]) for val in values)
+            self.conn.commit()
         except:
             self.conn.rollback()
+            raise
+        finally:
+            c.close()
+        if self.uri:
+            target = sqlite3.connect(self.path)
+            try:
+                self.conn.backup(target)
+            finally:
+                target.close()
+
+    @classmethod
+    def reload(cls, name):
+        data = cls(name)
+        meta = dict(data.conn.execute('''SELECT name, value FROM meta''').fetchall())
+        assert 'lsh' in meta, f"{name} has no saved LSH, write it with LSH.save first"
+        return data, pickle.loads(meta['lsh']), pickle.loads(meta['hasher'])
+
+    def export(self) -> Exported:
+        c = self.conn.cursor()
+        try:
+            rows = c.execute(
+                '''SELECT lsh.hash, lsh.band, keys.value FROM lsh JOIN keys ON lsh.id = keys.id
+                WHERE lsh.id NOT IN (SELECT id FROM tombstones)'''
+            ).fetchall()
         finally:
             c.close()
-        return values
+        return _intern_rows(
+            (np.array([h], dtype=np.int64).view(np.uint64)[0], band, pickle.loads(value))
+            for h, band, value in rows
+        )
 
 
 class PickleData(Data):
+    """In memory dict of sets tables.
+
+    Keys are interned to integer ids (`self.ids` maps key -> id and
+    `self.keys` maps id -> key) and the buckets hold ids. Removed keys give
+    up their id, which is tombstoned in `self.dead` until `compact` drops
+    its entries, and get a new id if they are inserted again, so updating a
+    key never has to scan the tables.
+    """
+
     def __init__(self, name: str, b: int):
         super().__init__(name)
         self.tables = [defaultdict(set) for _ in range(b)]
+        self.ids = {}
+        self.keys = []
+        self.dead = set()
+
+    def _intern(self, values: List[Key]) -> List[int]:
+        ids = []
+        for value in values:
+            idx = self.ids.get(value)
+            if idx is None:
+                idx = self.ids[value] = len(self.keys)
+                self.keys.append(value)
+            ids.append(idx)
+        return ids
+
+    def _keys(self, ids: Set[int]) -> Set[Key]:
+        return set(self.keys[i] for i in ids - self.dead)
 
     def insert(self, keys: Iterable[bytes], value: Key) -> None:
+        idx = self._intern([value])[0]
         for key, table in zip(keys, self.tables):
-            table[key].add(value)
+            table[key].add(idx)
 
     def get(self, keys: Iterable[bytes]) -> Set[Key]:
         cands = set()
         for key, table in zip(keys, self.tables):
-            cands.update(table[key])
-        return cands
+            # `.get` so a miss doesn't add an empty bucket to the defaultdict.
+            cands.update(table.get(key, ()))
+        return self._keys(cands)
+
+    def get_bands(self, bands: np.ndarray, hashes: np.ndarray) -> Set[Key]:
+        cands = set()
+        for band, key in zip(np.asarray(bands).tolist(), to_keys(hashes)):
+            cands.update(self.tables[band].get(key, ()))
+        return self._keys(cands)
+
+    def insert_many(self, keys: np.ndarray, values: List[Key]) -> None:
+        ids = self._intern(values)
+        for band, table in zip(keys.T, self.tables):
+            for key, idx in zip(to_keys(band), ids):
+                table[key].add(idx)
+
+    def insert_bands(self, bands: np.ndarray, hashes: np.ndarray, values: List[Key]) -> None:
+        ids = self._intern(values)
+        for band, key, idx in zip(np.asarray(bands).tolist(), to_keys(hashes), ids):
+            self.tables[band][key].add(idx)
+
+    def remove_bands(self, bands: np.ndarray, hashes: np.ndarray, values: List[Key]) -> None:
+        for band, key, value in zip(np.asarray(bands).tolist(), to_keys(hashes), values):
+            bucket = self.tables[band].get(key)
+            if bucket is not None and value in self.ids:
+                bucket.discard(self.ids[value])
+                if not bucket:
+                    del self.tables[band][key]
+
+    def bucket_sizes(self, bands: np.ndarray, hashes: np.ndarray) -> np.ndarray:
+        return np.array(
+            [len(self.tables[band].get(key, ())) for band, key in zip(np.asarray(bands).tolist(), to_keys(hashes))],
+            dtype=np.int64
+        )
+
+    def key_ids(self, values: List[Key]) -> List[Optional[int]]:
+        return [self.ids.get(value) for value in values]
+
+    def remove(self, value: Key, keys: Optional[np.ndarray]=None) -> None:
+        idx = self.ids.pop(value, None)
+        if idx is None:
+            return
+        # Tombstone the id even when its entries are known, inserting the key
+        # twice with different signatures leaves entries `keys` doesn't cover.
+        self.dead.add(idx)
+        if keys is None:
+            return
+        for key, table in zip(to_keys(keys), self.tables):
+            bucket = table.get(key)
+            if bucket is not None:
+                bucket.discard(idx)
+                if not bucket:
+                    del table[key]
+
+    def compact(self) -> None:
+        if not self.dead and len(self.keys) == len(self.ids):
+            return
+        live = sorted(self.ids.values())
+        remap = {idx: i for i, idx in enumerate(live)}
+        for table in self.tables:
+            for key in list(table):
+                bucket = {remap[idx] for idx in table[key] if idx in remap}
+                if bucket:
+                    table[key] = bucket
+                else:
+                    del table[key]
+        self.keys = [self.keys[idx] for idx in live]
+        self.ids = {key: i for i, key in enumerate(self.keys)}
+        self.dead = set()
+
+    def export(self) -> Exported:
+        hashes, ids = [], []
+        for table in self.tables:
+            buckets = list(table.items())
+            sizes = [len(values) for _, values in buckets]
+            hashes.append(np.repeat(from_keys([key for key, _ in buckets]), sizes))
+            ids.append(np.fromiter((idx for _, values in buckets for idx in values), dtype=np.int64, count=sum(sizes)))
+        if self.dead:
+            # Filter instead of compacting so exporting doesn't change the tables.
+            dead = np.array(sorted(self.dead), dtype=np.int64)
+            keep = [~np.isin(i, dead) for i in ids]
+            hashes = [h[k] for h, k in zip(hashes, keep)]
+            ids = [i[k] for i, k in zip(ids, keep)]
+        return hashes, ids, list(self.keys)
+
+    def nbytes(self) -> int:
+        # Keys are shared with the caller so only the containers are counted.
+        tables = sum(
+            sys.getsizeof(table) + sum(sys.getsizeof(key) + sys.getsizeof(values) for key, values in table.items())
+            for table in self.tables
+        )
+        return tables + sys.getsizeof(self.ids) + sys.getsizeof(self.keys)
 
     def save(self, lsh, hasher):
-        data = [self.tables, lsh, hasher]
+        self.compact()
+        data = [(self.tables, self.keys), lsh, hasher]
         pickle.dump(data, open(f"{self.name}.p", "wb"))
 
     @classmethod
     def reload(cls, name):
         data = pickle.load(open(f"{name}.p", "rb"))
         tables, lsh, hasher = data
+        # Files from before band hashing hold a list of tables keyed by raw signature bytes.
+        assert isinstance(tables, tuple), f"{name}.p holds an index from an older version, rebuild it"
         data = cls(name, 1)
-        data.tables = tables
+        data.tables, data.keys = tables
+        data.ids = {key: i for i, key in enumerate(data.keys)}
         return data, lsh, hasher
 
 
-def sniff(file_name: str) -> Union[SQLData, PickleData]:
+class ArrayData(Data):
+    """In memory backend with compact, array based bucket tables.
+
+    Keys are interned to dense integer ids (`self.ids` maps key -> id and
+    `self.keys` maps id -> key). Entries are kept in `self.runs`, each run
+    stores every band as a pair of arrays, the band hashes sorted and the
+    matching ids, and buckets are found with `np.searchsorted` in each run.
+    New (band, band hash, id) entries are buffered and sorted into a new run
+    on the next lookup, small runs are merged into bigger ones (see `_merge`)
+    so mixing inserts and lookups never re-sorts the whole index. Removed
+    keys give up their id, which is tombstoned in `self.dead` until `compact`
+    drops its entries, and get a new id if they are inserted again.
+
+    The run arrays are never changed in place, merges swap in new lists
+    under `self.lock` so lookups running in several threads each work on a
+    consistent set of arrays.
+    """
+
+    def __init__(self, name: str, b: int):
+        super().__init__(name)
+        self.b = b
+        self.ids = {}
+        self.keys = []
+        self.runs = []
+        self.pending = []
+        self.dead = set()
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def _intern(self, values: List[Key]) -> np.ndarray:
+        ids = np.empty(len(values), dtype=np.int64)
+        for i, value in enumerate(values):
+            idx = self.ids.get(value)
+            if idx is None:
+                idx = len(self.keys)
+                self.ids[value] = idx
+                self.keys.append(value)
+            ids[i] = idx
+        return ids
+
+    def _merge(self, flatten: bool=False, run: Optional[Run]=None) -> List[Run]:
+        """Sort buffered inserts into a new run and merge runs, returns the runs oldest first.
+
+        The newest run is merged into the one before it while that one is
+        less than `RUN_RATIO` times bigger, so there are O(log n) runs and
+        each entry is copied O(log n) times. `flatten` merges every run into
+        one and `run` is a sorted run to add after the buffered inserts.
+        """
+        with self.lock:
+            runs = list(self.runs)
+            if self.pending:
+                runs.append(self._sort_pending())
+                self.pending = []
+            if run is not None:
+                runs.append(run)
+            while len(runs) > 1 and (flatten or run_size(runs[-2]) < RUN_RATIO * run_size(runs[-1])):
+                runs[-2:] = [merge_runs(runs[-2], runs[-1])]
+            self.runs = runs
+            return runs
+
+    def _id_dtype(self):
+        return np.int32 if len(self.keys) < np.iinfo(np.int32).max else np.int64
+
+    def _sort_pending(self) -> Run:
+        bands = np.concatenate([b for b, _, _ in self.pending])
+        keys = np.concatenate([k for _, k, _ in self.pending])
+        ids = np.concatenate([v for _, _, v in self.pending])
+        order = np.lexsort((keys, bands))
+        bands, keys, ids = bands[order], keys[order], ids[order].astype(self._id_dtype())
+        bounds = np.searchsorted(bands, np.arange(self.b + 1)).tolist()
+        return (
+            [keys[start:end] for start, end in zip(bounds, bounds[1:])],
+            [ids[start:end] for start, end in zip(bounds, bounds[1:])]
+        )
+
+    def _replace(self, keep: Dict[Tuple[int, int], np.ndarray]) -> None:
+        """Swap in runs that only keep the masked entries, `keep` is keyed by (run, band)."""
+        with self.lock:
+            runs = [(list(hashes), list(values)) for hashes, values in self.runs]
+            for (run, band), mask in keep.items():
+                hashes, values = runs[run]
+                hashes[band] = hashes[band][mask]
+                values[band] = values[band][mask]
+            self.runs = runs
+
+    def insert(self, keys: Iterable[bytes], value: Key) -> None:
+        self.insert_many(from_keys(keys)[np.newaxis], [value])
+
+    def insert_many(self, keys: np.ndarray, values: List[Key]) -> None:
+        keys = np.asarray(keys, dtype=np.uint64)
+        n, b = keys.shape
+        bands = np.tile(np.arange(b, dtype=np.int32), n)
+        ids = np.repeat(self._intern(values), b)
+        with self.lock:
+            self.pending.append((bands, keys.ravel(), ids))
+
+    def insert_bands(self, bands: np.ndarray, hashes: np.ndarray, values: List[Key]) -> None:
+        bands = np.asarray(bands, dtype=np.int32)
+        ids = self._intern(values)
+        with self.lock:
+            self.pending.append((bands, np.asarray(hashes, dtype=np.uint64), ids))
+
+    def load_bands(self, tables: List[Tuple[np.ndarray, np.ndarray]], values: List[Key]) -> None:
+        # The tables are already sorted, so they become a run as they are.
+        ids = self._intern(values).astype(self._id_dtype())
+        self._merge(run=([hashes for hashes, _ in tables], [ids[rows] for _, rows in tables]))
+
+    def remove_bands(self, bands: np.ndarray, hashes: np.ndarray, values: List[Key]) -> None:
+        runs = self._merge()
+        keep = {}
+        for band, h, value in zip(np.asarray(bands).tolist(), np.asarray(hashes, dtype=np.uint64), values):
+            idx = self.ids.get(value)
+            if idx is None:
+                continue
+            for run, (tables, ids) in enumerate(runs):
+                start = np.searchsorted(tables[band], h, side='left')
+                end = np.searchsorted(tables[band], h, side='right')
+                mask = keep.setdefault((run, band), np.ones(len(tables[band]), dtype=bool))
+                mask[start + np.flatnonzero(ids[band][start:end] == idx)] = False
+        self._replace(keep)
+
+    def bucket_sizes(self, bands: np.ndarray, hashes: np.ndarray) -> np.ndarray:
+        runs = self._merge()
+        bands = np.asarray(bands)
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        sizes = np.zeros(len(bands), dtype=np.int64)
+        for band in np.unique(bands).tolist():
+            mask = bands == band
+            for tables, _ in runs:
+                sizes[mask] += (
+                    np.searchsorted(tables[band], hashes[mask], side='right')
+                    - np.searchsorted(tables[band], hashes[mask], side='left')
+                )
+        return sizes
+
+    def get(self, keys: Iterable[bytes]) -> Set[Key]:
+        return self.get_many(from_keys(keys)[np.newaxis])[0]
+
+    def get_many(self, keys: np.ndarray) -> List[Set[Key]]:
+        runs = self._merge()
+        keys = np.asarray(keys, dtype=np.uint64)
+        found = [set() for _ in range(len(keys))]
+        for tables, ids in runs:
+            for band in range(self.b):
+                hashes = tables[band]
+                starts = np.searchsorted(hashes, keys[:, band], side='left')
+                ends = np.searchsorted(hashes, keys[:, band], side='right')
+                for cands, start, end in zip(found, starts, ends):
+                    if end > start:
+                        cands.update(ids[band][start:end].tolist())
+        return [set(self.keys[i] for i in cands - self.dead) for cands in found]
+
+    def get_bands(self, bands: np.ndarray, hashes: np.ndarray) -> Set[Key]:
+        runs = self._merge()
+        cands = set()
+        for band, h in zip(np.asarray(bands).tolist(), np.asarray(hashes, dtype=np.uint64)):
+            for tables, ids in runs:
+                start = np.searchsorted(tables[band], h, side='left')
+                end = np.searchsorted(tables[band], h, side='right')
+                cands.update(ids[band][start:end].tolist())
+        return set(self.keys[i] for i in cands - self.dead)
+
+    def key_ids(self, values: List[Key]) -> List[Optional[int]]:
+        return [self.ids.get(value) for value in values]
+
+    def remove(self, value: Key, keys: Optional[np.ndarray]=None) -> None:
+        idx = self.ids.pop(value, None)
+        if idx is not None:
+            self.dead.add(idx)
+
+    def compact(self) -> None:
+        runs = self._merge(flatten=True)
+        if not self.dead and len(self.keys) == len(self.ids):
+            return
+        live = np.array(sorted(self.ids.values()), dtype=np.int64)
+        remap = np.full(len(self.keys), -1, dtype=np.int64)
+        remap[live] = np.arange(len(live))
+        keys = [self.keys[idx] for idx in live.tolist()]
+        with self.lock:
+            self.keys = keys
+            self.ids = {key: i for i, key in enumerate(keys)}
+            if runs:
+                hashes, values = runs[0]
+                ids = [remap[band] for band in values]
+                masks = [band >= 0 for band in ids]
+                self.runs = [(
+                    [h[mask] for h, mask in zip(hashes, masks)],
+                    [i[mask].astype(self._id_dtype()) for i, mask in zip(ids, masks)]
+                )]
+            self.dead = set()
+
+    def export(self) -> Exported:
+        runs = self._merge()
+        hashes = [np.concatenate([run[0][band] for run in runs] or [np.zeros(0, dtype=np.uint64)]) for band in range(self.b)]
+        ids = [np.concatenate([run[1][band] for run in runs] or [np.zeros(0, dtype=np.int64)]) for band in range(self.b)]
+        if self.dead:
+            # Filter instead of compacting so exporting doesn't change the tables.
+            dead = np.array(sorted(self.dead), dtype=np.int64)
+            keep = [~np.isin(i, dead) for i in ids]
+            hashes = [h[k] for h, k in zip(hashes, keep)]
+            ids = [i[k] for i, k in zip(ids, keep)]
+        return hashes, ids, list(self.keys)
+
+    def nbytes(self) -> int:
+        arrays = sum(h.nbytes + v.nbytes for hashes, values in self.runs for h, v in zip(hashes, values))
+        pending = sum(b.nbytes + k.nbytes + v.nbytes for b, k, v in self.pending)
+        return arrays + pending + sys.getsizeof(self.ids) + sys.getsizeof(self.keys)
+
+    def save(self, lsh, hasher):
+        self.compact()
+        hashes, values, keys = self.export()
+        data = [(hashes, values, keys), lsh, hasher]
+        pickle.dump(data, open(f"{self.name}.arrays.p", "wb"))
+
+    @classmethod
+    def reload(cls, name):
+        data = pickle.load(open(f"{name}.arrays.p", "rb"))
+        (hashes, values, keys), lsh, hasher = data
+        data = cls(name, len(hashes))
+        data.runs = [(hashes, values)]
+        data.keys = keys
+        data.ids = {key: i for i, key in enumerate(keys)}
+        return data, lsh, hasher
+
+
+class FrozenData(Data):
+    """A read only, memory-mapped index.
+
+    The file is `FROZEN_MAGIC`, the length of a JSON header, the header, and
+    then flat arrays each aligned to `ALIGN` bytes. The header has the `LSH`
+    and hasher parameters and the dtype, shape and offset of each array. The
+    bands are stored CSR style: `hashes` holds the sorted unique hashes of
+    every band one after the other (band i is `hashes[band_offsets[i]:band_offsets[i + 1]]`)
+    and the ids in bucket j are `ids[bucket_offsets[j]:bucket_offsets[j + 1]]`.
+
+    Opening the file only maps it so loading is fast and processes that open
+    the same index share its pages. Integer, str and bytes keys are read from
+    the mapped arrays when they are needed (see `FrozenKeys`) and so are the
+    stored signature rows of the `LSH` (see `FrozenRows`), other keys are
+    unpickled when the file is opened.
+    """
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        header, arrays = read_frozen(name)
+        self.header = header
+        self.arrays = arrays
+        self.hashes = arrays['hashes']
+        self.band_offsets = arrays['band_offsets']
+        self.bucket_offsets = arrays['bucket_offsets']
+        self.ids = arrays['ids']
+        self.keys = FrozenKeys(header['keys'], arrays)
+        self.b = len(self.band_offsets) - 1
+        # Ids removed since the file was written, the file itself is never changed.
+        self.dead = set()
+
+    def insert(self, keys: Iterable[bytes], value: Key) -> None:
+        raise NotImplementedError("FrozenData is read only")
+
+    def insert_many(self, keys: np.ndarray, values: List[Key]) -> None:
+        raise NotImplementedError("FrozenData is read only")
+
+    def get(self, keys: Iterable[bytes]) -> Set[Key]:
+        return self.get_many(from_keys(keys)[np.newaxis])[0]
+
+    def get_many(self, keys: np.ndarray) -> List[Set[Key]]:
+        keys = np.asarray(keys, dtype=np.uint64)
+        found = [set() for _ in range(len(keys))]
+        for band in range(self.b):
+            start, end = self.band_offsets[band], self.band_offsets[band + 1]
+            hashes = self.hashes[start:end]
+            pos = np.searchsorted(hashes, keys[:, band])
+            hit = pos < len(hashes)
+            hit[hit] = hashes[pos[hit]] == keys[hit, band]
+            for i in np.flatnonzero(hit):
+                bucket = start + pos[i]
+                found[i].update(self.ids[self.bucket_offsets[bucket]:self.bucket_offsets[bucket + 1]].tolist())
+        return [self._keys(cands) for cands in found]
+
+    def key_ids(self, values: List[Key]) -> List[Optional[int]]:
+        ids = []
+        for value in values:
+            # A key removed and inserted again before freezing has several ids, the last one is live.
+            live = [idx for idx in self.keys.find(value).tolist() if idx not in self.dead]
+            ids.append(max(live) if live else None)
+        return ids
+
+    def remove(self, value: Key, keys: Optional[np.ndarray]=None) -> None:
+        self.dead.update(self.keys.find(value).tolist())
+
+    def compact(self) -> None:
+        raise NotImplementedError("FrozenData is read only, freeze the index again to drop removed items")
+
+    def _keys(self, ids: Set[int]) -> Set[Key]:
+        return set(self.keys.lookup(sorted(ids - self.dead)))
+
+    def get_bands(self, bands: np.ndarray, hashes: np.ndarray) -> Set[Key]:
+        cands = set()
+        for band, h in zip(np.asarray(bands).tolist(), np.asarray(hashes, dtype=np.uint64)):
+            start, end = self.band_offsets[band], self.band_offsets[band + 1]
+            pos = start + np.searchsorted(self.hashes[start:end], h)
+            if pos < end and self.hashes[pos] == h:
+                cands.update(self.ids[self.bucket_offsets[pos]:self.bucket_offsets[pos + 1]].tolist())
+        return self._keys(cands)
+
+    def export(self) -> Exported:
+        hashes, ids = [], []
+        for band in range(self.b):
+            start, end = self.band_offsets[band], self.band_offsets[band + 1]
+            sizes = np.diff(self.bucket_offsets[start:end + 1])
+            hashes.append(np.repeat(self.hashes[start:end], sizes))
+            ids.append(np.asarray(self.ids[self.bucket_offsets[start]:self.bucket_offsets[end]]))
+        if self.dead:
+            dead = np.array(sorted(self.dead), dtype=np.int64)
+            keep = [~np.isin(i, dead) for i in ids]
+            hashes = [h[k] for h, k in zip(hashes, keep)]
+            ids = [i[k] for i, k in zip(ids, keep)]
+        return hashes, ids, self.keys.tolist()
+
+    def nbytes(self) -> int:
+        return os.path.getsize(self.name)
+
+    @staticmethod
+    def write(name: str, lsh, hasher, data: Data) -> None:
+        """Freeze the band tables in `data` together with `lsh` and `hasher` into the file `name`."""
+        band_hashes, band_ids, keys = data.export()
+        empty = np.zeros(0, dtype=np.int64)
+        band_hashes = list(band_hashes) + [empty] * (lsh.b - len(band_hashes))
+        band_ids = list(band_ids) + [empty] * (lsh.b - len(band_ids))
+        id_dtype = np.int32 if len(keys) < np.iinfo(np.int32).max else np.int64
+        hashes, bucket_offsets, ids = [], [np.zeros(1, dtype=np.int64)], []
+        band_offsets = [0]
+        entries = 0
+        for h, i in zip(band_hashes, band_ids):
+            h = np.asarray(h, dtype=np.uint64)
+            i = np.asarray(i, dtype=np.int64)
+            order = np.lexsort((i, h))
+            h, i = h[order], i[order]
+            # Drop repeated (hash, id) pairs
+            keep = np.concatenate([[True], (h[1:] != h[:-1]) | (i[1:] != i[:-1])])
+            h, i = h[keep], i[keep]
+            starts = np.flatnonzero(np.concatenate([[True], h[1:] != h[:-1]])) if len(h) else np.zeros(0, dtype=np.int64)
+            hashes.append(h[starts])
+            bucket_offsets.append(np.append(starts[1:], len(h)) + entries)
+            ids.append(i.astype(id_dtype))
+            entries += len(h)
+            band_offsets.append(band_offsets[-1] + len(starts))
+        arrays = {
+            'hashes': np.concatenate(hashes),
+            'band_offsets': np.array(band_offsets, dtype=np.int64),
+            'bucket_offsets': np.concatenate(bucket_offsets).astype(np.int64),
+            'ids': np.concatenate(ids),
+        }
+        kind = FrozenKeys.write(keys, arrays)
+        if lsh.store_signatures:
+            # The signature row of each key id, -1 for ids without one.
+            ids = {key: idx for idx, key in enumerate(keys)}
+            rows = np.full(len(keys), -1, dtype=np.int64)
+            for key, row in lsh.sig_rows.items():
+                # Keys a bucket cap kept out of every bucket can't be candidates.
+                if key in ids:
+                    rows[ids[key]] = row
+            arrays['sig_rows'] = rows
+        header = {
+            'lsh': object_state(lsh, arrays, 'lsh', skip=('data', 'sig_rows')),
+            'hasher': object_state(hasher, arrays, 'hasher'),
+            'keys': kind,
+        }
+        write_frozen(name, header, arrays)
+
+    @classmethod
+    def reload(cls, name):
+        data = cls(name)
+        lsh = object_from_state(data.header['lsh'], data.arrays, 'lsh')
+        lsh.sig_rows = FrozenRows(data, data.arrays['sig_rows']) if 'sig_rows' in data.arrays else {}
+        hasher = object_from_state(data.header['hasher'], data.arrays, 'hasher')
+        return data, lsh, hasher
+
+
+class FrozenKeys(object):
+    """The id -> key table of a `FrozenData` file.
+
+    Integer keys are an int64 array. str and bytes keys are one blob of
+    encoded bytes with an offset per key, a key is decoded when it is looked
+    up. Either way `key_order` sorts the ids by key so `find` is a binary
+    search. Other keys are pickled and loaded up front.
+    """
+
+    def __init__(self, kind: str, arrays: Dict[str, np.ndarray]):
+        self.kind = kind
+        self.order = arrays.get('key_order')
+        if kind == "int":
+            self.keys = arrays['keys']
+            self.sorted = arrays['sorted_keys']
+        elif kind in ("str", "bytes"):
+            # Memoryviews, indexing them is much cheaper than indexing the mapped arrays.
+            self.blob = memoryview(arrays['key_blob'])
+            self.offsets = memoryview(arrays['key_offsets'])
+            self.ranks = memoryview(self.order)
+        else:
+            self.keys = pickle.loads(arrays['pickled_keys'].tobytes())
+            self.index = None
+
+    @staticmethod
+    def write(keys: List[Key], arrays: Dict[str, np.ndarray]) -> str:
+        """Add the arrays for a list of keys to `arrays`, returns the kind of keys."""
+        if all(isinstance(k, (int, np.integer)) and not isinstance(k, bool) for k in keys):
+            keys = np.array(keys, dtype=np.int64)
+            order = np.argsort(keys, kind='stable')
+            arrays.update(keys=keys, sorted_keys=keys[order], key_order=order)
+            return "int"
+        for kind, cls in (("str", str), ("bytes", bytes)):
+            if all(isinstance(k, cls) for k in keys):
+                encoded = [k.encode('utf-8') if cls is str else k for k in keys]
+                offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+                np.cumsum([len(k) for k in encoded], out=offsets[1:])
+                arrays.update(
+                    key_blob=np.frombuffer(b''.join(encoded), dtype=np.uint8),
+                    key_offsets=offsets,
+                    key_order=np.array(sorted(range(len(keys)), key=encoded.__getitem__), dtype=np.int64),
+                )
+                return kind
+        arrays['pickled_keys'] = np.frombuffer(pickle.dumps(keys), dtype=np.uint8)
+        return "pickled"
+
+    def __len__(self) -> int:
+        if self.kind in ("str", "bytes"):
+            return len(self.offsets) - 1
+        return len(self.keys)
+
+    def _raw(self, idx: int) -> bytes:
+        return bytes(self.blob[self.offsets[idx]:self.offsets[idx + 1]])
+
+    def __getitem__(self, idx: int) -> Key:
+        if self.kind == "str":
+            return self._raw(idx).decode('utf-8')
+        if self.kind == "bytes":
+            return self._raw(idx)
+        return self.keys[idx].item() if self.kind == "int" else self.keys[idx]
+
+    def lookup(self, ids: List[int]) -> List[Key]:
+        if self.kind == "int":
+            return self.keys[ids].tolist()
+        return [self[idx] for idx in ids]
+
+    def tolist(self) -> List[Key]:
+        return self.lookup(list(range(len(self))))
+
+    def find(self, value: Key) -> np.ndarray:
+        """The ids of a key, in order."""
+        if self.kind == "int":
+            if not isinstance(value, (int, np.integer)) or isinstance(value, bool):
+                return np.zeros(0, dtype=np.int64)
+            lo, hi = np.searchsorted(self.sorted, value, side='left'), np.searchsorted(self.sorted, value, side='right')
+            return np.sort(self.order[lo:hi])
+        if self.kind in ("str", "bytes"):
+            if not isinstance(value, str if self.kind == "str" else bytes):
+                return np.zeros(0, dtype=np.int64)
+            raw = value.encode('utf-8') if self.kind == "str" else value
+            lo = bisect(self.ranks, raw, self._raw, left=True)
+            hi = bisect(self.ranks, raw, self._raw, left=False)
+            return np.sort(self.order[lo:hi])
+        if self.index is None:
+            self.index = defaultdict(list)
+            for idx, key in enumerate(self.keys):
+                self.index[key].append(idx)
+        return np.array(self.index.get(value, ()), dtype=np.int64)
+
+
+class FrozenRows(Mapping):
+    """`LSH.sig_rows` of a frozen index, key -> signature row looked up through the `FrozenData` keys."""
+
+    def __init__(self, data: FrozenData, rows: np.ndarray):
+        self.data = data
+        self.rows = rows
+        self.removed = set()
+
+    def __getitem__(self, key: Key) -> int:
+        idx = None if key in self.removed else self.data.key_ids([key])[0]
+        if idx is None or self.rows[idx] < 0:
+            raise KeyError(key)
+        return int(self.rows[idx])
+
+    def __iter__(self) -> Iterator[Key]:
+        for key in self.data.keys.lookup(np.flatnonzero(np.asarray(self.rows) >= 0).tolist()):
+            if key in self:
+                yield key
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def pop(self, key: Key, *default) -> int:
+        try:
+            row = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        self.removed.add(key)
+        return row
+
+
+def bisect(order: memoryview, value: bytes, get, left: bool) -> int:
+    """Binary search for `value` among the keys `get(idx)` of ids sorted by `order`."""
+    lo, hi = 0, len(order)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        key = get(order[mid])
+        if key < value or (not left and key == value):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def object_state(obj: Any, arrays: Dict[str, np.ndarray], prefix: str, skip: Tuple[str, ...]=()) -> Dict[str, Any]:
+    """Split an object's attributes into JSON values and arrays (added to `arrays` as `prefix.attr`)."""
+    if obj is None:
+        return None
+    state = {
+        'class': f"{type(obj).__module__}:{type(obj).__qualname__}",
+        'attrs': {},
+        'arrays': [],
+        'scalars': [],
+        'pickled': [],
+    }
+    # Classes that define `__getstate__` choose what gets stored, like with pickle.
+    custom = getattr(type(obj), '__getstate__', None) not in (None, getattr(object, '__getstate__', None))
+    attrs = obj.__getstate__() if custom else vars(obj)
+    for attr, value in attrs.items():
+        if attr in skip:
+            continue
+        if isinstance(value, (np.ndarray, np.generic)):
+            arrays[f"{prefix}.{attr}"] = np.asarray(value)
+            state['scalars' if isinstance(value, np.generic) else 'arrays'].append(attr)
+        elif isinstance(value, dict):
+            # JSON would turn non string keys into strings.
+            arrays[f"{prefix}.{attr}"] = np.frombuffer(pickle.dumps(value), dtype=np.uint8)
+            state['pickled'].append(attr)
+        else:
+            state['attrs'][attr] = value
+    return state
+
+
+def object_from_state(state: Dict[str, Any], arrays: Dict[str, np.ndarray], prefix: str) -> Any:
+    """Inverse of `object_state`, the object is created without calling `__init__`."""
+    if state is None:
+        return None
+    module, name = state['class'].split(':')
+    obj = object.__new__(getattr(importlib.import_module(module), name))
+    attrs = dict(state['attrs'])
+    for attr in state['arrays']:
+        attrs[attr] = arrays[f"{prefix}.{attr}"]
+    for attr in state['scalars']:
+        attrs[attr] = arrays[f"{prefix}.{attr}"][()]
+    for attr in state['pickled']:
+        attrs[attr] = pickle.loads(arrays[f"{prefix}.{attr}"].tobytes())
+    if hasattr(obj, '__setstate__'):
+        obj.__setstate__(attrs)
+    else:
+        obj.__dict__.update(attrs)
+    return obj
+
+
+def write_frozen(name: str, header: Dict[str, Any], arrays: Dict[str, np.ndarray]) -> None:
+    layout = {}
+    offset = 0
+    for key, array in arrays.items():
+        offset += -offset % ALIGN
+        layout[key] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += array.nbytes
+    # Numpy scalars nested in plain attributes (like LSH.ranges) are stored as Python numbers.
+    header = json.dumps({'header': header, 'layout': layout}, default=lambda x: x.item()).encode('utf-8')
+    start = len(FROZEN_MAGIC) + 8 + len(header)
+    start += -start % ALIGN
+    with open(name, 'wb') as f:
+        f.write(FROZEN_MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for key, array in arrays.items():
+            f.seek(start + layout[key]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+
+
+def read_frozen(name: str) -> Tuple[Dict[str, Any], Dict[str, np.ndarray]]:
+    with open(name, 'rb') as f:
+        magic = f.read(len(FROZEN_MAGIC))
+        assert magic == FROZEN_MAGIC, f"{name} is not a frozen index"
+        size = struct.unpack('<Q', f.read(8))[0]
+        meta = json.loads(f.read(size).decode('utf-8'))
+    start = len(FROZEN_MAGIC) + 8 + size
+    start += -start % ALIGN
+    raw = np.memmap(name, mode='r', dtype=np.uint8)
+    arrays = {}
+    for key, info in meta['layout'].items():
+        dtype = np.dtype(info['dtype'])
+        count = int(np.prod(info['shape'], dtype=np.int64))
+        offset = start + info['offset']
+        arrays[key] = raw[offset:offset + count * dtype.itemsize].view(dtype).reshape(info['shape'])
+    return meta['header'], arrays
+
+
+def merge_sorted(
+        hashes: np.ndarray,
+        values: np.ndarray,
+        new_hashes: np.ndarray,
+        new_values: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Merge sorted (hash, value) arrays in linear time, new entries go after equal old ones."""
+    if not len(new_hashes):
+        return hashes, values
+    at = np.searchsorted(hashes, new_hashes, side='right')
+    return np.insert(hashes, at, new_hashes), np.insert(values, at, new_values)
+
+
+def run_size(run: Run) -> int:
+    return sum(len(h) for h in run[0])
+
+
+def merge_runs(old: Run, new: Run) -> Run:
+    """Merge two runs band by band, entries of `new` go after equal ones of `old`."""
+    hashes, values = [], []
+    for h, v, new_h, new_v in zip(old[0], old[1], new[0], new[1]):
+        dtype = np.promote_types(v.dtype, new_v.dtype)
+        h, v = merge_sorted(h, v.astype(dtype, copy=False), new_h, new_v.astype(dtype, copy=False))
+        hashes.append(h)
+        values.append(v)
+    return hashes, values
+
+
+def _intern_rows(rows: Iterable[Tuple[int, int, Key]]) -> Exported:
+    """Group (band hash, band, key) rows into per band arrays with interned key ids."""
+    ids = {}
+    keys = []
+    bands = defaultdict(lambda: ([], []))
+    for h, band, value in rows:
+        idx = ids.get(value)
+        if idx is None:
+            idx = ids[value] = len(keys)
+            keys.append(value)
+        bands[band][0].append(h)
+        bands[band][1].append(idx)
+    n_bands = max(bands) + 1 if bands else 0
+    hashes = [np.array(bands[band][0], dtype=np.uint64) for band in range(n_bands)]
+    values = [np.array(bands[band][1], dtype=np.int64) for band in range(n_bands)]
+    return hashes, values, keys
+
+
+def sniff(file_name: str) -> Union[SQLData, PickleData, ArrayData, FrozenData]:
+    if os.path.exists(f"{file_name}.arrays.p"):
+        return ArrayData
     try:
-        SQL_STRING = "SQLite format 3\x00"
         with open(file_name, 'rb') as f:
-            header = f.read(16).decode('utf-8')
-        if header == SQL_STRING:
-            return SQLData
-    except UnicodeDecodeError:
-        pass
+            header = f.read(16)
+    except OSError:
+        return PickleData
+    if header == SQL_STRING:
+        return SQLData
+    if header.startswith(FROZEN_MAGIC):
+        return FrozenData
     return PickleData
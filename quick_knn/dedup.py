@@ -0,0 +1,124 @@
+from itertools import islice
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+import numpy as np
+from quick_knn.lsh import LSH
+from quick_knn.type_hints import Key
+
+# Default number of documents handled per micro-batch.
+BATCH = 4096
+
+
+def dedup(
+        docs: Iterable[Tuple[Key, Any]],
+        lsh: LSH,
+        hasher,
+        shingle: Optional[Callable]=None,
+        batch: int=BATCH,
+        processes: Optional[int]=None,
+        min_similarity: Optional[float]=None
+) -> Iterator[Tuple[Key, Optional[Key]]]:
+    """Near-duplicate detection over a stream of (doc id, document) pairs in one pass.
+
+    Documents are read in micro-batches of `batch`. Each batch is shingled
+    with `shingle` (None means the documents are already token sets), signed
+    with `hasher.signature_batch`, checked against the documents kept so far
+    and against the earlier documents of its own batch, and the documents
+    that aren't duplicates are inserted into `lsh`. Only one batch of
+    documents is held at a time.
+
+    With `processes` shingling and signing run in a process pool, a couple of
+    batches per worker are signed ahead of the one being matched. `shingle`
+    and `hasher` must be picklable.
+
+    With `min_similarity` candidates are verified against stored signatures
+    (this requires `store_signatures`) and the most similar one is reported.
+    Otherwise the first kept colliding document is. Ties go to the document
+    kept first (the one with the lowest id in the backend, see
+    `Data.key_ids`), documents that were in `lsh` before the stream started
+    count as kept before it. No per document state is kept outside `lsh`.
+
+    :returns: (doc id, id of the kept document it duplicates or None) for
+        every document, in stream order.
+    """
+    docs = iter(docs)
+    batches = iter(lambda: list(islice(docs, batch)), [])
+    if processes is None or processes <= 1:
+        for items in batches:
+            ids = [doc_id for doc_id, _ in items]
+            yield from _match(lsh, ids, _sign(hasher, shingle, [doc for _, doc in items]), min_similarity)
+        return
+    with ProcessPoolExecutor(processes) as pool:
+        # Keep a bounded number of batches in flight.
+        window = 2 * processes
+        in_flight = deque()
+        for items in batches:
+            in_flight.append(([doc_id for doc_id, _ in items], pool.submit(_sign, hasher, shingle, [doc for _, doc in items])))
+            while len(in_flight) >= window:
+                ids, future = in_flight.popleft()
+                yield from _match(lsh, ids, future.result(), min_similarity)
+        while in_flight:
+            ids, future = in_flight.popleft()
+            yield from _match(lsh, ids, future.result(), min_similarity)
+
+
+def _sign(hasher, shingle: Optional[Callable], docs: List[Any]) -> np.ndarray:
+    if shingle is not None:
+        docs = [shingle(doc) for doc in docs]
+    return hasher.signature_batch(docs)
+
+
+def _match(
+        lsh: LSH,
+        ids: List[Key],
+        sigs: np.ndarray,
+        min_similarity: Optional[float]
+) -> List[Tuple[Key, Optional[Key]]]:
+    """Find the duplicate of each signature in a batch and insert the rest."""
+    hashes = lsh.band_hashes(sigs)
+    # Queried through the LSH so the lookups take its read lock, are counted
+    # in its metrics and include split buckets.
+    found = lsh.query_many(sigs, min_similarity=min_similarity, hashes=hashes)
+    # (band, band hash) -> rows kept earlier in this batch.
+    seen = {}
+    keep = []
+    results = []
+    for row, (doc_id, cands, row_hashes) in enumerate(zip(ids, found, hashes.tolist())):
+        dup = _first(lsh, cands, min_similarity is not None)
+        if dup is None:
+            rows = sorted({r for band, h in enumerate(row_hashes) for r in seen.get((band, h), ())})
+            best = _best_row(lsh, sigs[row], rows, min_similarity, sigs)
+            dup = None if best is None else ids[best]
+        if dup is None:
+            keep.append(row)
+            for band, h in enumerate(row_hashes):
+                seen.setdefault((band, h), []).append(row)
+        results.append((doc_id, dup))
+    if keep:
+        lsh.insert_many([ids[row] for row in keep], sigs[keep])
+    return results
+
+
+def _first(lsh: LSH, cands: List, scored: bool) -> Optional[Key]:
+    """The candidate kept first, of the most similar ones when they are (key, score) pairs sorted by score."""
+    if not cands:
+        return None
+    if scored:
+        top = cands[0][1]
+        cands = [key for key, score in cands if score == top]
+    cands = list(cands)
+    # Candidates come out of the index, so each one has an id.
+    ids = lsh.data.key_ids(cands)
+    return cands[int(np.argmin(ids))]
+
+
+def _best_row(lsh: LSH, sig: np.ndarray, rows: List[int], min_similarity: Optional[float], sigs: np.ndarray) -> Optional[int]:
+    """The earliest of the most similar rows of the batch."""
+    if not rows:
+        return None
+    if min_similarity is None:
+        return rows[0]
+    scores = lsh.similarity(sig, sigs[rows])
+    best = int(np.argmax(scores))
+    return rows[best] if scores[best] >= min_similarity else None
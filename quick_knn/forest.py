@@ -0,0 +1,164 @@
+from typing import Iterable, List, Optional
+import numpy as np
+from quick_knn.data import RUN_RATIO, Run, run_size
+from quick_knn.lsh import opt_r
+from quick_knn.random_hyperplane import unpack_bits
+from quick_knn.type_hints import Signature, Key
+
+
+class LSHForest(object):
+    """LSH Forest, one index that can be queried at any threshold.
+
+    The signature is split into `trees` prefix trees of `depth = bits // trees`
+    lanes each. Every tree keeps its lanes sorted lexicographically so the
+    items sharing a prefix of any length r <= depth are a contiguous range that
+    is found with a binary search per lane. At query time r is picked for the
+    requested threshold with b fixed to `trees` (see `opt_r`).
+
+    Like `ArrayData` the trees are kept as sorted runs, inserts are buffered
+    and sorted into a new run on the next query and small runs are merged
+    into bigger ones (see `_merge`), so mixing inserts and queries never
+    re-sorts the whole forest.
+
+    https://dl.acm.org/doi/10.1145/1060745.1060840
+    """
+
+    def __init__(
+            self,
+            bits: int=32,
+            trees: int=8,
+            threshold: float=0.51,
+            fp_weight: float=0.5,
+            packed: bool=False
+    ):
+        super().__init__()
+        assert bits >= trees, f"There must be at least one bit per tree, got {bits} bits and {trees} trees"
+        assert threshold <= 1.0 and threshold >= 0.0, f"threshold must be in [0.0, 1.0], got {threshold}"
+        assert fp_weight <= 1.0 and fp_weight >= 0.0, f"fp_weight must be in [0.0, 1.0], got {fp_weight}"
+        self.bits = bits
+        self.trees = trees
+        self.depth = bits // trees
+        self.threshold = threshold
+        self.fp_weight = fp_weight
+        self.fn_weight = 1.0 - fp_weight
+        # Signatures are bit-packed np.uint64 words from `RandomHyperplanes(packed=True)`
+        self.packed = packed
+        self.ids = {}
+        self.keys = []
+        # Each run holds every tree's lanes sorted and the matching ids.
+        self.runs = []
+        self.pending = []
+        self.r_cache = {}
+
+    def __repr__(self):
+        return (
+            f"LSHForest(bits={self.bits}, trees={self.trees}, depth={self.depth}, "
+            f"threshold={self.threshold}, fp_weight={self.fp_weight:.2})"
+        )
+
+    def _unpack(self, sigs: np.ndarray) -> np.ndarray:
+        sigs = np.atleast_2d(sigs)
+        if self.packed:
+            sigs = unpack_bits(sigs, self.bits)
+        return sigs
+
+    def insert(self, key: Key, sig: Signature) -> None:
+        self.insert_many([key], sig)
+
+    def insert_many(self, keys: Iterable[Key], sigs: np.ndarray) -> None:
+        """Insert the rows of a (n x bits) signature matrix under their keys."""
+        ids = []
+        for key in keys:
+            idx = self.ids.get(key)
+            if idx is None:
+                idx = self.ids[key] = len(self.keys)
+                self.keys.append(key)
+            ids.append(idx)
+        self.pending.append((self._unpack(sigs), np.array(ids, dtype=np.int64)))
+
+    def _merge(self) -> None:
+        """Sort buffered inserts into a new run and merge runs, see `ArrayData._merge`."""
+        if not self.pending:
+            return
+        sigs = np.concatenate([s for s, _ in self.pending])
+        ids = np.concatenate([i for _, i in self.pending])
+        run = ([], [])
+        for tree in range(self.trees):
+            start = tree * self.depth
+            lanes = sigs[:, start:start + self.depth]
+            # lexsort uses the last key as the primary one.
+            order = np.lexsort(lanes.T[::-1])
+            run[0].append(np.ascontiguousarray(lanes[order]))
+            run[1].append(ids[order])
+        self.runs.append(run)
+        while len(self.runs) > 1 and run_size(self.runs[-2]) < RUN_RATIO * run_size(self.runs[-1]):
+            self.runs[-2:] = [merge_trees(self.runs[-2], self.runs[-1])]
+        self.pending = []
+
+    def r_for(self, threshold: float) -> int:
+        """The prefix length used to answer queries at this threshold."""
+        r = self.r_cache.get(threshold)
+        if r is None:
+            r = self.r_cache[threshold] = opt_r(threshold, self.trees, self.depth, self.fp_weight, self.fn_weight)
+        return r
+
+    def _prefix(self, tree: int, query: np.ndarray, r: int) -> np.ndarray:
+        """Ids of the items that share the first r lanes of the query in a tree."""
+        found = []
+        for lanes, values in self.runs:
+            lanes = lanes[tree]
+            lo, hi = 0, len(lanes)
+            for j in range(r):
+                col = lanes[lo:hi, j]
+                lo, hi = lo + np.searchsorted(col, query[j], side='left'), lo + np.searchsorted(col, query[j], side='right')
+                if lo == hi:
+                    break
+            found.append(values[tree][lo:hi])
+        return np.concatenate(found)
+
+    def query(self, sig: Signature, threshold: Optional[float]=None, r: Optional[int]=None) -> List[Key]:
+        """Find the keys that share a prefix of length r with `sig` in any tree.
+
+        :param threshold: Pick r for this similarity, defaults to `self.threshold`.
+        :param r: Use this prefix length directly.
+        """
+        return self.query_many(sig, threshold, r)[0]
+
+    def query_many(
+            self,
+            sigs: np.ndarray,
+            threshold: Optional[float]=None,
+            r: Optional[int]=None
+    ) -> List[List[Key]]:
+        """Query with each row of a (n x bits) signature matrix, results are per row."""
+        self._merge()
+        sigs = self._unpack(sigs)
+        if not self.runs:
+            return [[] for _ in sigs]
+        if r is None:
+            r = self.r_for(self.threshold if threshold is None else threshold)
+        assert 1 <= r <= self.depth, f"r must be in [1, {self.depth}], got {r}"
+        results = []
+        for sig in sigs:
+            cands = set()
+            for tree in range(self.trees):
+                start = tree * self.depth
+                cands.update(self._prefix(tree, sig[start:start + self.depth], r).tolist())
+            results.append([self.keys[i] for i in cands])
+        return results
+
+
+def lane_keys(lanes: np.ndarray) -> np.ndarray:
+    """One byte string per row that sorts like the row's (unsigned) lanes do lexicographically."""
+    big = np.ascontiguousarray(lanes, dtype=lanes.dtype.newbyteorder('>'))
+    return big.view(f'V{big.shape[1] * big.itemsize}').ravel()
+
+
+def merge_trees(old: Run, new: Run) -> Run:
+    """Merge two runs tree by tree in linear time, rows of `new` go after equal rows of `old`."""
+    lanes, values = [], []
+    for l, v, new_l, new_v in zip(old[0], old[1], new[0], new[1]):
+        at = np.searchsorted(lane_keys(l), lane_keys(new_l), side='right')
+        lanes.append(np.insert(l, at, new_l, axis=0))
+        values.append(np.insert(v, at, new_v))
+    return lanes, values
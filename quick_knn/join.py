@@ -0,0 +1,97 @@
+from typing import Iterator, List, Tuple
+import numpy as np
+
+# Default number of candidate pairs generated at a time by a self-join.
+CHUNK_PAIRS = 1 << 20
+
+
+def bucket_pairs(
+        hashes: np.ndarray,
+        ids: np.ndarray,
+        chunk: int=CHUNK_PAIRS
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Every pair of ids that share a bucket in one band, in chunks.
+
+    Entries are sorted by (hash, id) so each pair comes out once with the
+    smaller id first. The pairs of one id are never split, so a chunk can go
+    over `chunk` by at most the size of the largest bucket.
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    ids = np.asarray(ids, dtype=np.int64)
+    order = np.lexsort((ids, hashes))
+    hashes, ids = hashes[order], ids[order]
+    keep = np.ones(len(ids), dtype=bool)
+    keep[1:] = (hashes[1:] != hashes[:-1]) | (ids[1:] != ids[:-1])
+    hashes, ids = hashes[keep], ids[keep]
+    if len(ids) < 2:
+        return
+    starts = np.flatnonzero(np.concatenate([[True], hashes[1:] != hashes[:-1]]))
+    ends = np.append(starts[1:], len(ids))
+    # Each entry is paired with the entries after it in its bucket.
+    counts = np.repeat(ends, ends - starts) - np.arange(len(ids)) - 1
+    pos = np.flatnonzero(counts)
+    if len(pos) == 0:
+        return
+    counts = counts[pos]
+    total = np.cumsum(counts)
+    cuts = np.searchsorted(total, np.arange(chunk, total[-1], chunk)) + 1
+    bounds = np.unique(np.concatenate([[0], cuts, [len(pos)]]))
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        c = counts[lo:hi]
+        left = np.repeat(pos[lo:hi], c)
+        right = left + 1 + np.arange(c.sum()) - np.repeat(np.cumsum(c) - c, c)
+        yield ids[left], ids[right]
+
+
+def band_matrix(hashes: List[np.ndarray], ids: List[np.ndarray], n: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Scatter exported band tables into a (b x n) matrix of each id's band hashes.
+
+    :returns: The hashes and a mask of which (band, id) cells are filled.
+    """
+    matrix = np.zeros((len(hashes), n), dtype=np.uint64)
+    present = np.zeros((len(hashes), n), dtype=bool)
+    for band, (h, i) in enumerate(zip(hashes, ids)):
+        i = np.asarray(i, dtype=np.int64)
+        matrix[band, i] = h
+        present[band, i] = True
+    return matrix, present
+
+
+def first_band(a: np.ndarray, b: np.ndarray, band: int, matrix: np.ndarray, present: np.ndarray) -> np.ndarray:
+    """Mask of the pairs that don't share a bucket in any band before `band`.
+
+    A pair is only kept by the first band it collides in so it is emitted once.
+    """
+    seen = np.zeros(len(a), dtype=bool)
+    for earlier in range(band):
+        seen |= (matrix[earlier, a] == matrix[earlier, b]) & present[earlier, a] & present[earlier, b]
+    return ~seen
+
+
+def roots(parent: np.ndarray) -> np.ndarray:
+    """Point every node of a union-find forest directly at its root, in place."""
+    while True:
+        grand = parent[parent]
+        if np.array_equal(grand, parent):
+            return parent
+        parent[:] = grand
+
+
+def union(parent: np.ndarray, a: np.ndarray, b: np.ndarray) -> None:
+    """Merge the sets of each pair (a[i], b[i]), the smallest id becomes the root."""
+    while len(a):
+        roots(parent)
+        ra, rb = parent[a], parent[b]
+        differ = ra != rb
+        a, b, ra, rb = a[differ], b[differ], ra[differ], rb[differ]
+        np.minimum.at(parent, np.maximum(ra, rb), np.minimum(ra, rb))
+
+
+def components(parent: np.ndarray) -> List[np.ndarray]:
+    """The ids in each set with more than one member, ordered by their smallest id."""
+    roots(parent)
+    order = np.argsort(parent, kind='stable')
+    labels = parent[order]
+    starts = np.flatnonzero(np.concatenate([[True], labels[1:] != labels[:-1]]))
+    ends = np.append(starts[1:], len(labels))
+    return [order[start:end] for start, end in zip(starts, ends) if end - start > 1]
@@ -0,0 +1,84 @@
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+
+class RWLock(object):
+    """A readers-writer lock, any number of readers or a single writer.
+
+    Waiting writers block new readers so a steady stream of queries can't
+    starve inserts. Both sides are reentrant: a thread that holds the lock
+    can take it again for reading, and the writer can take it again for
+    writing, so locked methods can call each other. A reader can't upgrade
+    to a writer.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = None
+        self.depth = 0
+        self.waiting = 0
+        self.local = threading.local()
+
+    @contextmanager
+    def read(self):
+        held = getattr(self.local, 'reads', 0)
+        me = threading.get_ident()
+        with self.cond:
+            if not held and self.writer != me:
+                while self.writer is not None or self.waiting:
+                    self.cond.wait()
+            self.readers += 1
+        self.local.reads = held + 1
+        try:
+            yield
+        finally:
+            self.local.reads = held
+            with self.cond:
+                self.readers -= 1
+                if not self.readers:
+                    self.cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        with self.cond:
+            if self.writer == me:
+                self.depth += 1
+            else:
+                assert not getattr(self.local, 'reads', 0), "Can't take the write lock while holding the read lock"
+                self.waiting += 1
+                try:
+                    while self.writer is not None or self.readers:
+                        self.cond.wait()
+                finally:
+                    self.waiting -= 1
+                self.writer = me
+                self.depth = 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.depth -= 1
+                if not self.depth:
+                    self.writer = None
+                    self.cond.notify_all()
+
+
+def read_locked(method):
+    """Run a method while holding `self.lock` for reading."""
+    @wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.lock.read():
+            return method(self, *args, **kwargs)
+    return locked
+
+
+def write_locked(method):
+    """Run a method while holding `self.lock` for writing."""
+    @wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.lock.write():
+            return method(self, *args, **kwargs)
+    return locked
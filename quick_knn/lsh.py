@@ -1,10 +1,27 @@
-from functools import partial
-from typing import Tuple, List
-from collections import defaultdict
+import os
+from functools import partial, lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import combinations
+from typing import Any, Dict, Tuple, List, Iterable, Iterator, Optional, Set
+from collections import defaultdict, deque, namedtuple
 import numpy as np
-from quick_knn.data import SQLData, PickleData, sniff
+from quick_knn.data import SQLData, PickleData, ArrayData, FrozenData, sniff, to_keys, unsort_bands
+from quick_knn.random_hyperplane import pack_bits, unpack_bits, mix64, cosine
+from quick_knn.min_hash import WIDTHS, jaccard
+from quick_knn.join import CHUNK_PAIRS, bucket_pairs, band_matrix, first_band, union, components
+from quick_knn.metrics import Metrics, Callback, NULL_STAGE
+from quick_knn.locks import RWLock, read_locked, write_locked
 from quick_knn.type_hints import Signature, Integrable, Key, Vector
 
+# Default number of signatures per shard in `LSH.insert_parallel`.
+CHUNK_ROWS = 1 << 16
+# Number of (b, r) pairs `optimize` scores exactly after screening them all.
+CANDIDATES = 16
+# Number of buckets per band listed by `LSH.stats`.
+LARGEST = 5
+# What happens to new entries for a band bucket that is already at `LSH.bucket_cap`.
+CAP_POLICIES = ("stop", "reservoir", "split")
+
 
 def integrate(func: Integrable, a: float, b: float, dt: float=0.001) -> float:
     """Midpoint Riemann Sum Integration."""
@@ -27,6 +44,9 @@ def fn_prob(b: Vector, r: Vector, s: float) -> Vector:
     # As above (1 - s^r)^b is the probability of having a mismatch in each band.
     return (1 - s ** r) ** b
 
+Params = namedtuple('Params', 'b r fp_rate fn_rate error')
+
+
 def opt_b_r(thresh: float, bits: int, fp_weight: float, fn_weight: float) -> Tuple[int, int]:
     """Find optimal values for b and r.
 
@@ -35,37 +55,278 @@ def opt_b_r(thresh: float, bits: int, fp_weight: float, fn_weight: float) -> Tup
         * The similarity threshold
         * User weighting for false positives and negatives.
     """
-    bs = []
-    rs = []
+    params = optimize(thresh, bits, fp_weight, fn_weight)
+    return params.b, params.r
+
+
+@lru_cache(maxsize=None)
+def optimize(thresh: float, bits: int, fp_weight: float=0.5, fn_weight: Optional[float]=None) -> Params:
+    """Find the optimal b and r and report how well they do.
+
+    `fp_rate` is the average probability that a pair with similarity below the
+    threshold shares a band (a false positive) and `fn_rate` is the average
+    probability that a pair above the threshold doesn't (a false negative).
+    Results are cached.
+    """
+    if fn_weight is None:
+        fn_weight = 1.0 - fp_weight
     # Enumerate all legal b and r combinations.
-    for b in range(bits):
-        max_r = bits // (b + 1)
-        for r in range(max_r):
-            bs.append(b + 1)
-            rs.append(r + 1)
-    bs = np.array(bs)
-    rs = np.array(rs)
-    # Calculate the probability of false positives.
-    fp = partial(fp_prob, bs, rs)
-    # Integrate from 0 to thresh to calculate the probability of a set with less
-    # than the threshold will match in some bucket.
-    fp = integrate(fp, 0.0, thresh)
-    # Calculate the probability of false positives.
-    fn = partial(fn_prob, bs, rs)
-    # Integrate from thresh to 1 to calculate the probability of a set with a
-    # score greater than the threshold will not match in any bucket.
-    fn = integrate(fn, thresh, 1.0)
+    counts = bits // np.arange(1, bits + 1)
+    bs = np.repeat(np.arange(1, bits + 1), counts)
+    rs = np.concatenate([np.arange(1, count + 1) for count in counts])
+    # Screen every pair with cheap Gauss-Legendre quadrature, then score the
+    # best few with the same midpoint sum as `integrate` so the pick matches it.
+    fp, fn = error_areas(bs, rs, thresh, gauss_legendre)
+    top = np.sort(np.argsort(fp * fp_weight + fn * fn_weight, kind='stable')[:CANDIDATES])
+    fp, fn = error_areas(bs[top], rs[top], thresh)
     # Scale errors by user weighting
     error = fp * fp_weight + fn * fn_weight
     # Pick b and r that minimize the error
     idx = np.argmin(error)
-    return bs[idx], rs[idx]
+    fp_rate = fp[idx] / thresh if thresh > 0 else 0.0
+    fn_rate = fn[idx] / (1.0 - thresh) if thresh < 1 else 0.0
+    return Params(int(bs[top][idx]), int(rs[top][idx]), float(fp_rate), float(fn_rate), float(error[idx]))
+
+
+def opt_r(thresh: float, b: int, max_r: int, fp_weight: float, fn_weight: float) -> int:
+    """Find the optimal r for a fixed number of bands b, used by `LSHForest` at query time."""
+    rs = np.arange(1, max_r + 1)
+    error = weighted_error(np.full(len(rs), b), rs, thresh, fp_weight, fn_weight)
+    return int(rs[np.argmin(error)])
+
+
+def weighted_error(bs: Vector, rs: Vector, thresh: float, fp_weight: float, fn_weight: float) -> Vector:
+    """The weighted false positive and false negative areas for each (b, r) pair."""
+    fp, fn = error_areas(bs, rs, thresh)
+    # Scale errors by user weighting
+    return fp * fp_weight + fn * fn_weight
+
+
+def error_areas(bs: Vector, rs: Vector, thresh: float, quadrature=None) -> Tuple[Vector, Vector]:
+    """The false positive and false negative areas for each (b, r) pair.
+
+    :param quadrature: How to integrate, defaults to `integrate_grid`.
+    """
+    if quadrature is None:
+        quadrature = integrate_grid
+    # Integrate from 0 to thresh to calculate the probability of a set with less
+    # than the threshold will match in some bucket.
+    fp = quadrature(partial(fp_prob, bs, rs), 0.0, thresh)
+    # Integrate from thresh to 1 to calculate the probability of a set with a
+    # score greater than the threshold will not match in any bucket.
+    fn = quadrature(partial(fn_prob, bs, rs), thresh, 1.0)
+    return fp, fn
+
+
+def midpoints(a: float, b: float, dt: float=0.001) -> np.ndarray:
+    """The points `integrate` samples, generated the same way so the sums match."""
+    points = []
+    while a < b:
+        points.append(a + 0.5 * dt)
+        a += dt
+    return np.array(points)
+
+
+def integrate_grid(func: Integrable, a: float, b: float, dt: float=0.001, chunk: int=64) -> Vector:
+    """Vectorized `integrate`, `func` is evaluated on a (samples x outputs) grid `chunk` samples at a time.
+
+    Reducing over the first axis adds the rows in order, with the running area
+    as the first row, so the result is the same as `integrate`'s loop.
+    """
+    points = midpoints(a, b, dt)[:, np.newaxis]
+    area = 0.0
+    for start in range(0, len(points), chunk):
+        terms = func(points[start:start + chunk]) * dt
+        area = np.sum(np.concatenate([np.broadcast_to(area, terms.shape[1:])[np.newaxis], terms]), axis=0)
+    return area
+
+
+def gauss_legendre(func: Integrable, a: float, b: float, panels: int=16, nodes: int=8) -> Vector:
+    """Composite Gauss-Legendre quadrature, `func` is evaluated on a (samples x outputs) grid."""
+    x, w = np.polynomial.legendre.leggauss(nodes)
+    edges = np.linspace(a, b, panels + 1)
+    half = (edges[1:] - edges[:-1]) / 2
+    mid = (edges[1:] + edges[:-1]) / 2
+    points = (mid[:, np.newaxis] + half[:, np.newaxis] * x).ravel()
+    weights = (half[:, np.newaxis] * w).ravel()
+    return weights @ func(points[:, np.newaxis])
+
+
+def row_words(rows: np.ndarray) -> np.ndarray:
+    """The bytes of each row (the last axis) as zero padded little endian np.uint64 words."""
+    rows = np.ascontiguousarray(rows)
+    raw = rows.view(np.uint8).reshape(rows.shape[:-1] + (-1,))
+    pad = -raw.shape[-1] % 8
+    if pad:
+        raw = np.concatenate([raw, np.zeros(raw.shape[:-1] + (pad,), dtype=np.uint8)], axis=-1)
+    return raw.view('<u8')
+
+
+def fold_words(words: np.ndarray, seeds: np.ndarray) -> np.ndarray:
+    """Hash the last axis of an (n x b x words) np.uint64 array, band j is seeded with `seeds[j]`.
+
+    Each word is tagged with its band's seed and its position, mixed, and the
+    mixes are summed, so all the words of all the bands go through one `mix64`
+    call instead of one call per word.
+    """
+    seeds = np.left_shift(np.asarray(seeds, dtype=np.uint64), np.uint64(32))[:, np.newaxis]
+    tags = seeds + np.arange(words.shape[-1], dtype=np.uint64)
+    return mix64(mix64(words ^ tags).sum(axis=-1, dtype=np.uint64))
+
+
+def hash_rows(rows: np.ndarray, seed: int=0) -> np.ndarray:
+    """Reduce each row of a 2D array to a 64 bit hash of its bytes."""
+    return fold_words(row_words(rows)[:, np.newaxis], [seed])[:, 0]
+
+
+def bit_fields(sigs: np.ndarray, starts: np.ndarray, length: int) -> np.ndarray:
+    """Read bits [start, start + length) of each row for every start, the rows are little endian bit strings.
+
+    Each field is cut out of the row's 64 bit words with a shift and a mask,
+    so nothing is unpacked to one byte per bit.
+
+    :returns: An (n x len(starts) x words) np.uint64 array, each field zero padded to whole words.
+    """
+    raw = np.ascontiguousarray(sigs).view(np.uint8).reshape(len(sigs), -1)
+    pad = -raw.shape[1] % 8
+    if pad:
+        raw = np.concatenate([raw, np.zeros((len(raw), pad), dtype=np.uint8)], axis=1)
+    words = raw.view('<u8')
+    offsets = np.asarray(starts, dtype=np.int64)[:, np.newaxis] + np.arange(0, length, 64)
+    first = offsets // 64
+    # The word after a field's last word may be past the end of the row, those bits are masked off below.
+    second = np.minimum(first + 1, words.shape[1] - 1)
+    shift = (offsets % 64).astype(np.uint64)
+    # Shifting left by 1 then by 63 - shift keeps a shift of 0 from moving in the whole next word.
+    fields = np.right_shift(words[:, first], shift) | np.left_shift(
+        np.left_shift(words[:, second], np.uint64(1)), np.uint64(63) - shift
+    )
+    if length % 64:
+        fields[:, :, -1] &= np.uint64((1 << (length % 64)) - 1)
+    return fields
+
+
+def band_hashes(
+        sigs: np.ndarray,
+        ranges: List[Tuple[int, int]],
+        packed: bool=False,
+        width: int=64,
+        bands: Optional[List[int]]=None
+) -> np.ndarray:
+    """Hash each band (given by `ranges`) of each row of a signature matrix, see `LSH.band_hashes`.
+
+    Bands must all have the same width. Band i is seeded with `bands[i]`,
+    which defaults to i. Unpacked signatures hash the same as
+    `hash_rows(sigs[:, start:end], seed=i)`. For packed bit signatures
+    `ranges` count bits and for b-bit signatures (`width` < 8) they count
+    lanes, each band hashes its bits read straight from the packed words
+    (see `bit_fields`).
+    """
+    sigs = np.atleast_2d(sigs)
+    size = ranges[0][1] - ranges[0][0]
+    assert all(end - start == size for start, end in ranges), "bands must all have the same width"
+    starts = np.array([start for start, _ in ranges])
+    seeds = np.arange(len(ranges)) if bands is None else bands
+    if packed or width < 8:
+        unit = 1 if packed else width
+        return fold_words(bit_fields(sigs, starts * unit, size * unit), seeds)
+    cells = sigs[:, starts[:, np.newaxis] + np.arange(size)]
+    return fold_words(row_words(cells), seeds)
+
+
+def sorted_bands(
+        sigs: np.ndarray,
+        ranges: List[Tuple[int, int]],
+        bands: List[int],
+        packed: bool=False,
+        width: int=64
+) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """Hash some bands of a block of signature columns and sort each one, used by `LSH.insert_parallel`.
+
+    :param ranges: The columns (bits or lanes for packed signatures) of each band within `sigs`.
+    :param bands: The index of each band, it seeds its hash like in `band_hashes`.
+    :param packed: The columns are packed bit words.
+    :param width: The `MinHash` width of the signatures.
+    :returns: For each band its hashes sorted and the row of each hash.
+    """
+    hashes = band_hashes(sigs, ranges, packed, width, bands)
+    tables = []
+    for column in hashes.T:
+        order = np.argsort(column, kind='stable')
+        tables.append((column[order], order))
+    return tables
+
+
+class Candidates(list):
+    """Query results, a list that also says if a limit was hit.
+
+    `truncated` is set when `max_candidates` stopped the query before every
+    band was looked up. `capped` is set when one of the query's buckets is
+    full (see `LSH` `bucket_cap`) so some items in it weren't kept.
+    """
+
+    def __init__(self, items: Iterable=(), truncated: bool=False, capped: bool=False):
+        super().__init__(items)
+        self.truncated = truncated
+        self.capped = capped
+
+
+def split_hash(hashes: np.ndarray, extra: np.ndarray) -> np.ndarray:
+    """The sub-bucket for entries of a full bucket, keyed by the band hash and the next band's hash."""
+    return mix64(np.asarray(hashes, dtype=np.uint64) ^ mix64(np.asarray(extra, dtype=np.uint64)))
+
+
+def ranks(bands: np.ndarray, hashes: np.ndarray) -> np.ndarray:
+    """How many earlier cells have the same (band, hash), for each cell."""
+    position = np.arange(len(hashes))
+    order = np.lexsort((position, hashes, bands))
+    b, h = bands[order], hashes[order]
+    starts = np.concatenate([[True], (b[1:] != b[:-1]) | (h[1:] != h[:-1])])
+    group_start = np.maximum.accumulate(np.where(starts, position, 0))
+    rank = np.empty(len(hashes), dtype=np.int64)
+    rank[order] = position - group_start
+    return rank
 
 
 class LSH(object):
-    """Banding based LSH as described in http://www.mmds.org/"""
+    """Banding based LSH as described in http://www.mmds.org/
 
-    def __init__(self, threshold: float=0.51, bits: int=32, fp_weight: float=0.5, name="lsh", t="pickle"):
+    `bucket_cap` limits the number of entries in each band bucket, so a few
+    huge buckets (e.g. from near empty documents) don't make every query
+    that touches them slow. Once a bucket is full `cap_policy` decides what
+    happens to new entries: "stop" drops them, "reservoir" keeps a uniform
+    sample of everything offered to the bucket, and "split" puts them in a
+    sub-bucket that is also keyed by the next band's hash (that sub-bucket
+    is capped with "stop"). Inserting with a cap looks up bucket sizes
+    first so it is slower. Full buckets are tracked in `self.full` with the
+    number of entries offered to them.
+
+    Threads: lookups (`query`, `query_many`, `rerank`, `stats`, `freeze` and
+    the table scan of `self_join`) hold `self.lock` for reading and never
+    change the index, so any number of them can run at once. Writes
+    (`insert`, `insert_many`, `insert_parallel`, `remove`, `update`,
+    `compact` and `save`) hold it for writing and run alone, see `RWLock`.
+    `query_many(..., workers=n)` queries batches of rows from a thread pool.
+    The SQLite backend (one reader connection per thread) and the NumPy
+    searches of the array and frozen backends release the GIL so batches
+    overlap, the pickle backend is plain Python and gains little. Changing
+    `self.data` directly bypasses the lock, and `LSHForest` has no locking.
+    """
+
+    def __init__(
+            self,
+            threshold: float=0.51,
+            bits: int=32,
+            fp_weight: float=0.5,
+            name="lsh",
+            t="pickle",
+            packed: bool=False,
+            in_memory: bool=True,
+            store_signatures: bool=False,
+            bucket_cap: Optional[int]=None,
+            cap_policy: str="stop",
+            width: int=64
+    ):
         super().__init__()
 
         assert threshold <= 1.0 and threshold >= 0.0, f"threshold must be in [0.0, 1.0], got {threshold}"
@@ -75,14 +336,52 @@ class LSH(object):
         assert fp_weight <= 1.0 and fp_weight >= 0.0, f"fp_weight must be in [0.0, 1.0], got {fp_weight}"
         self.fp_weight = fp_weight
         self.fn_weight = 1.0 - fp_weight
+        # Signatures are bit-packed np.uint64 words from `RandomHyperplanes(packed=True)`
+        self.packed = packed
+        # The `MinHash` width the signatures were made with, b-bit signatures are
+        # banded and scored lane by lane and `bits` is their number of lanes.
+        assert width in WIDTHS, f"width must be one of {WIDTHS}, got {width}"
+        self.width = width
+        # Keep every inserted signature so query results can be re-scored.
+        self.store_signatures = store_signatures
+        self.signatures = None
+        self.sig_rows = {}
+        self.n_sigs = 0
+        # Timings and counts for the insert and query stages, see `instrument`.
+        self.metrics = None
+        self.lock = RWLock()
+        assert bucket_cap is None or bucket_cap >= 1, f"bucket_cap must be at least 1, got {bucket_cap}"
+        assert cap_policy in CAP_POLICIES, f"cap_policy must be one of {CAP_POLICIES}, got {cap_policy}"
+        self.bucket_cap = bucket_cap
+        self.cap_policy = cap_policy
+        # (band, band hash) -> entries offered to a full bucket.
+        self.full = {}
 
         self.b, self.r = opt_b_r(threshold, bits, self.fp_weight, self.fn_weight)
 
         self.ranges = [(i * self.r, j * self.r) for i, j in zip(range(self.b), range(1, self.b + 1))]
         if t == "pickle":
             self.data = PickleData(name, self.b)
+        elif t == "array":
+            self.data = ArrayData(name, self.b)
         else:
-            self.data = SQLData(name, in_memory=True)
+            self.data = SQLData(name, in_memory=in_memory)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Metrics hold a lock and a user callback, they aren't saved with the index.
+        state['metrics'] = None
+        state['lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = RWLock()
+        self.__dict__.setdefault('metrics', None)
+        self.__dict__.setdefault('bucket_cap', None)
+        self.__dict__.setdefault('cap_policy', "stop")
+        self.__dict__.setdefault('full', {})
+        self.__dict__.setdefault('width', 64)
 
     def __repr__(self):
         return (
@@ -91,23 +390,567 @@ class LSH(object):
             f"b={self.b}, r={self.r})"
         )
 
+    def band_hashes(self, sigs: np.ndarray) -> np.ndarray:
+        """Reduce each band of each signature in a (n x bits) matrix to a 64 bit hash.
+
+        :returns: A (n x b) np.uint64 matrix.
+        """
+        return band_hashes(sigs, self.ranges, self.packed, self.width)
+
+    def bands(self, sig: Signature) -> List[bytes]:
+        """Split a signature into the byte keys for each band."""
+        return to_keys(self.band_hashes(sig)[0])
+
+    def instrument(self, callback: Optional[Callback]=None) -> Metrics:
+        """Start timing and counting the insert and query stages.
+
+        The stages are "insert.hash" and "insert.backend" (counting "items"),
+        and "query.hash", "query.get", "query.probe" (counting "queries" and
+        "candidates") and "query.rerank" (counting "candidates" and "results").
+        `callback(stage, seconds, counts)` is called after every stage.
+
+        :returns: The `Metrics`, also at `self.metrics`, see `Metrics.snapshot`.
+        """
+        self.metrics = Metrics(callback)
+        return self.metrics
+
+    def _stage(self, name: str):
+        if self.metrics is None:
+            return NULL_STAGE
+        return self.metrics.stage(name)
+
+    @write_locked
     def insert(self, key: Key, sig: Signature) -> None:
-        parts = [LSH.hashable(sig[start:end]) for start, end in self.ranges]
-        self.data.insert(parts, key)
+        if self.bucket_cap is not None:
+            self.insert_many([key], np.atleast_2d(sig))
+            return
+        with self._stage("insert.hash") as counts:
+            parts = self.bands(sig)
+            counts["items"] = 1
+        with self._stage("insert.backend") as counts:
+            self.data.insert(parts, key)
+            counts["items"] = 1
+        if self.store_signatures:
+            self._store([key], sig)
+
+    @write_locked
+    def insert_many(self, keys: Iterable[Key], sigs: np.ndarray) -> None:
+        """Insert the rows of a (n x bits) signature matrix under their keys."""
+        keys = list(keys)
+        with self._stage("insert.hash") as counts:
+            hashes = self.band_hashes(sigs)
+            counts["items"] = len(keys)
+        with self._stage("insert.backend") as counts:
+            self._insert_hashes(hashes, keys)
+            counts["items"] = len(keys)
+        if self.store_signatures:
+            self._store(keys, sigs)
+
+    def _insert_hashes(self, hashes: np.ndarray, keys: List[Key]) -> None:
+        """Insert a (n x b) band hash matrix, applying the bucket cap."""
+        if self.bucket_cap is None:
+            self.data.insert_many(hashes, keys)
+            return
+        n, b = hashes.shape
+        rows = np.repeat(np.arange(n), b)
+        bands = np.tile(np.arange(b), n)
+        cells = hashes.ravel().copy()
+        fits = self._fits(bands, cells)
+        over = np.flatnonzero(~fits)
+        if self.cap_policy == "split" and len(over):
+            self._offer(bands[over], cells[over])
+            cells[over] = split_hash(cells[over], hashes[rows[over], (bands[over] + 1) % b])
+            fits[over] = self._fits(bands[over], cells[over])
+            over = np.flatnonzero(~fits)
+        self.data.insert_bands(bands[fits], cells[fits], [keys[row] for row in rows[fits].tolist()])
+        if self.cap_policy == "reservoir":
+            self._sample(bands[over], cells[over], [keys[row] for row in rows[over].tolist()])
+        else:
+            self._offer(bands[over], cells[over])
+
+    def _fits(self, bands: np.ndarray, cells: np.ndarray) -> np.ndarray:
+        """Mask of the cells whose bucket still has room, counting earlier cells in the same call."""
+        return self.data.bucket_sizes(bands, cells) + ranks(bands, cells) < self.bucket_cap
+
+    def _offer(self, bands: np.ndarray, cells: np.ndarray) -> List[int]:
+        """Count entries offered to full buckets, returns the running count for each."""
+        seen = []
+        for key in zip(bands.tolist(), cells.tolist()):
+            self.full[key] = self.full.get(key, self.bucket_cap) + 1
+            seen.append(self.full[key])
+        return seen
+
+    def _sample(self, bands: np.ndarray, cells: np.ndarray, keys: List[Key]) -> None:
+        """Reservoir sampling, the n-th entry offered to a full bucket replaces a member with probability cap / n."""
+        seen = np.array(self._offer(bands, cells), dtype=np.uint64)
+        # Hash based draws so the index doesn't have to carry a random state.
+        draws = mix64(cells ^ mix64(np.left_shift(bands.astype(np.uint64), np.uint64(40)) ^ seen)) % np.maximum(seen, 1)
+        for i in np.flatnonzero(draws < self.bucket_cap).tolist():
+            band, h = bands[i:i + 1], cells[i:i + 1]
+            members = list(self.data.get_bands(band, h))
+            if members:
+                self.data.remove_bands(band, h, [members[int(draws[i]) % len(members)]])
+            self.data.insert_bands(band, h, [keys[i]])
+
+    @write_locked
+    def insert_parallel(
+            self,
+            keys: Iterable[Key],
+            sigs: np.ndarray,
+            processes: Optional[int]=None,
+            chunk: int=CHUNK_ROWS
+    ) -> None:
+        """Insert a large signature matrix using a process pool.
+
+        The bands are split into one group per worker. For every shard of
+        `chunk` rows each worker gets just the columns of its bands, hashes
+        them and returns each band's hashes sorted together with their rows
+        (see `sorted_bands`), so the parent only bulk loads ready made band
+        tables (see `Data.load_bands`). The array backend adds them as sorted
+        runs as they are, the pickle and SQLite backends still add every
+        entry in the parent. Two shards are in flight at a time and shards
+        are loaded in order, so the index ends up the same as inserting each
+        row with `insert`.
+        """
+        keys = list(keys)
+        processes = processes or os.cpu_count() or 1
+        groups = [group.tolist() for group in np.array_split(np.arange(self.b), min(processes, self.b))]
+        tasks = [self._band_columns(group) for group in groups]
+
+        def submit(pool, start):
+            shard = sigs[start:start + chunk]
+            return start, [
+                pool.submit(sorted_bands, shard[:, lo:hi], ranges, group, self.packed, self.width)
+                for group, (lo, hi, ranges) in zip(groups, tasks)
+            ]
+
+        starts = iter(range(0, len(keys), chunk))
+        with ProcessPoolExecutor(processes) as pool:
+            # Keep a bounded number of shards in flight.
+            in_flight = deque(submit(pool, start) for _, start in zip(range(2), starts))
+            while in_flight:
+                start, futures = in_flight.popleft()
+                tables = [table for future in futures for table in future.result()]
+                for start_next in starts:
+                    in_flight.append(submit(pool, start_next))
+                    break
+                with self._stage("insert.backend") as counts:
+                    shard_keys = keys[start:start + chunk]
+                    if self.bucket_cap is None:
+                        self.data.load_bands(tables, shard_keys)
+                    else:
+                        self._insert_hashes(unsort_bands(tables, len(shard_keys)), shard_keys)
+                    counts["items"] = len(shard_keys)
+        if self.store_signatures:
+            self._store(keys, sigs)
+
+    def _band_columns(self, bands: List[int]) -> Tuple[int, int, List[Tuple[int, int]]]:
+        """The signature columns a group of bands needs and their ranges within those columns."""
+        lo, hi = self.ranges[bands[0]][0], self.ranges[bands[-1]][1]
+        # Packed bits and b-bit lanes are sliced on whole columns (64 bit words and bytes).
+        per = 64 if self.packed else 8 // self.width if self.width < 8 else 1
+        first, last = lo // per, -(-hi // per)
+        ranges = [(start - first * per, end - first * per) for start, end in self.ranges[bands[0]:bands[-1] + 1]]
+        return first, last, ranges
+
+    def _store(self, keys: List[Key], sigs: np.ndarray) -> None:
+        """Copy signatures into `self.signatures`, which grows by doubling."""
+        sigs = np.atleast_2d(sigs)
+        rows = []
+        for key in keys:
+            row = self.sig_rows.get(key)
+            if row is None:
+                row = self.sig_rows[key] = self.n_sigs
+                self.n_sigs += 1
+            rows.append(row)
+        if self.signatures is None or len(self.signatures) < self.n_sigs:
+            size = max(16, self.n_sigs, 0 if self.signatures is None else 2 * len(self.signatures))
+            signatures = np.zeros((size, sigs.shape[1]), dtype=sigs.dtype)
+            if self.signatures is not None:
+                signatures[:len(self.signatures)] = self.signatures
+            self.signatures = signatures
+        self.signatures[rows] = sigs
 
-    def query(self, sig: Signature) -> List[Key]:
-        parts = [LSH.hashable(sig[start:end]) for start, end in self.ranges]
-        cands = self.data.get(parts)
-        return list(cands)
+    @write_locked
+    def remove(self, key: Key) -> None:
+        """Remove a key from the index.
+
+        With stored signatures its bucket entries are known and dropped right
+        away, otherwise the backend tombstones the key until `compact`.
+        """
+        hashes = None
+        row = self.sig_rows.pop(key, None)
+        # With a cap the key may live in a sub-bucket or not in every band, so leave it to the backend.
+        if row is not None and self.bucket_cap is None:
+            hashes = self.band_hashes(self.signatures[row])[0]
+        self.data.remove(key, hashes)
+
+    @write_locked
+    def update(self, key: Key, sig: Signature) -> None:
+        """Replace the signature stored under a key."""
+        self.remove(key)
+        self.insert(key, sig)
+
+    @write_locked
+    def compact(self) -> None:
+        """Drop the entries of removed keys from the backend and the stored signatures."""
+        self.data.compact()
+        if self.signatures is None:
+            return
+        keys = list(self.sig_rows)
+        rows = np.array([self.sig_rows[key] for key in keys], dtype=np.int64)
+        self.signatures = self.signatures[rows]
+        self.sig_rows = {key: i for i, key in enumerate(keys)}
+        self.n_sigs = len(keys)
+
+    def bulk_load(self, batch: int=10000):
+        """Context manager for loading many items, see `SQLData.bulk`.
+
+        With a `bucket_cap` every insert looks up bucket sizes, so the backend keeps its index.
+        """
+        return self.data.bulk(batch, keep_index=self.bucket_cap is not None)
+
+    def query(
+            self,
+            sig: Signature,
+            k: Optional[int]=None,
+            min_similarity: Optional[float]=None,
+            margins: Optional[np.ndarray]=None,
+            probes: int=1,
+            budget: Optional[int]=None,
+            max_candidates: Optional[int]=None
+    ) -> Candidates:
+        """Find the keys that share a band with `sig`.
+
+        When `k` or `min_similarity` is given the candidates are re-scored
+        against their stored signatures (this requires `store_signatures`),
+        the ones below `min_similarity` (defaults to the threshold) are
+        dropped, and the top `k` are returned as (key, score) pairs sorted by
+        score.
+
+        For bit signatures passing `margins` (from `RandomHyperplanes.signature(..., margins=True)`)
+        turns on multi-probe querying, see `probe_hashes` for `probes` and `budget`.
+
+        With `max_candidates` bands are looked up one at a time and the rest
+        are skipped once that many candidates were found. The results are
+        `Candidates`, which say whether that happened and whether any of the
+        query's buckets were full.
+        """
+        if margins is not None:
+            margins = np.atleast_2d(margins)
+        return self.query_many(np.atleast_2d(sig), k, min_similarity, margins, probes, budget, max_candidates)[0]
+
+    def query_many(
+            self,
+            sigs: np.ndarray,
+            k: Optional[int]=None,
+            min_similarity: Optional[float]=None,
+            margins: Optional[np.ndarray]=None,
+            probes: int=1,
+            budget: Optional[int]=None,
+            max_candidates: Optional[int]=None,
+            workers: Optional[int]=None,
+            *,
+            hashes: Optional[np.ndarray]=None
+    ) -> List[Candidates]:
+        """Query with each row of a (n x bits) signature matrix, results are per row.
+
+        With `workers` the rows are split into that many contiguous batches
+        that are queried from a thread pool, see the `LSH` notes on threads.
+        `hashes` are the band hashes of `sigs` (see `band_hashes`) when the
+        caller already has them, so they aren't computed again.
+        """
+        sigs = np.atleast_2d(sigs)
+        if workers is None or workers <= 1 or len(sigs) < 2:
+            return self._query_many(sigs, k, min_similarity, margins, probes, budget, max_candidates, hashes)
+        if margins is not None:
+            margins = np.atleast_2d(margins)
+        step = -(-len(sigs) // workers)
+
+        def batch(start):
+            part = None if margins is None else margins[start:start + step]
+            known = None if hashes is None else hashes[start:start + step]
+            return self._query_many(sigs[start:start + step], k, min_similarity, part, probes, budget, max_candidates, known)
+
+        # Each batch takes the read lock in its own thread, holding it here
+        # while waiting on them could deadlock with a waiting writer.
+        with ThreadPoolExecutor(workers) as pool:
+            return [res for results in pool.map(batch, range(0, len(sigs), step)) for res in results]
+
+    @read_locked
+    def _query_many(
+            self,
+            sigs: np.ndarray,
+            k: Optional[int],
+            min_similarity: Optional[float],
+            margins: Optional[np.ndarray],
+            probes: int,
+            budget: Optional[int],
+            max_candidates: Optional[int],
+            hashes: Optional[np.ndarray]=None
+    ) -> List[Candidates]:
+        """`query_many` for one batch, `hashes` are the band hashes of `sigs` if they are known."""
+        if hashes is None:
+            with self._stage("query.hash") as counts:
+                hashes = self.band_hashes(sigs)
+                counts["queries"] = len(sigs)
+        with self._stage("query.get") as counts:
+            if max_candidates is None:
+                results = self.data.get_many(hashes)
+                truncated = [False] * len(sigs)
+            else:
+                scans = [self._scan(row, max_candidates) for row in hashes]
+                results = [cands for cands, _ in scans]
+                truncated = [stopped for _, stopped in scans]
+            capped = [False] * len(sigs)
+            if self.full:
+                capped = [any((band, h) in self.full for band, h in enumerate(row)) for row in hashes.tolist()]
+                if self.cap_policy == "split" and max_candidates is None:
+                    for cands, row, hit in zip(results, hashes, capped):
+                        if hit:
+                            cands |= self.data.get_bands(*self._splits(row))
+            counts["queries"] = len(sigs)
+            counts["candidates"] = sum(len(cands) for cands in results)
+            counts["truncated"] = sum(truncated)
+        if margins is not None:
+            with self._stage("query.probe") as counts:
+                for cands, sig, margin in zip(results, sigs, np.atleast_2d(margins)):
+                    cands |= self.data.get_bands(*self.probe_hashes(sig, margin, probes, budget))
+                counts["queries"] = len(sigs)
+                counts["candidates"] = sum(len(cands) for cands in results)
+        if k is not None or min_similarity is not None:
+            results = [self.rerank(sig, cands, k, min_similarity) for sig, cands in zip(sigs, results)]
+        return [Candidates(res, stopped, hit) for res, stopped, hit in zip(results, truncated, capped)]
+
+    def _splits(self, row: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """The (bands, sub-bucket hashes) to also look up for a query's split buckets."""
+        bands = np.array([band for band, h in enumerate(row.tolist()) if (band, h) in self.full], dtype=np.int64)
+        return bands, split_hash(row[bands], row[(bands + 1) % len(row)])
+
+    def _scan(self, row: np.ndarray, max_candidates: int) -> Tuple[Set[Key], bool]:
+        """Look up one query's bands in order until there are `max_candidates` candidates."""
+        cands = set()
+        split = self.cap_policy == "split" and bool(self.full)
+        for band, h in enumerate(row.tolist()):
+            if len(cands) >= max_candidates:
+                return cands, True
+            bands = np.array([band])
+            hashes = row[band:band + 1]
+            if split and (band, h) in self.full:
+                bands = np.array([band, band])
+                hashes = np.concatenate([hashes, split_hash(hashes, row[(band + 1) % len(row):][:1])])
+            cands |= self.data.get_bands(bands, hashes)
+        return cands, False
+
+    def probe_hashes(
+            self,
+            sig: Signature,
+            margins: np.ndarray,
+            probes: int=1,
+            budget: Optional[int]=None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Band hashes of the buckets next to a bit signature's buckets.
+
+        In each band every set of 1 to `probes` bits is flipped. The perturbations
+        are ordered by the total margin of their flipped bits, smallest (most
+        likely to be a near neighbour's bucket) first, and only the first `budget`
+        across all bands are kept.
+
+        :returns: The band of each probe and its hash.
+        """
+        sig = np.atleast_2d(sig)
+        bits = unpack_bits(sig, self.bits)[0] if self.packed else sig[0]
+        margins = np.abs(np.asarray(margins, dtype=np.float64)).ravel()
+        perturbations = []
+        for band, (start, end) in enumerate(self.ranges):
+            for size in range(1, probes + 1):
+                for flips in combinations(range(start, end), size):
+                    perturbations.append((margins[list(flips)].sum(), band, flips))
+        perturbations.sort(key=lambda x: x[0])
+        perturbations = perturbations[:budget]
+        bands = np.array([band for _, band, _ in perturbations], dtype=np.int64)
+        hashes = np.empty(len(perturbations), dtype=np.uint64)
+        for band, (start, end) in enumerate(self.ranges):
+            idx = np.flatnonzero(bands == band)
+            if not len(idx):
+                continue
+            slices = np.tile(bits[start:end], (len(idx), 1))
+            for row, i in enumerate(idx):
+                cols = np.array(perturbations[i][2]) - start
+                slices[row, cols] = 1 - slices[row, cols]
+            if self.packed:
+                hashes[idx] = fold_words(pack_bits(slices)[:, np.newaxis], [band])[:, 0]
+            else:
+                hashes[idx] = hash_rows(slices, seed=band)
+        return bands, hashes
+
+    def similarity(self, sig: Signature, sigs: np.ndarray) -> np.ndarray:
+        """Estimated similarity between a signature and each row of a matrix of signatures.
+
+        Two matrices of the same shape are compared row by row. MinHash
+        signatures are scored with `jaccard` at `self.width`.
+        """
+        if self.packed:
+            return cosine(sig, sigs, self.bits)
+        return jaccard(sig, sigs, self.width)
+
+    @read_locked
+    def rerank(
+            self,
+            sig: Signature,
+            cands: Iterable[Key],
+            k: Optional[int]=None,
+            min_similarity: Optional[float]=None
+    ) -> List[Tuple[Key, float]]:
+        """Score candidates against their stored signatures and keep the best ones."""
+        assert self.store_signatures, "Re-ranking needs the LSH to be built with store_signatures=True"
+        if min_similarity is None:
+            min_similarity = self.threshold
+        # Skip candidates without a stored signature (e.g. removed keys).
+        cands = [cand for cand in cands if cand in self.sig_rows]
+        if not cands:
+            return []
+        with self._stage("query.rerank") as counts:
+            rows = np.array([self.sig_rows[cand] for cand in cands])
+            scores = self.similarity(sig, self.signatures[rows])
+            order = np.argsort(-scores, kind='stable')
+            order = order[scores[order] >= min_similarity][:k]
+            counts["candidates"] = len(cands)
+            counts["results"] = len(order)
+        return [(cands[i], float(scores[i])) for i in order]
+
+    def self_join(
+            self,
+            verify: bool=False,
+            min_similarity: Optional[float]=None,
+            chunk: int=CHUNK_PAIRS
+    ) -> Iterator[List[Tuple]]:
+        """Find every pair of indexed keys that share a bucket, each pair once.
+
+        The band tables are walked directly instead of querying with every
+        key, pairs are yielded in lists of about `chunk`. With `verify` the
+        pairs are scored against their stored signatures (this requires
+        `store_signatures`), ones below `min_similarity` (defaults to the
+        threshold) are dropped and the rest are (key, key, score) triples.
+        """
+        for keys, a, b, scores in self._join(verify, min_similarity, chunk):
+            if scores is None:
+                yield [(keys[i], keys[j]) for i, j in zip(a.tolist(), b.tolist())]
+            else:
+                yield [(keys[i], keys[j], s) for i, j, s in zip(a.tolist(), b.tolist(), scores.tolist())]
+
+    def clusters(
+            self,
+            verify: bool=False,
+            min_similarity: Optional[float]=None,
+            chunk: int=CHUNK_PAIRS
+    ) -> List[List[Key]]:
+        """Group keys into the connected components of the `self_join` pairs, singletons are left out."""
+        parent = None
+        for keys, a, b, _ in self._join(verify, min_similarity, chunk):
+            if parent is None:
+                parent = np.arange(len(keys))
+            union(parent, a, b)
+        if parent is None:
+            return []
+        return [[keys[i] for i in group.tolist()] for group in components(parent)]
+
+    def _join(
+            self,
+            verify: bool,
+            min_similarity: Optional[float],
+            chunk: int
+    ) -> Iterator[Tuple[List[Key], np.ndarray, np.ndarray, Optional[np.ndarray]]]:
+        """Yield chunks of candidate pairs as (keys, ids, ids, scores), the ids index into keys."""
+        if verify:
+            assert self.store_signatures, "Verifying pairs needs the LSH to be built with store_signatures=True"
+            if min_similarity is None:
+                min_similarity = self.threshold
+        with self.lock.read():
+            hashes, ids, keys = self.data.export()
+            if verify:
+                rows = np.array([self.sig_rows.get(key, -1) for key in keys], dtype=np.int64)
+                signatures = self.signatures
+        matrix, present = band_matrix(hashes, ids, len(keys))
+        for band, (h, i) in enumerate(zip(hashes, ids)):
+            for a, b in bucket_pairs(h, i, chunk):
+                keep = first_band(a, b, band, matrix, present)
+                a, b = a[keep], b[keep]
+                scores = None
+                if verify:
+                    scores = self.similarity(signatures[rows[a]], signatures[rows[b]])
+                    keep = scores >= min_similarity
+                    a, b, scores = a[keep], b[keep], scores[keep]
+                if len(a):
+                    yield keys, a, b, scores
+
+    @read_locked
+    def stats(self, largest: int=LARGEST) -> Dict[str, Any]:
+        """Describe how the index is filled, to find bands with degenerate buckets.
+
+        :returns: {"items", "entries", "full_buckets", "bytes": {"backend", "signatures"}, "bands": [...]}
+            with one dict per band holding its number of "buckets" and
+            "entries", the "max" and "mean" bucket size, a "histogram" of
+            bucket sizes as [low, high, buckets] rows with power of two bounds,
+            and the `largest` buckets as [band hash, size] rows.
+        """
+        hashes, ids, keys = self.data.export()
+        hashes = list(hashes) + [np.zeros(0, dtype=np.uint64)] * (self.b - len(hashes))
+        ids = list(ids) + [np.zeros(0, dtype=np.int64)] * (self.b - len(ids))
+        bands = []
+        items = set()
+        for h, i in zip(hashes, ids):
+            h = np.asarray(h, dtype=np.uint64)
+            i = np.asarray(i, dtype=np.int64)
+            items.update(np.unique(i).tolist())
+            # Count each (hash, id) pair once.
+            pairs = np.unique(np.stack([h, i.view(np.uint64)], axis=1), axis=0)
+            buckets, sizes = np.unique(pairs[:, 0], return_counts=True)
+            histogram = []
+            if len(sizes):
+                logs = np.floor(np.log2(sizes)).astype(np.int64)
+                for log, count in zip(*np.unique(logs, return_counts=True)):
+                    histogram.append([1 << int(log), (1 << int(log) + 1) - 1, int(count)])
+            top = np.argsort(-sizes, kind='stable')[:largest]
+            bands.append({
+                "buckets": len(buckets),
+                "entries": int(sizes.sum()),
+                "max": int(sizes.max()) if len(sizes) else 0,
+                "mean": float(sizes.mean()) if len(sizes) else 0.0,
+                "histogram": histogram,
+                "largest": [[int(buckets[j]), int(sizes[j])] for j in top],
+            })
+        try:
+            backend = self.data.nbytes()
+        except NotImplementedError:
+            backend = None
+        return {
+            "items": len(items),
+            "entries": sum(band["entries"] for band in bands),
+            "full_buckets": len(self.full),
+            "bytes": {
+                "backend": backend,
+                "signatures": 0 if self.signatures is None else int(self.signatures.nbytes),
+            },
+            "bands": bands,
+        }
 
     @staticmethod
     def hashable(hs: Signature) -> bytes:
         return bytes(hs.data)
 
+    @write_locked
     def save(self, hasher):
         self.data.save(self, hasher)
 
+    @read_locked
+    def freeze(self, name: str, hasher=None) -> None:
+        """Write this index as a read only, memory-mappable `FrozenData` file."""
+        FrozenData.write(name, self, hasher, self.data)
+
     @classmethod
     def restore(cls, name):
-        data = sniff(name)
-        return data.restore(name)
+        """Load an index written by `save` or `freeze`, returns the LSH and its hasher."""
+        data, lsh, hasher = sniff(name).reload(name)
+        lsh.data = data
+        return lsh, hasher
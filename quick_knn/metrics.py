@@ -0,0 +1,87 @@
+import time
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, Optional
+
+# Called with the stage name, its duration in seconds and its counts after every timed stage.
+Callback = Callable[[str, float, Dict[str, int]], None]
+
+
+class Metrics(object):
+    """Call counts, totals and timings for the stages of `LSH` inserts and queries.
+
+    Stages are named like "query.get", see `LSH.instrument`. Each use of a
+    stage adds one call, its duration and any counts it reports (e.g.
+    candidates) to running totals and is passed to `callback`, so the numbers
+    can be forwarded to another metrics system.
+    """
+
+    def __init__(self, callback: Optional[Callback]=None):
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        self.calls = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.counts = defaultdict(lambda: defaultdict(int))
+
+    def stage(self, name: str) -> 'Stage':
+        return Stage(self, name)
+
+    def record(self, name: str, seconds: float, counts: Dict[str, int]) -> None:
+        with self.lock:
+            self.calls[name] += 1
+            self.seconds[name] += seconds
+            totals = self.counts[name]
+            for count, value in counts.items():
+                totals[count] += value
+        if self.callback is not None:
+            self.callback(name, seconds, counts)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """A copy of the totals, {stage: {"calls", "seconds", "mean_seconds", count: total}}."""
+        with self.lock:
+            return {
+                name: dict(
+                    calls=calls,
+                    seconds=self.seconds[name],
+                    mean_seconds=self.seconds[name] / calls,
+                    **self.counts[name]
+                )
+                for name, calls in self.calls.items()
+            }
+
+
+class Stage(object):
+    """Times a block and records it, the block can add counts to the dict it gets."""
+    __slots__ = ('metrics', 'name', 'counts', 'start')
+
+    def __init__(self, metrics: Metrics, name: str):
+        self.metrics = metrics
+        self.name = name
+        self.counts = {}
+
+    def __enter__(self) -> Dict[str, int]:
+        self.start = time.perf_counter()
+        return self.counts
+
+    def __exit__(self, *exc) -> None:
+        self.metrics.record(self.name, time.perf_counter() - self.start, self.counts)
+
+
+class NullStage(object):
+    """Stand in for `Stage` when metrics are off."""
+    __slots__ = ('counts',)
+
+    def __init__(self):
+        self.counts = {}
+
+    def __enter__(self) -> Dict[str, int]:
+        return self.counts
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+
+NULL_STAGE = NullStage()
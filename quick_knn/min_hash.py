@@ -1,17 +1,46 @@
 import struct
 from hashlib import sha1
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterable, Optional, Tuple, Union
 import numpy as np
 from quick_knn.type_hints import Signature, Hashable
 
 PRIME = (1 << 61) - 1
 MAX = (1 << 32) - 1
 BYTES = 4
+# Upper bound on the number of (token, permutation) cells computed at once,
+# small enough that the uint64 temporaries stay in cache.
+CHUNK = 1 << 16
+# Marks a bin in a one permutation signature that no token fell into.
+EMPTY = np.iinfo(np.uint64).max
+# Supported signature widths, widths below 8 are bit-packed into bytes.
+WIDTHS = (1, 2, 4, 8, 32, 64)
+DTYPES = {64: np.uint64, 32: np.uint32}
 
 
 class MinHash(object):
+    """MinHash signatures.
 
-    def __init__(self, bits: int, seed: int=1):
+    `width` controls how many bits of each minimum are kept. 64 and 32 store the
+    full 32 bit value (as np.uint64 and np.uint32). 8, 4, 2, and 1 keep only the
+    lowest bits of each value (b-bit MinHash) and pack them into np.uint8, these
+    signatures must be compared with `jaccard(..., width=width)` and can't be
+    used as `old` to extend a signature.
+
+    Tokens can be given as an integer array of token hashes (see
+    `quick_knn.shingle`), which skips hashing them with sha1. `cache` is the
+    size of an LRU cache of sha1 token hashes for corpora with many repeated
+    tokens, 0 turns it off.
+    """
+
+    def __init__(self, bits: int, seed: int=1, width: int=64, cache: int=0):
+        assert width in WIDTHS, f"width must be one of {WIDTHS}, got {width}"
+        assert (bits * width) % 8 == 0, f"bits * width must fill whole bytes, got {bits} * {width}"
         self.bits = bits
+        self.width = width
+        self.cache = cache
+        self.token_hash = cached_token_hash(cache)
         self.default = np.ones(self.bits, dtype=np.uint64) * MAX
         r = np.random.RandomState(seed)
         self.a = r.randint(1, PRIME, dtype=np.uint64, size=self.bits)
@@ -23,33 +52,245 @@ class MinHash(object):
             return self.signature(bs, old)
         if isinstance(bs, bytes):
             return self.signature(bs, old)
+        hash_values = self.token_hashes(bs, self.token_hash)
+        if len(hash_values) == 0:
+            return old
+        self._check_old(old)
+        hash_values = np.asarray(hash_values, dtype=np.uint64)
+        sig = self._segment_min(hash_values, np.array([0, len(hash_values)]))[0]
+        if old is not None:
+            sig = np.minimum(sig, old)
+        return self.compact(sig)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # The token cache isn't picklable, it starts empty again when loaded.
+        del state['token_hash']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cache = state.get('cache', 0)
+        self.token_hash = cached_token_hash(self.cache)
+
+    def _check_old(self, old: Optional[Signature]) -> None:
+        assert old is None or self.width in DTYPES, f"Can't extend a {self.width} bit signature"
+
+    def compact(self, sigs: np.ndarray) -> Signature:
+        """Convert full signatures (the last axis) to this hasher's width."""
+        if self.width in DTYPES:
+            return sigs.astype(DTYPES[self.width])
+        lanes = np.bitwise_and(sigs, np.uint64((1 << self.width) - 1)).astype(np.uint8)
+        return pack_lanes(lanes, self.width)
+
+    @staticmethod
+    def token_hashes(
+            bs: Union[Iterable[Union[str, bytes]], np.ndarray],
+            hash_token: Callable[[bytes], int]=None
+    ) -> np.ndarray:
+        """Hash every token in a set into a single array of 32 bit values.
+
+        Integer arrays are already token hashes and are used as is.
+        """
+        if isinstance(bs, np.ndarray) and np.issubdtype(bs.dtype, np.integer):
+            return bs.astype(np.uint64)
+        if hash_token is None:
+            hash_token = token_hash
+        hash_values = []
         for b in bs:
             if isinstance(b, str):
                 b = b.encode()
-            old = self.signature(b, old)
-        return old
+            hash_values.append(hash_token(b))
+        return np.array(hash_values, dtype=np.uint64)
+
+    def _permute(self, hash_values: np.ndarray) -> np.ndarray:
+        """Apply all the permutations to a column of hashes, result is (len(hash_values), bits)."""
+        hash_values = hash_values.reshape(-1, 1)
+        return np.bitwise_and((self.a * hash_values + self.b) % PRIME, np.uint64(MAX))
 
     def _hash(self, b: bytes) -> Signature:
-        hash_values = struct.unpack('<I', sha1(b).digest()[:BYTES])[0]
-        perm_hash_values = np.bitwise_and((self.a * hash_values + self.b) % PRIME, np.uint64(MAX))
-        return perm_hash_values
+        hash_values = self.token_hash(b)
+        return self._permute(np.array([hash_values], dtype=np.uint64))[0]
+
+    def signature_hashes(self, hash_values: np.ndarray) -> Signature:
+        """Sign a whole set of token hashes at once."""
+        hash_values = np.asarray(hash_values, dtype=np.uint64)
+        return self.compact(self._segment_min(hash_values, np.array([0, len(hash_values)]))[0])
+
+    def _segment_min(self, hash_values: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+        """Min-reduce the permuted hashes of each segment `hash_values[offsets[i]:offsets[i + 1]]`.
+
+        The permutations are applied as a (tokens x bits) broadcast in chunks
+        of at most `CHUNK` cells. Empty segments are left at the default signature.
+        """
+        n_docs = len(offsets) - 1
+        sigs = np.tile(self.default, (n_docs, 1))
+        doc_ids = np.repeat(np.arange(n_docs), np.diff(offsets))
+        step = max(1, CHUNK // self.bits)
+        for start in range(0, len(hash_values), step):
+            chunk = self._permute(hash_values[start:start + step])
+            ids = doc_ids[start:start + step]
+            # Tokens are grouped by document so each run of ids is one segment.
+            bounds = np.flatnonzero(np.concatenate([[True], ids[1:] != ids[:-1]]))
+            rows = ids[bounds]
+            sigs[rows] = np.minimum(sigs[rows], np.minimum.reduceat(chunk, bounds, axis=0))
+        return sigs
+
+    @staticmethod
+    def flatten(
+            docs: Iterable[Union[Hashable, np.ndarray]],
+            hash_token: Callable[[bytes], int]=None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Hash a collection of token sets into one flat buffer plus CSR style offsets."""
+        hash_values = []
+        offsets = [0]
+        for doc in docs:
+            if isinstance(doc, (str, bytes)):
+                doc = [doc]
+            doc = MinHash.token_hashes(doc, hash_token)
+            hash_values.append(doc)
+            offsets.append(offsets[-1] + len(doc))
+        if not hash_values:
+            return np.zeros(0, dtype=np.uint64), np.array(offsets)
+        return np.concatenate(hash_values), np.array(offsets)
+
+    def signature_batch(self, docs: Iterable[Hashable], processes: Optional[int]=None) -> np.ndarray:
+        """Sign many token sets into a contiguous (len(docs) x bits) matrix.
+
+        Documents with no tokens get the default (all `MAX`) signature. When
+        `processes` is given the documents are split into contiguous slices
+        that are signed in a process pool.
+        """
+        if processes is not None and processes > 1:
+            docs = list(docs)
+            step = max(1, -(-len(docs) // processes))
+            slices = [docs[i:i + step] for i in range(0, len(docs), step)]
+            if len(slices) > 1:
+                with ProcessPoolExecutor(processes) as pool:
+                    return np.vstack(list(pool.map(self.signature_batch, slices)))
+        hash_values, offsets = MinHash.flatten(docs, self.token_hash)
+        return self.compact(self._segment_min(hash_values, offsets))
 
     def signature(self, b: bytes, old: Signature=None) -> Signature:
+        self._check_old(old)
         if old is None:
             old = self.default
-        return np.minimum(self._hash(b), old)
+        return self.compact(np.minimum(self._hash(b), old))
 
     def __len__(self) -> int:
         return self.bits
 
 
+class OnePermutationMinHash(object):
+    """One Permutation Hashing with optimal densification.
+
+    Each token is hashed once and binned into one of `bits` buckets, the
+    smallest value in a bucket is kept. Empty buckets are filled by probing
+    other buckets with a fixed (bucket, attempt) hash until a full one is
+    found, https://arxiv.org/abs/1703.04664. The attempt number is stored
+    above the 32 bit value so filled buckets can be told apart from real ones
+    when more tokens are added to an old signature.
+    """
+
+    def __init__(self, bits: int, seed: int=1):
+        self.bits = bits
+        self.empty = np.full(self.bits, EMPTY, dtype=np.uint64)
+        r = np.random.RandomState(seed)
+        self.a, self.c = r.randint(1, PRIME, dtype=np.uint64, size=2)
+        self.b, self.d = r.randint(0, PRIME, dtype=np.uint64, size=2)
+
+    def __call__(self, bs: Hashable, old: Signature=None) -> Signature:
+        if isinstance(bs, (str, bytes)):
+            bs = [bs]
+        hash_values = MinHash.token_hashes(bs)
+        if len(hash_values) == 0:
+            return old
+        return self.signature_hashes(hash_values, old)
+
+    def signature_hashes(self, hash_values: np.ndarray, old: Signature=None) -> Signature:
+        hash_values = np.asarray(hash_values, dtype=np.uint64)
+        perm_hash_values = np.bitwise_and((self.a * hash_values + self.b) % PRIME, np.uint64(MAX))
+        bins = (perm_hash_values % np.uint64(self.bits)).astype(np.intp)
+        raw = self.empty.copy() if old is None else np.where(old > MAX, EMPTY, old)
+        np.minimum.at(raw, bins, perm_hash_values // np.uint64(self.bits))
+        return self.densify(raw)
+
+    def signature(self, b: bytes, old: Signature=None) -> Signature:
+        return self(b, old)
+
+    def _probe(self, bins: np.ndarray, attempt: int) -> np.ndarray:
+        key = np.left_shift(bins.astype(np.uint64), np.uint64(32)) | np.uint64(attempt)
+        return ((self.c * key + self.d) % PRIME % np.uint64(self.bits)).astype(np.intp)
+
+    def densify(self, raw: Signature) -> Signature:
+        sig = raw.copy()
+        empty = np.flatnonzero(raw == EMPTY)
+        if len(empty) == len(raw):
+            return sig
+        attempt = 0
+        while len(empty):
+            attempt += 1
+            src = self._probe(empty, attempt)
+            found = raw[src] != EMPTY
+            sig[empty[found]] = raw[src[found]] + np.uint64(attempt << 32)
+            empty = empty[~found]
+        return sig
+
+    def __len__(self) -> int:
+        return self.bits
+
+
+def token_hash(b: bytes) -> int:
+    """The 32 bit sha1 based hash of a token."""
+    return struct.unpack('<I', sha1(b).digest()[:BYTES])[0]
+
+
+def cached_token_hash(size: int) -> Callable[[bytes], int]:
+    """`token_hash` behind an LRU cache of `size` tokens, no cache when size is 0."""
+    if not size:
+        return token_hash
+    return lru_cache(maxsize=size)(token_hash)
+
+
+def pack_lanes(lanes: np.ndarray, width: int) -> np.ndarray:
+    """Pack b-bit values (the last axis) into bytes, lowest bits first."""
+    if width == 8:
+        return lanes
+    per = 8 // width
+    shifts = np.arange(0, 8, width, dtype=np.uint8)
+    lanes = lanes.reshape(lanes.shape[:-1] + (-1, per))
+    return np.bitwise_or.reduce(np.left_shift(lanes, shifts), axis=-1).astype(np.uint8)
+
+
+def unpack_lanes(packed: np.ndarray, width: int) -> np.ndarray:
+    """Inverse of `pack_lanes`."""
+    if width == 8:
+        return packed
+    shifts = np.arange(0, 8, width, dtype=np.uint8)
+    lanes = np.bitwise_and(np.right_shift(packed[..., np.newaxis], shifts), np.uint8((1 << width) - 1))
+    return lanes.reshape(packed.shape[:-1] + (-1,))
+
+
 def count(hashes: Signature) -> float:
     """http://ieeexplore.ieee.org/stamp/stamp.jsp?arnumber=365694"""
     return len(hashes) / np.sum(hashes / MAX) - 1.0
 
 
-def jaccard(mh1: Signature, mh2: Signature) -> float:
-    return np.sum(mh1 == mh2) / len(mh1)
+def jaccard(mh1: Signature, mh2: Signature, width: int=64) -> Union[float, np.ndarray]:
+    """Estimate Jaccard similarity from MinHash signatures.
+
+    For b-bit signatures (width <= 8) two lanes also agree by chance with
+    probability ~1 / 2^b, the raw agreement rate is corrected for that as in
+    https://arxiv.org/abs/0910.3349
+
+    Signature matrices (which broadcast against each other) are compared
+    row by row.
+    """
+    if width in DTYPES:
+        return np.mean(mh1 == mh2, axis=-1)
+    agree = np.mean(unpack_lanes(mh1, width) == unpack_lanes(mh2, width), axis=-1)
+    chance = 1.0 / (1 << width)
+    return np.maximum(0.0, (agree - chance) / (1.0 - chance))
 
 
 if __name__ == "__main__":
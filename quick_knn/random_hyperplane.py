@@ -1,22 +1,251 @@
+from collections import namedtuple
+from typing import Iterable, Optional, Tuple, Union
 import numpy as np
 from quick_knn.type_hints import Signature
 
+WORD = 64
+# Default number of rows signed at a time by `RandomHyperplanes.signature_stream`.
+CHUNK_ROWS = 1 << 16
+# Upper bound on the number of (input value, bit) cells projected at once for
+# sparse inputs and generated projections.
+CHUNK = 1 << 22
+PROJECTIONS = ("gaussian", "sparse")
+# Number of set bits in each byte, used when np.bitwise_count is missing.
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+# Compressed Sparse Row input, anything with `data`, `indices` and `indptr`
+# attributes (like a scipy.sparse.csr_matrix) is also accepted.
+CSR = namedtuple('CSR', 'data indices indptr')
+
+
 class RandomHyperplanes(object):
+    """Random Hyperplane signatures.
+
+    When `packed` is set signatures are bit-packed into np.uint64 words (see
+    `pack_bits`) instead of one np.uint8 per bit.
 
-    def __init__(self, bits: int, dim: int):
+    `projection="gaussian"` stores a dense (dim x bits) matrix of planes drawn
+    from `seed`. `projection="sparse"` uses very sparse {-1, 0, +1} planes
+    (https://dl.acm.org/doi/10.1145/1150402.1150436) that are generated from
+    `seed` by hashing (feature, bit) when needed, so memory doesn't depend on
+    `dim`. `density` is the fraction of non-zero entries, it defaults to
+    1 / sqrt(dim), use 1 / 3 for Achlioptas projections.
+
+    Input can be dense or CSR (see `CSR`), with CSR input the cost scales with
+    the number of non-zeros.
+    """
+
+    def __init__(
+            self,
+            bits: int,
+            dim: int,
+            packed: bool=False,
+            projection: str="gaussian",
+            density: Optional[float]=None,
+            seed: int=1
+    ):
         super().__init__()
+        assert projection in PROJECTIONS, f"projection must be one of {PROJECTIONS}, got {projection}"
         self.bits = bits
         self.dim = dim
-        self.planes = np.random.randn(self.dim, self.bits)
+        self.packed = packed
+        self.projection = projection
+        self.seed = seed
+        if projection == "gaussian":
+            self.planes = np.random.RandomState(seed).randn(self.dim, self.bits)
+        else:
+            self.planes = None
+            self.density = 1.0 / np.sqrt(dim) if density is None else density
+            assert 0.0 < self.density <= 1.0, f"density must be in (0.0, 1.0], got {self.density}"
 
     def __call__(self, data: np.ndarray) -> Signature:
         return self.signature(data)
 
-    def signature(self, data: np.ndarray) -> Signature:
-        return (np.dot(data, self.planes) >= 0).astype(np.uint8)
+    def signature(
+            self,
+            data: Union[np.ndarray, CSR],
+            margins: bool=False
+    ) -> Union[Signature, Tuple[Signature, np.ndarray]]:
+        """Sign data.
+
+        :param margins: Also return the distance of each projection from its
+            plane, bits with small margins are the likeliest to flip for a
+            near neighbour (see `LSH.query` probes).
+        """
+        projection = self.project(data)
+        sig = (projection >= 0).astype(np.uint8)
+        if self.packed:
+            sig = pack_bits(sig)
+        if margins:
+            return sig, np.abs(projection)
+        return sig
+
+    def project(self, data: Union[np.ndarray, CSR], planes: Optional[np.ndarray]=None) -> np.ndarray:
+        """Project dense or CSR data onto the planes.
+
+        :param planes: Use these stored planes (e.g. a float32 copy) instead of `self.planes`.
+        """
+        if planes is None:
+            planes = self.planes
+        csr = as_csr(data)
+        if csr is not None:
+            return self._project_csr(*csr, planes)
+        if planes is not None:
+            return np.dot(data, planes)
+        data = np.asarray(data)
+        flat = data.ndim == 1
+        data = np.atleast_2d(data)
+        out = np.zeros((data.shape[0], self.bits), dtype=np.float32)
+        step = max(1, CHUNK // (self.bits * data.shape[0]))
+        for start in range(0, self.dim, step):
+            features = np.arange(start, min(start + step, self.dim))
+            out += np.dot(data[:, features], self.rows(features))
+        return out[0] if flat else out
+
+    def _project_csr(
+            self,
+            values: np.ndarray,
+            indices: np.ndarray,
+            indptr: np.ndarray,
+            planes: Optional[np.ndarray]
+    ) -> np.ndarray:
+        n_rows = len(indptr) - 1
+        dtype = np.float32 if planes is None else planes.dtype
+        out = np.zeros((n_rows, self.bits), dtype=dtype)
+        row_ids = np.repeat(np.arange(n_rows), np.diff(indptr))
+        step = max(1, CHUNK // self.bits)
+        for start in range(0, len(indices), step):
+            idx = np.asarray(indices[start:start + step])
+            if planes is None:
+                features, inverse = np.unique(idx, return_inverse=True)
+                rows = self.rows(features)[inverse]
+            else:
+                rows = planes[idx]
+            contrib = rows * np.asarray(values[start:start + step], dtype=dtype)[:, np.newaxis]
+            ids = row_ids[start:start + step]
+            # Values are grouped by row so each run of ids is one row.
+            bounds = np.flatnonzero(np.concatenate([[True], ids[1:] != ids[:-1]]))
+            out[ids[bounds]] += np.add.reduceat(contrib, bounds, axis=0)
+        return out
+
+    def rows(self, features: np.ndarray) -> np.ndarray:
+        """The rows of the plane matrix for some features, generated for sparse projections."""
+        if self.planes is not None:
+            return self.planes[features]
+        keys = np.asarray(features, dtype=np.uint64)[:, np.newaxis] * np.uint64(self.bits) + np.arange(self.bits, dtype=np.uint64)
+        h = mix64(keys ^ mix64(np.array([self.seed], dtype=np.uint64)))
+        nonzero = np.bitwise_and(h, np.uint64(0xFFFFFFFF)) < np.uint64(int(self.density * (1 << 32)))
+        sign = np.where(np.bitwise_and(np.right_shift(h, np.uint64(32)), np.uint64(1)), 1.0, -1.0)
+        return (sign * nonzero).astype(np.float32)
+
+    def signature_stream(
+            self,
+            data: Union[str, np.ndarray, Iterable[np.ndarray]],
+            out: Union[str, np.ndarray]=None,
+            chunk: int=CHUNK_ROWS
+    ) -> np.ndarray:
+        """Sign a large dataset in chunks with bounded memory.
+
+        `data` is an array (e.g. a np.memmap), a path to a .npy file which is
+        memory-mapped, or an iterator of row blocks. Each block of at most `chunk`
+        rows is projected in float32 and written as packed signatures to `out`.
+        `out` is a pre-allocated array, a path to create a .npy memmap at, or None
+        to allocate in memory. Because of the float32 projection rows very close to
+        a plane can get a different bit than `signature`.
+
+        :returns: The packed (rows x words) np.uint64 signatures.
+        """
+        planes = None if self.planes is None else self.planes.astype(np.float32)
+        words = -(-self.bits // WORD)
+        if isinstance(data, str):
+            data = np.load(data, mmap_mode='r')
+        if isinstance(data, np.ndarray):
+            rows = data.shape[0]
+            blocks = (data[i:i + chunk] for i in range(0, rows, chunk))
+        else:
+            rows = None
+            blocks = data
+        if isinstance(out, str):
+            assert rows is not None, "Writing to a file requires the number of rows, pass an array or .npy path"
+            out = np.lib.format.open_memmap(out, mode='w+', dtype=np.uint64, shape=(rows, words))
+        elif out is None and rows is not None:
+            out = np.empty((rows, words), dtype=np.uint64)
+        results = []
+        start = 0
+        for block in blocks:
+            for i in range(0, len(block), chunk):
+                sub = np.asarray(block[i:i + chunk], dtype=np.float32)
+                sig = pack_bits((self.project(sub, planes) >= 0).astype(np.uint8))
+                if out is None:
+                    results.append(sig)
+                else:
+                    out[start:start + len(sig)] = sig
+                start += len(sig)
+        if out is None:
+            return np.concatenate(results) if results else np.empty((0, words), dtype=np.uint64)
+        if isinstance(out, np.memmap):
+            out.flush()
+        return out
+
+
+def as_csr(data) -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Return (data, indices, indptr) for CSR input and None for dense input."""
+    if isinstance(data, tuple) and len(data) == 3:
+        return tuple(data)
+    if all(hasattr(data, attr) for attr in CSR._fields):
+        return data.data, data.indices, data.indptr
+    return None
+
+
+def mix64(x: np.ndarray) -> np.ndarray:
+    """The splitmix64 finalizer, scrambles np.uint64 values."""
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x ^= np.right_shift(x, np.uint64(30))
+    x *= np.uint64(0xBF58476D1CE4E5B9)
+    x ^= np.right_shift(x, np.uint64(27))
+    x *= np.uint64(0x94D049BB133111EB)
+    x ^= np.right_shift(x, np.uint64(31))
+    return x
+
+
+def pack_bits(sigs: np.ndarray) -> np.ndarray:
+    """Pack 0/1 signatures (the last axis) into little endian np.uint64 words, zero padded."""
+    packed = np.packbits(sigs, axis=-1, bitorder='little')
+    pad = -packed.shape[-1] % (WORD // 8)
+    if pad:
+        packed = np.concatenate([packed, np.zeros(packed.shape[:-1] + (pad,), dtype=np.uint8)], axis=-1)
+    return np.ascontiguousarray(packed).view('<u8')
+
+
+def unpack_bits(packed: np.ndarray, bits: int) -> np.ndarray:
+    """Inverse of `pack_bits`."""
+    packed = np.ascontiguousarray(packed).view(np.uint8)
+    return np.unpackbits(packed, axis=-1, count=bits, bitorder='little')
+
+
+def popcount(words: np.ndarray) -> np.ndarray:
+    """Count the set bits in each word of an integer array."""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    counts = POPCOUNT[np.ascontiguousarray(words).view(np.uint8)]
+    return counts.reshape(words.shape + (-1,)).sum(axis=-1)
+
+
+def hamming(query: Signature, dataset: Signature) -> np.ndarray:
+    """Number of differing bits between a packed query and each row of a packed dataset."""
+    return popcount(np.bitwise_xor(query, dataset)).sum(axis=-1, dtype=np.int64)
+
 
+def cosine(query: Signature, dataset: Signature, bits: int=None) -> float:
+    """Estimate the angular similarity between a query and each row of dataset.
 
-def cosine(query: Signature, dataset: Signature) -> float:
+    Packed (np.uint64) signatures are compared with XOR + popcount, `bits` is
+    the unpadded signature length and defaults to every bit in the words.
+    """
+    if query.dtype == np.uint64:
+        if bits is None:
+            bits = query.shape[-1] * WORD
+        return 1 - hamming(query, dataset) / bits
     return 1 - np.mean(np.logical_xor(query, dataset), axis=1)
 
 
@@ -0,0 +1,74 @@
+import numpy as np
+from quick_knn.random_hyperplane import mix64
+
+# Odd multiplier of the polynomial word hash and its inverse mod 2^64.
+WORD_PRIME = np.uint64(0x100000001B3)
+WORD_PRIME_INV = np.uint64(0xCE965057AFF6957B)
+# Code points `str.split()` treats as whitespace.
+WHITESPACE = np.array(
+    [9, 10, 11, 12, 13, 28, 29, 30, 31, 32, 0x85, 0xA0, 0x1680, 0x2028, 0x2029, 0x202F, 0x205F, 0x3000]
+    + list(range(0x2000, 0x200B)),
+    dtype=np.uint32
+)
+DTYPES = (np.uint32, np.uint64)
+
+
+def char_ngrams(text: str, n: int=2, lower: bool=True, dtype=np.uint32, seed: int=0) -> np.ndarray:
+    """Hash the distinct character n-grams of a text.
+
+    :returns: A sorted array of unique n-gram hashes, empty when the text is
+        shorter than `n`. It can be passed straight to `MinHash`.
+    """
+    return finish(ngrams(codepoints(text, lower), n, seed), dtype)
+
+
+def word_ngrams(text: str, n: int=1, lower: bool=True, dtype=np.uint32, seed: int=0) -> np.ndarray:
+    """Hash the distinct n-grams of whitespace separated words of a text, see `char_ngrams`."""
+    return finish(ngrams(word_hashes(codepoints(text, lower)), n, seed), dtype)
+
+
+def codepoints(text: str, lower: bool=True) -> np.ndarray:
+    """The unicode code points of a text as np.uint32."""
+    if lower:
+        text = text.lower()
+    return np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+
+
+def ngrams(values: np.ndarray, n: int, seed: int=0) -> np.ndarray:
+    """Hash every window of `n` consecutive values by folding them through `mix64`."""
+    assert n >= 1, f"n must be at least 1, got {n}"
+    windows = len(values) - n + 1
+    if windows <= 0:
+        return np.zeros(0, dtype=np.uint64)
+    values = values.astype(np.uint64)
+    h = np.full(windows, mix64(np.array([seed], dtype=np.uint64))[0])
+    for i in range(n):
+        h = mix64(h ^ values[i:i + windows])
+    return h
+
+
+def word_hashes(points: np.ndarray) -> np.ndarray:
+    """Hash each whitespace separated word in an array of code points.
+
+    Words are hashed with a polynomial hash computed for all of them at once
+    from prefix sums, then scrambled together with their length.
+    """
+    word = ~np.isin(points, WHITESPACE)
+    edges = np.diff(np.concatenate([[False], word, [False]]).astype(np.int8))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    if len(starts) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    one = np.ones(1, dtype=np.uint64)
+    powers = np.concatenate([one, np.cumprod(np.full(len(points) - 1, WORD_PRIME))])
+    inverses = np.concatenate([one, np.cumprod(np.full(len(points) - 1, WORD_PRIME_INV))])
+    prefix = np.concatenate([[np.uint64(0)], np.cumsum(points.astype(np.uint64) * powers, dtype=np.uint64)])
+    # Shift each word's sum back so it doesn't depend on where the word starts.
+    sums = (prefix[ends] - prefix[starts]) * inverses[starts]
+    return mix64(sums ^ mix64((ends - starts).astype(np.uint64)))
+
+
+def finish(hashes: np.ndarray, dtype=np.uint32) -> np.ndarray:
+    """Truncate hashes to `dtype` and drop repeats."""
+    assert dtype in DTYPES, f"dtype must be one of {DTYPES}, got {dtype}"
+    return np.unique(hashes.astype(dtype))
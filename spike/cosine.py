@@ -76,15 +76,12 @@ def main():
     lsh = LSH(args.thresh, args.bits)
     rh = RandomHyperplanes(args.bits, data_vectors.shape[1])
     sigs = rh(data_vectors)
-    for i, sig in enumerate(sigs):
-        lsh.insert(i, sig)
+    lsh.insert_many(range(len(sigs)), sigs)
     build_time = time.time() - t0
 
     t0 = time.time()
     qs = rh(query_vectors)
-    res = []
-    for q in qs:
-        res.append(lsh.query(q))
+    res = lsh.query_many(qs)
     query_time = time.time() - t0
 
     for i, (g, r) in enumerate(zip(gold, res)):
@@ -42,14 +42,6 @@ def f1(gold, res):
     print(f"F1: {f}")
     return f
 
-def encode(d, mh):
-    # This is a bad function but cleans up our code
-    my = None
-    for x in d:
-        my = mh.signature(x, my)
-    return my
-
-
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--thresh", "-t", default = 0.59, type=float)
@@ -77,16 +69,13 @@ def main():
     mh = MinHash(args.bits)
 
     t0 = time.time()
-    for i, d in enumerate(data):
-        my = encode(d, mh)
-        lsh.insert(i, my)
+    sigs = mh.signature_batch(data)
+    with lsh.bulk_load():
+        lsh.insert_many(range(len(sigs)), sigs)
     build_time = time.time() - t0
 
     t0 = time.time()
-    res = []
-    for query in queries:
-        my = encode(query, mh)
-        res.append(lsh.query(my))
+    res = lsh.query_many(mh.signature_batch(queries))
     query_time = time.time() - t0
 
     m_score = []
@@ -0,0 +1,40 @@
+import time
+import random
+import argparse
+import numpy as np
+from quick_knn.min_hash import MinHash, OnePermutationMinHash, jaccard
+
+
+def make_pair(size, overlap):
+    shared = int(size * overlap)
+    s1 = {f"{random.random()}" for _ in range(size)}
+    # Sorted so which tokens are shared doesn't depend on set iteration order.
+    s2 = set(sorted(s1)[:shared]) | {f"{random.random()}" for _ in range(size - shared)}
+    return s1, s2
+
+
+def run(hasher, pairs):
+    t0 = time.time()
+    sigs = [(hasher(s1), hasher(s2)) for s1, s2 in pairs]
+    elapsed = time.time() - t0
+    return np.array([jaccard(a, b) for a, b in sigs]), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bits", "-b", default=1024, type=int)
+    parser.add_argument("--size", default=2000, type=int)
+    parser.add_argument("--pairs", "-p", default=50, type=int)
+    parser.add_argument("--seed", "-s", default=1337, type=int)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    pairs = [make_pair(args.size, random.random()) for _ in range(args.pairs)]
+    gold = np.array([len(s1 & s2) / len(s1 | s2) for s1, s2 in pairs])
+
+    for name, hasher in [("MinHash", MinHash(args.bits)), ("OnePermutationMinHash", OnePermutationMinHash(args.bits))]:
+        est, elapsed = run(hasher, pairs)
+        print(f"{name}: Sign time: {elapsed:.4f} Mean abs error: {np.mean(np.abs(est - gold)):.4f} Max abs error: {np.max(np.abs(est - gold)):.4f}")
+
+if __name__ == "__main__":
+    main()
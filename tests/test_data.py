@@ -0,0 +1,149 @@
+import numpy as np
+import pytest
+from quick_knn.data import ArrayData, PickleData, SQLData, to_keys, from_keys, merge_sorted
+
+def random_keys(n, b, buckets=5):
+    return np.random.randint(0, buckets, size=(n, b)).astype(np.uint64)
+
+def test_to_keys_round_trip():
+    hashes = np.array([0, 1, 2 ** 63 + 5], dtype=np.uint64)
+    keys = to_keys(hashes)
+    assert all(len(key) == 8 for key in keys)
+    np.testing.assert_array_equal(from_keys(keys), hashes)
+
+def test_array_data_matches_pickle_data():
+    keys = random_keys(100, 4)
+    values = [f"item-{i}" for i in range(100)]
+    array = ArrayData("array", 4)
+    pickled = PickleData("pickle", 4)
+    array.insert_many(keys[:50], values[:50])
+    for row, value in zip(keys[50:], values[50:]):
+        array.insert(to_keys(row), value)
+    pickled.insert_many(keys, values)
+    queries = random_keys(20, 4)
+    assert array.get_many(queries) == pickled.get_many(queries)
+    assert array.get(to_keys(queries[0])) == pickled.get(to_keys(queries[0]))
+
+def test_array_data_merges_between_lookups():
+    keys = random_keys(90, 3)
+    values = [f"item-{i}" for i in range(90)]
+    data = ArrayData("merge", 3)
+    gold = PickleData("gold", 3)
+    for start in range(0, 90, 10):
+        data.insert_many(keys[start:start + 10], values[start:start + 10])
+        gold.insert_many(keys[start:start + 10], values[start:start + 10])
+        queries = random_keys(10, 3)
+        assert data.get_many(queries) == gold.get_many(queries)
+    # Runs shrink geometrically so there are only a few of them.
+    assert len(data.runs) <= 3
+    assert all(np.all(h[1:] >= h[:-1]) for hashes, _ in data.runs for h in hashes)
+    data.compact()
+    assert len(data.runs) == 1
+    assert data.get_many(keys) == gold.get_many(keys)
+
+def test_merge_sorted():
+    hashes = np.array([1, 3, 3, 7], dtype=np.uint64)
+    values = np.array([0, 1, 2, 3])
+    merged = merge_sorted(hashes, values, np.array([0, 3, 9], dtype=np.uint64), np.array([4, 5, 6]))
+    np.testing.assert_array_equal(merged[0], [0, 1, 3, 3, 3, 7, 9])
+    np.testing.assert_array_equal(merged[1], [4, 0, 1, 2, 5, 3, 6])
+
+def test_array_data_save_reload(tmpdir):
+    name = str(tmpdir.join("index"))
+    keys = random_keys(30, 3)
+    data = ArrayData(name, 3)
+    data.insert_many(keys, list(range(30)))
+    data.save(None, None)
+    reloaded, _, _ = ArrayData.reload(name)
+    assert reloaded.get_many(keys) == data.get_many(keys)
+
+def test_sql_bulk_matches_single_inserts(tmpdir):
+    keys = random_keys(60, 4)
+    values = [("item", i) for i in range(60)]
+    single = SQLData("single", in_memory=True)
+    for row, value in zip(keys, values):
+        single.insert(to_keys(row), value)
+    path = str(tmpdir.join("bulk.db"))
+    bulk = SQLData(path)
+    with bulk.bulk(batch=7):
+        bulk.insert_many(keys[:30], values[:30])
+        for row, value in zip(keys[30:], values[30:]):
+            bulk.insert(to_keys(row), value)
+    queries = random_keys(10, 4)
+    assert bulk.get_many(queries) == single.get_many(queries)
+    reopened = SQLData(path)
+    assert reopened.get_many(queries) == single.get_many(queries)
+    assert len(reopened.ids) == 60
+    indices = reopened.conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'").fetchall()
+    assert ('bands',) in indices
+
+def test_sql_wal_enabled(tmpdir):
+    data = SQLData(str(tmpdir.join("wal.db")))
+    assert data.conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+def test_sql_get_ids_many_grouped_by_query():
+    keys = random_keys(40, 3)
+    data = SQLData("ids", in_memory=True)
+    data.insert_many(keys, list(range(40)))
+    queries = random_keys(8, 3)
+    ids = data.get_ids_many(queries)
+    assert len(ids) == len(queries)
+    gold = PickleData("gold", 3)
+    gold.insert_many(keys, list(range(40)))
+    for got, want in zip(ids, gold.get_many(queries)):
+        assert set(got.tolist()) == want
+
+def test_sql_threaded_readers(tmpdir):
+    from concurrent.futures import ThreadPoolExecutor
+    keys = random_keys(50, 4)
+    data = SQLData(str(tmpdir.join("threads.db")))
+    data.insert_many(keys, [f"item-{i}" for i in range(50)])
+    queries = [random_keys(5, 4) for _ in range(8)]
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(data.get_many, queries))
+    assert results == [data.get_many(q) for q in queries]
+
+def test_pickle_data_reinsert_keeps_tombstones():
+    keys = np.arange(60, dtype=np.uint64).reshape(20, 3)
+    data = PickleData("reinsert", 3)
+    data.insert_many(keys, list(range(20)))
+    data.remove(4)
+    data.insert(to_keys(keys[5]), 4)
+    # The old entries stay tombstoned instead of being compacted away.
+    assert len(data.dead) == 1
+    assert data.get(to_keys(keys[4])) == set()
+    assert data.get(to_keys(keys[5])) == {4, 5}
+    data.compact()
+    assert not data.dead
+    assert data.get(to_keys(keys[5])) == {4, 5}
+
+@pytest.mark.parametrize("cls", [PickleData, ArrayData])
+def test_compact_renumbers_ids(tmpdir, cls):
+    keys = random_keys(30, 3)
+    data = cls(str(tmpdir.join("churn")), 3)
+    for _ in range(5):
+        data.insert_many(keys, list(range(30)))
+        for i in range(0, 30, 2):
+            data.remove(i)
+    before = data.get_many(keys)
+    assert len(data.keys) > 30
+    data.compact()
+    assert [data.ids[key] for key in data.keys] == list(range(len(data.keys)))
+    assert sorted(data.keys) == list(range(1, 30, 2))
+    assert data.get_many(keys) == before
+    hashes, ids, exported = data.export()
+    assert exported == data.keys
+    assert all(i.max() < len(exported) for i in ids)
+
+def test_pickle_data_rejects_old_files(tmpdir):
+    import pickle
+    from collections import defaultdict
+    name = str(tmpdir.join("old"))
+    sigs = np.arange(20, dtype=np.uint64).reshape(10, 2)
+    tables = [defaultdict(set) for _ in range(2)]
+    for i, sig in enumerate(sigs):
+        for band, table in enumerate(tables):
+            table[bytes(sig[band:band + 1])].add(f"item-{i}")
+    pickle.dump([tables, None, None], open(f"{name}.p", "wb"))
+    with pytest.raises(AssertionError, match="older version"):
+        PickleData.reload(name)
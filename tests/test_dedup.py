@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from quick_knn.dedup import dedup
+from quick_knn.lsh import LSH
+from quick_knn.min_hash import MinHash
+
+def words(doc):
+    return set(doc.split())
+
+def make_docs(n=60):
+    rng = np.random.RandomState(0)
+    base = [" ".join(f"w{j}" for j in rng.randint(0, 10000, size=30)) for _ in range(20)]
+    return [(f"doc-{i}", base[i % 20]) for i in range(n)]
+
+@pytest.mark.parametrize("t", ["pickle", "sql", "array"])
+def test_dedup_exact_duplicates(t):
+    docs = make_docs()
+    results = list(dedup(docs, LSH(0.8, 64, t=t), MinHash(64), shingle=words, batch=7))
+    assert [doc_id for doc_id, _ in results] == [doc_id for doc_id, _ in docs]
+    for i, (doc_id, dup) in enumerate(results):
+        if i < 20:
+            assert dup is None
+        else:
+            # The first kept copy, whatever order the candidate sets come in.
+            assert dup == f"doc-{i % 20}"
+
+def test_dedup_processes_and_verify():
+    docs = make_docs()
+    serial = list(dedup(docs, LSH(0.8, 64, store_signatures=True), MinHash(64), words, batch=5, min_similarity=0.9))
+    parallel = list(dedup(docs, LSH(0.8, 64, store_signatures=True), MinHash(64), words, batch=5, processes=2, min_similarity=0.9))
+    assert serial == parallel
+    assert [dup for _, dup in serial] == [None] * 20 + [f"doc-{i % 20}" for i in range(20, 60)]
+
+def test_dedup_looks_in_split_buckets():
+    docs = make_docs(1)
+    mh = MinHash(64)
+    sig = mh.signature_batch([words(docs[0][1])])
+    lsh = LSH(0.8, 64, bucket_cap=1, cap_policy="split")
+    # "kept" lands in the split sub-buckets behind "old".
+    lsh.insert_many(["old", "kept"], np.vstack([sig, sig]))
+    lsh.remove("old")
+    assert list(dedup(docs, lsh, mh, words)) == [("doc-0", "kept")]
+
+@pytest.mark.parametrize("t", ["pickle", "sql", "array"])
+def test_dedup_prefers_keys_indexed_first(t):
+    docs = make_docs(1)
+    mh = MinHash(64)
+    sig = mh.signature_batch([words(docs[0][1])])
+    lsh = LSH(0.8, 64, t=t)
+    lsh.insert("b", sig[0])
+    lsh.insert("a", sig[0])
+    assert list(dedup(docs, lsh, mh, words)) == [("doc-0", "b")]
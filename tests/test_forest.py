@@ -0,0 +1,62 @@
+import numpy as np
+from quick_knn.forest import LSHForest
+from quick_knn.min_hash import MinHash
+from quick_knn.random_hyperplane import RandomHyperplanes, pack_bits
+
+def brute_force(sigs, query, trees, depth, r):
+    found = set()
+    for i, sig in enumerate(sigs):
+        for tree in range(trees):
+            start = tree * depth
+            if np.array_equal(sig[start:start + r], query[start:start + r]):
+                found.add(i)
+    return found
+
+def test_prefix_query_matches_brute_force():
+    rng = np.random.RandomState(1)
+    sigs = rng.randint(0, 3, size=(200, 32)).astype(np.uint32)
+    forest = LSHForest(32, trees=4)
+    forest.insert_many(range(100), sigs[:100])
+    for i, sig in enumerate(sigs[100:], 100):
+        forest.insert(i, sig)
+    for r in (1, 2, 5, 8):
+        for query in sigs[:10]:
+            assert set(forest.query(query, r=r)) == brute_force(sigs, query, 4, 8, r)
+
+def test_interleaved_inserts_and_queries():
+    rng = np.random.RandomState(2)
+    sigs = rng.randint(0, 3, size=(150, 32)).astype(np.uint32)
+    forest = LSHForest(32, trees=4)
+    for i, sig in enumerate(sigs):
+        forest.insert(i, sig)
+        assert set(forest.query(sig, r=3)) == brute_force(sigs[:i + 1], sig, 4, 8, 3)
+    # Runs are merged geometrically and each stays sorted.
+    assert len(forest.runs) < 10
+    for lanes, _ in forest.runs:
+        for tree in lanes:
+            assert np.array_equal(tree[np.lexsort(tree.T[::-1])], tree)
+
+def test_threshold_picks_longer_prefix_when_higher():
+    forest = LSHForest(64, trees=8)
+    assert forest.r_for(0.9) >= forest.r_for(0.5) >= forest.r_for(0.2)
+
+def test_one_forest_serves_many_thresholds():
+    mh = MinHash(64, seed=2)
+    docs = [{f"{j}" for j in range(i, i + 30)} for i in range(0, 60, 3)]
+    sigs = mh.signature_batch(docs)
+    forest = LSHForest(64, trees=8)
+    forest.insert_many(range(len(sigs)), sigs)
+    loose = forest.query(sigs[0], threshold=0.3)
+    strict = forest.query(sigs[0], threshold=0.9)
+    assert 0 in strict
+    assert set(strict) <= set(loose)
+
+def test_packed_signatures():
+    rh = RandomHyperplanes(64, 10)
+    sigs = rh(np.random.randn(50, 10))
+    forest = LSHForest(64, trees=8)
+    packed_forest = LSHForest(64, trees=8, packed=True)
+    forest.insert_many(range(50), sigs)
+    packed_forest.insert_many(range(50), pack_bits(sigs))
+    for sig in sigs[:5]:
+        assert sorted(forest.query(sig)) == sorted(packed_forest.query(pack_bits(sig)))
@@ -1,5 +1,6 @@
+from functools import partial
 import numpy as np
-from quick_knn.lsh import integrate
+from quick_knn.lsh import integrate, integrate_grid, gauss_legendre, optimize, fp_prob, fn_prob
 
 def test_integrate_x_squared():
     def func(x):
@@ -22,3 +23,32 @@ def test_integrate_vectorized():
     gold = np.array([4, 6, 8])
     area = integrate(func, -1, 1)
     np.testing.assert_allclose(area, gold)
+
+def test_integrate_grid_matches_integrate():
+    bs = np.array([1, 2, 4, 8])
+    rs = np.array([8, 4, 2, 1])
+    for a, b in [(0.0, 0.5), (0.51, 1.0), (0.0, 0.3)]:
+        func = partial(fp_prob, bs, rs)
+        np.testing.assert_array_equal(integrate_grid(func, a, b), integrate(func, a, b))
+
+def test_gauss_legendre_polynomial():
+    def func(x):
+        return x ** 3 + np.array([2, 3, 4])
+    np.testing.assert_allclose(gauss_legendre(func, -1, 1), [4, 6, 8])
+
+def test_optimize_matches_exhaustive_integration():
+    for bits in (4, 16, 50):
+        for thresh in (0.3, 0.51, 0.8):
+            for fp_weight in (0.2, 0.5):
+                bs, rs = zip(*[(b, r) for b in range(1, bits + 1) for r in range(1, bits // b + 1)])
+                bs, rs = np.array(bs), np.array(rs)
+                fp = integrate(partial(fp_prob, bs, rs), 0.0, thresh)
+                fn = integrate(partial(fn_prob, bs, rs), thresh, 1.0)
+                idx = np.argmin(fp * fp_weight + fn * (1 - fp_weight))
+                params = optimize(thresh, bits, fp_weight)
+                assert (params.b, params.r) == (bs[idx], rs[idx])
+                np.testing.assert_allclose(params.fp_rate, fp[idx] / thresh)
+                np.testing.assert_allclose(params.fn_rate, fn[idx] / (1 - thresh))
+
+def test_optimize_is_cached():
+    assert optimize(0.6, 64, 0.5) is optimize(0.6, 64, 0.5)
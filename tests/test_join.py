@@ -0,0 +1,71 @@
+from itertools import combinations
+import numpy as np
+import pytest
+from quick_knn.lsh import LSH
+from quick_knn.join import bucket_pairs, union, components
+from quick_knn.min_hash import MinHash
+
+def make_sigs(n=60, bits=64):
+    mh = MinHash(bits, seed=3)
+    docs = [{f"{j}" for j in range(i % 10, i % 10 + 20)} | {f"doc-{i}"} for i in range(n)]
+    return mh.signature_batch(docs)
+
+def test_bucket_pairs_chunks():
+    rng = np.random.RandomState(0)
+    hashes = rng.randint(0, 5, size=50).astype(np.uint64)
+    ids = rng.permutation(50)
+    gold = set()
+    for h in np.unique(hashes):
+        gold.update(combinations(sorted(ids[hashes == h].tolist()), 2))
+    got = []
+    for a, b in bucket_pairs(hashes, ids, chunk=7):
+        assert len(a) <= 7 + 50
+        got.extend(zip(a.tolist(), b.tolist()))
+    assert len(got) == len(gold)
+    assert set(got) == gold
+
+def test_bucket_pairs_drops_repeats():
+    hashes = np.array([1, 1, 1, 2], dtype=np.uint64)
+    ids = np.array([4, 4, 2, 3])
+    pairs = [list(zip(a.tolist(), b.tolist())) for a, b in bucket_pairs(hashes, ids)]
+    assert pairs == [[(2, 4)]]
+
+def test_union_components():
+    parent = np.arange(8)
+    union(parent, np.array([5, 1]), np.array([6, 5]))
+    union(parent, np.array([3]), np.array([7]))
+    groups = [g.tolist() for g in components(parent)]
+    assert groups == [[1, 5, 6], [3, 7]]
+
+@pytest.mark.parametrize("t", ["pickle", "sql", "array", "frozen"])
+def test_self_join_matches_queries(tmpdir, t):
+    sigs = make_sigs()
+    lsh = LSH(0.6, 64, t="array" if t == "frozen" else t)
+    lsh.insert_many(range(len(sigs)), sigs)
+    lsh.remove(7)
+    if t == "frozen":
+        path = str(tmpdir.join("frozen.idx"))
+        lsh.freeze(path)
+        lsh, _ = LSH.restore(path)
+    gold = set()
+    for i, res in enumerate(lsh.query_many(sigs)):
+        gold.update((min(i, j), max(i, j)) for j in res if j != i and i != 7)
+    got = [tuple(sorted(pair)) for pairs in lsh.self_join(chunk=16) for pair in pairs]
+    assert len(got) == len(set(got))
+    assert set(got) == gold
+
+def test_self_join_verify_and_clusters():
+    sigs = make_sigs()
+    lsh = LSH(0.6, 64, store_signatures=True)
+    lsh.insert_many(range(len(sigs)), sigs)
+    scored = [triple for triples in lsh.self_join(verify=True, min_similarity=0.7) for triple in triples]
+    assert scored
+    for a, b, score in scored:
+        assert score >= 0.7
+        assert score == pytest.approx(np.mean(sigs[a] == sigs[b]))
+    clusters = lsh.clusters(verify=True, min_similarity=0.7)
+    members = [key for cluster in clusters for key in cluster]
+    assert len(members) == len(set(members))
+    label = {key: i for i, cluster in enumerate(clusters) for key in cluster}
+    for a, b, _ in scored:
+        assert label[a] == label[b]
@@ -0,0 +1,41 @@
+import time
+import threading
+from quick_knn.locks import RWLock
+
+def test_readers_share_writers_exclude():
+    lock = RWLock()
+    active = []
+    seen = []
+
+    def reader():
+        with lock.read():
+            active.append(1)
+            time.sleep(0.05)
+            seen.append(len(active))
+            active.pop()
+
+    def writer():
+        with lock.write():
+            seen.append(("writer", len(active)))
+
+    threads = [threading.Thread(target=reader) for _ in range(3)]
+    for t in threads:
+        t.start()
+    time.sleep(0.01)
+    w = threading.Thread(target=writer)
+    w.start()
+    for t in threads + [w]:
+        t.join()
+    assert max(x for x in seen if isinstance(x, int)) > 1
+    assert ("writer", 0) in seen
+
+def test_reentrant():
+    lock = RWLock()
+    with lock.write():
+        with lock.write():
+            with lock.read():
+                pass
+    with lock.read():
+        with lock.read():
+            pass
+    assert lock.writer is None and lock.readers == 0
@@ -0,0 +1,487 @@
+import numpy as np
+import pytest
+from quick_knn.lsh import LSH, hash_rows
+from quick_knn.min_hash import MinHash
+
+def make_sigs(n=40, bits=64):
+    mh = MinHash(bits, seed=3)
+    docs = [{f"{j}" for j in range(i % 10, i % 10 + 20)} | {f"doc-{i}"} for i in range(n)]
+    return mh.signature_batch(docs)
+
+@pytest.mark.parametrize("t", ["pickle", "sql", "array"])
+def test_insert_many_matches_insert(t):
+    sigs = make_sigs()
+    lsh = LSH(0.6, 64, t=t)
+    bulk = LSH(0.6, 64, t=t)
+    for i, sig in enumerate(sigs):
+        lsh.insert(i, sig)
+    bulk.insert_many(range(len(sigs)), sigs)
+    for sig in sigs:
+        assert sorted(lsh.query(sig)) == sorted(bulk.query(sig))
+
+def test_query_many_matches_query():
+    sigs = make_sigs()
+    lsh = LSH(0.6, 64)
+    lsh.insert_many(range(len(sigs)), sigs)
+    results = lsh.query_many(sigs)
+    assert len(results) == len(sigs)
+    for i, (sig, res) in enumerate(zip(sigs, results)):
+        assert i in res
+        assert sorted(res) == sorted(lsh.query(sig))
+
+def test_band_hashes_shape():
+    sigs = make_sigs(5)
+    lsh = LSH(0.6, 64)
+    hashes = lsh.band_hashes(sigs)
+    assert hashes.shape == (5, lsh.b)
+    assert hashes.dtype == np.uint64
+    np.testing.assert_array_equal(lsh.band_hashes(sigs[2])[0], hashes[2])
+
+def test_band_hashes_match_hash_rows():
+    sigs = make_sigs(5)
+    lsh = LSH(0.6, 64)
+    hashes = lsh.band_hashes(sigs)
+    for band, (start, end) in enumerate(lsh.ranges):
+        np.testing.assert_array_equal(hash_rows(sigs[:, start:end], seed=band), hashes[:, band])
+
+@pytest.mark.parametrize("t", ["pickle", "sql", "array"])
+def test_freeze_restore(tmpdir, t):
+    sigs = make_sigs()
+    mh = MinHash(64, seed=3)
+    lsh = LSH(0.6, 64, t=t, name=str(tmpdir.join("lsh")))
+    lsh.insert_many([f"key-{i}" for i in range(len(sigs))], sigs)
+    path = str(tmpdir.join("frozen.idx"))
+    lsh.freeze(path, mh)
+    frozen, hasher = LSH.restore(path)
+    assert type(frozen.data).__name__ == "FrozenData"
+    assert (frozen.b, frozen.r) == (lsh.b, lsh.r)
+    np.testing.assert_array_equal(hasher.a, mh.a)
+    for got, gold in zip(frozen.query_many(sigs), lsh.query_many(sigs)):
+        assert sorted(got) == sorted(gold)
+
+def test_freeze_integer_keys(tmpdir):
+    sigs = make_sigs()
+    lsh = LSH(0.6, 64, t="array")
+    lsh.insert_many(range(len(sigs)), sigs)
+    path = str(tmpdir.join("frozen.idx"))
+    lsh.freeze(path)
+    frozen, hasher = LSH.restore(path)
+    assert hasher is None
+    assert frozen.data.keys.kind == "int"
+    assert isinstance(frozen.data.keys.keys, np.memmap)
+    assert sorted(frozen.query(sigs[0])) == sorted(lsh.query(sigs[0]))
+
+@pytest.mark.parametrize("keys", [
+    [f"key-{i}" for i in range(40)],
+    [f"key-{i}".encode() for i in range(40)],
+    [(i, "mixed") for i in range(40)],
+    list(range(40)),
+])
+def test_freeze_keys_and_signatures_are_mapped(tmpdir, keys):
+    sigs = make_sigs()
+    lsh = LSH(0.6, 64, t="array", store_signatures=True)
+    lsh.insert_many(keys, sigs)
+    # Removed and inserted again, so the file has a dead id for it.
+    lsh.remove(keys[3])
+    lsh.insert(keys[3], sigs[3])
+    path = str(tmpdir.join("frozen.idx"))
+    lsh.freeze(path)
+    frozen, _ = LSH.restore(path)
+    assert type(frozen.sig_rows).__name__ == "FrozenRows"
+    # Only keys that aren't int, str or bytes are unpickled when the file is opened.
+    assert (frozen.data.keys.kind == "pickled") == isinstance(keys[0], tuple)
+    assert sorted(frozen.sig_rows) == sorted(keys)
+    for i in (0, 3, 7):
+        assert frozen.query(sigs[i], k=5) == lsh.query(sigs[i], k=5)
+        assert frozen.data.key_ids([keys[i]]) == lsh.data.key_ids([keys[i]])
+    frozen.remove(keys[3])
+    assert keys[3] not in frozen.query(sigs[3])
+    assert keys[3] not in frozen.sig_rows
+
+def test_save_restore(tmpdir):
+    sigs = make_sigs()
+    for t in ("pickle", "array", "sql"):
+        lsh = LSH(0.6, 64, t=t, name=str(tmpdir.join(t)))
+        lsh.insert_many(range(len(sigs)), sigs)
+        lsh.save(None)
+        restored, _ = LSH.restore(str(tmpdir.join(t)))
+        assert sorted(restored.query(sigs[1])) == sorted(lsh.query(sigs[1]))
+
+def test_save_restore_sql_file(tmpdir):
+    sigs = make_sigs()
+    mh = MinHash(64, seed=3)
+    name = str(tmpdir.join("index.db"))
+    lsh = LSH(0.6, 64, t="sql", name=name, in_memory=False, store_signatures=True)
+    lsh.insert_many([f"key-{i}" for i in range(len(sigs))], sigs)
+    lsh.save(mh)
+    restored, hasher = LSH.restore(name)
+    assert type(restored.data).__name__ == "SQLData"
+    np.testing.assert_array_equal(hasher.a, mh.a)
+    assert restored.query(sigs[2], k=3) == lsh.query(sigs[2], k=3)
+    restored.insert("new", sigs[0])
+    assert "new" in restored.query(sigs[0])
+
+def test_restore_unsaved_sql(tmpdir):
+    name = str(tmpdir.join("unsaved.db"))
+    LSH(0.6, 64, t="sql", name=name, in_memory=False).insert(0, make_sigs(1)[0])
+    with pytest.raises(AssertionError, match="no saved LSH"):
+        LSH.restore(name)
+
+@pytest.mark.parametrize("in_memory", [True, False])
+def test_sql_query_during_bulk_load(tmpdir, in_memory):
+    sigs = make_sigs()
+    lsh = LSH(0.6, 64, t="sql", name=str(tmpdir.join("bulk.db")), in_memory=in_memory)
+    lsh.insert_many(range(10), sigs[:10])
+    gold = LSH(0.6, 64)
+    gold.insert_many(range(len(sigs)), sigs)
+    with lsh.bulk_load():
+        lsh.insert_many(range(10, len(sigs)), sigs[10:])
+        assert sorted(lsh.query(sigs[15])) == sorted(gold.query(sigs[15]))
+    assert sorted(lsh.query(sigs[15])) == sorted(gold.query(sigs[15]))
+
+def test_sql_reservoir_cap_during_bulk_load():
+    sigs = make_sigs()
+    lsh = LSH(0.6, 64, t="sql", bucket_cap=2, cap_policy="reservoir")
+    with lsh.bulk_load():
+        # Capped inserts count bucket entries through the band index, so it stays.
+        assert lsh.data.conn.execute("SELECT name FROM sqlite_master WHERE name = 'bands'").fetchall()
+        lsh.insert_many(range(len(sigs)), sigs)
+    assert lsh.stats()["bands"][0]["max"] <= 2
+
+def test_query_rerank_top_k():
+    sigs = make_sigs()
+    lsh = LSH(0.6, 64, store_signatures=True)
+    lsh.insert_many(range(len(sigs)), sigs)
+    results = lsh.query(sigs[0], k=3, min_similarity=0.0)
+    assert len(results) <= 3
+    assert results[0] == (0, 1.0)
+    scores = [score for _, score in results]
+    assert scores == sorted(scores, reverse=True)
+    for key, score in lsh.query(sigs[0], min_similarity=0.9):
+        assert score >= 0.9
+        assert np.mean(sigs[key] == sigs[0]) == score
+
+def test_query_many_rerank_matches_query():
+    sigs = make_sigs()
+    lsh = LSH(0.6, 64, store_signatures=True)
+    for i, sig in enumerate(sigs):
+        lsh.insert(i, sig)
+    assert lsh.query_many(sigs[:5], k=2) == [lsh.query(sig, k=2) for sig in sigs[:5]]
+
+def test_rerank_b_bit_signatures():
+    from quick_knn.min_hash import jaccard
+    mh = MinHash(256, seed=3, width=2)
+    base = {str(i) for i in range(200)}
+    docs = [base, set(list(base)[:100]) | {f"x{i}" for i in range(100)}]
+    sigs = mh.signature_batch(docs)
+    # Each byte holds four lanes, the LSH bands the lanes.
+    lsh = LSH(0.3, 256, store_signatures=True, width=2)
+    lsh.insert_many(range(2), sigs)
+    score = lsh.similarity(sigs[0], sigs[1:])[0]
+    assert score == jaccard(sigs[0], sigs[1], width=2)
+    assert abs(score - 1 / 3) < 0.1
+    assert lsh.rerank(sigs[0], [0, 1], min_similarity=0.25) == [(0, 1.0), (1, score)]
+
+@pytest.mark.parametrize("width", [1, 2, 4])
+def test_band_hashes_b_bit_lanes(width):
+    from quick_knn.min_hash import pack_lanes, unpack_lanes
+    sigs = MinHash(64, seed=3, width=width).signature_batch([{str(i) for i in range(20)}])
+    lsh = LSH(0.6, 64, width=width)
+    assert lsh.ranges[-1][1] <= 64
+    lanes = unpack_lanes(sigs, width)
+    # Flip the first lane of band 1, which can share a byte with the last lanes of band 0.
+    changed = lanes.copy()
+    changed[0, lsh.r] ^= 1
+    before, after = lsh.band_hashes(sigs)[0], lsh.band_hashes(pack_lanes(changed, width))[0]
+    assert before[0] == after[0]
+    assert before[1] != after[1]
+    np.testing.assert_array_equal(before[2:], after[2:])
+
+def test_rerank_packed_hyperplanes():
+    from quick_knn.random_hyperplane import RandomHyperplanes, cosine
+    rh = RandomHyperplanes(64, 10, packed=True)
+    sigs = rh(np.random.randn(30, 10))
+    lsh = LSH(0.7, 64, packed=True, store_signatures=True)
+    lsh.insert_many(range(30), sigs)
+    for key, score in lsh.query(sigs[4], min_similarity=0.0):
+        np.testing.assert_allclose(score, cosine(sigs[4], sigs[key:key + 1], 64)[0])
+
+def test_freeze_keeps_signatures(tmpdir):
+    sigs = make_sigs()
+    lsh = LSH(0.6, 64, t="array", store_signatures=True)
+    lsh.insert_many([f"key-{i}" for i in range(len(sigs))], sigs)
+    path = str(tmpdir.join("frozen.idx"))
+    lsh.freeze(path)
+    frozen, _ = LSH.restore(path)
+    assert frozen.query(sigs[3], k=4) == lsh.query(sigs[3], k=4)
+
+@pytest.mark.parametrize("t", ["pickle", "sql", "array", "frozen"])
+def test_multi_probe_improves_recall(tmpdir, t):
+    from quick_knn.random_hyperplane import RandomHyperplanes
+    rng = np.random.RandomState(0)
+    dim = 20
+    rh = RandomHyperplanes(64, dim)
+    data = rng.randn(500, dim)
+    queries = data[:30] + 0.3 * rng.randn(30, dim)
+    lsh = LSH(0.9, 64, t="array" if t == "frozen" else t)
+    lsh.insert_many(range(len(data)), rh(data))
+    if t == "frozen":
+        path = str(tmpdir.join("frozen.idx"))
+        lsh.freeze(path)
+        lsh, _ = LSH.restore(path)
+    sigs, margins = rh.signature(queries, margins=True)
+    exact = lsh.query_many(sigs)
+    probed = lsh.query_many(sigs, margins=margins, probes=2, budget=50)
+    for i, (e, p) in enumerate(zip(exact, probed)):
+        assert set(e) <= set(p)
+        assert set(p) == set(lsh.query(sigs[i], margins=margins[i], probes=2, budget=50))
+    assert sum(i in p for i, p in enumerate(probed)) > sum(i in e for i, e in enumerate(exact))
+
+def test_packed_probe_hashes_match_band_hashes():
+    from quick_knn.random_hyperplane import RandomHyperplanes, pack_bits, unpack_bits
+    sigs = RandomHyperplanes(200, 10, packed=True)(np.random.randn(3, 10))
+    lsh = LSH(0.8, 200, packed=True)
+    assert lsh.r % 64
+    bits = unpack_bits(sigs, 200)
+    bands, hashes = lsh.probe_hashes(sigs[0], np.arange(1, 201), probes=1)
+    flipped = [i for start, end in lsh.ranges for i in range(start, end)]
+    assert len(hashes) == len(flipped)
+    for band, h, i in zip(bands, hashes, flipped):
+        sig = bits[0].copy()
+        sig[i] ^= 1
+        assert lsh.band_hashes(pack_bits(sig))[0, band] == h
+
+def test_probe_hashes_budget_and_order():
+    lsh = LSH(0.9, 64)
+    sig = np.random.randint(0, 2, size=64).astype(np.uint8)
+    margins = np.random.rand(64)
+    bands, hashes = lsh.probe_hashes(sig, margins, probes=1, budget=5)
+    assert len(bands) == len(hashes) == 5
+    in_bands = np.concatenate([np.arange(start, end) for start, end in lsh.ranges])
+    smallest = np.sort(margins[in_bands])[:5]
+    for band, h in zip(bands, hashes):
+        start, end = lsh.ranges[band]
+        flips = [i for i in range(start, end) if margins[i] in smallest]
+        assert flips
+
+@pytest.mark.parametrize("t", ["pickle", "sql", "array"])
+def test_insert_parallel_matches_insert(t):
+    sigs = make_sigs(60)
+    serial = LSH(0.6, 64, t=t)
+    for i, sig in enumerate(sigs):
+        serial.insert(i, sig)
+    parallel = LSH(0.6, 64, t=t)
+    parallel.insert_parallel(range(len(sigs)), sigs, processes=2, chunk=7)
+    for got, gold in zip(parallel.query_many(sigs), serial.query_many(sigs)):
+        assert sorted(got) == sorted(gold)
+
+@pytest.mark.parametrize("kwargs", [dict(packed=True), dict(bucket_cap=3), dict(width=2)])
+def test_insert_parallel_packed_and_capped(kwargs):
+    from quick_knn.random_hyperplane import RandomHyperplanes
+    if kwargs.get("packed"):
+        sigs = RandomHyperplanes(128, 10, packed=True)(np.random.randn(50, 10))
+    elif kwargs.get("width"):
+        sigs = MinHash(64, seed=3, width=2).signature_batch([{f"{j}" for j in range(i % 10, i % 10 + 20)} for i in range(50)])
+    else:
+        sigs = make_sigs(50)
+    bits = 128 if kwargs.get("packed") else 64
+    serial = LSH(0.6, bits, t="array", **kwargs)
+    serial.insert_many(range(len(sigs)), sigs)
+    parallel = LSH(0.6, bits, t="array", **kwargs)
+    parallel.insert_parallel(range(len(sigs)), sigs, processes=3, chunk=11)
+    for got, gold in zip(parallel.query_many(sigs), serial.query_many(sigs)):
+        assert sorted(got) == sorted(gold)
+
+@pytest.mark.parametrize("t", ["pickle", "sql", "array"])
+@pytest.mark.parametrize("store", [False, True])
+def test_remove_update_compact(t, store):
+    sigs = make_sigs()
+    lsh = LSH(0.6, 64, t=t, store_signatures=store)
+    lsh.insert_many(range(len(sigs)), sigs)
+    lsh.remove(3)
+    lsh.update(5, sigs[0])
+    before = lsh.query_many(sigs)
+    assert all(3 not in res for res in before)
+    assert 5 not in before[5]
+    assert 5 in before[0]
+    lsh.compact()
+    for got, gold in zip(lsh.query_many(sigs), before):
+        assert sorted(got) == sorted(gold)
+    lsh.insert(3, sigs[3])
+    assert 3 in lsh.query(sigs[3])
+
+@pytest.mark.parametrize("t", ["pickle", "sql", "array"])
+def test_remove_key_inserted_twice(t):
+    sigs = make_sigs()
+    lsh = LSH(0.6, 64, t=t, store_signatures=True)
+    lsh.insert_many(range(len(sigs)), sigs)
+    lsh.insert(0, sigs[10])
+    lsh.remove(0)
+    assert 0 not in lsh.query(sigs[0])
+    assert 0 not in lsh.query(sigs[10])
+    assert [key for key, _ in lsh.query(sigs[0], k=1)] != [0]
+    assert [key for key, _ in lsh.rerank(sigs[0], [0, 1], min_similarity=0.0)] == [1]
+
+def test_remove_frozen(tmpdir):
+    sigs = make_sigs()
+    lsh = LSH(0.6, 64, t="array")
+    lsh.insert_many(range(len(sigs)), sigs)
+    lsh.remove(3)
+    path = str(tmpdir.join("frozen.idx"))
+    lsh.freeze(path)
+    frozen, _ = LSH.restore(path)
+    assert 3 not in frozen.query(sigs[3])
+    frozen.remove(4)
+    assert 4 not in frozen.query(sigs[4])
+    with pytest.raises(NotImplementedError):
+        frozen.compact()
+
+@pytest.mark.parametrize("t", ["pickle", "sql", "array"])
+def test_stats(t):
+    sigs = make_sigs()
+    lsh = LSH(0.6, 64, t=t, store_signatures=True)
+    lsh.insert_many(range(len(sigs)), sigs)
+    lsh.insert_many(range(40, 45), np.tile(sigs[:1], (5, 1)))
+    stats = lsh.stats(largest=2)
+    assert stats["items"] == 45
+    assert stats["entries"] == 45 * lsh.b
+    assert stats["bytes"]["backend"] > 0
+    assert stats["bytes"]["signatures"] >= 45 * 64 * sigs.itemsize
+    assert len(stats["bands"]) == lsh.b
+    for band in stats["bands"]:
+        assert band["entries"] == 45
+        assert band["max"] >= 6
+        assert band["largest"][0][1] == band["max"]
+        assert sum(count for _, _, count in band["histogram"]) == band["buckets"]
+        for low, high, _ in band["histogram"]:
+            assert high == 2 * low - 1
+
+def test_instrument():
+    sigs = make_sigs()
+    lsh = LSH(0.6, 64, store_signatures=True)
+    calls = []
+    metrics = lsh.instrument(lambda stage, seconds, counts: calls.append(stage))
+    lsh.insert_many(range(len(sigs)), sigs)
+    lsh.insert(100, sigs[0])
+    lsh.query(sigs[0])
+    results = lsh.query_many(sigs[:5], min_similarity=0.5)
+    snapshot = metrics.snapshot()
+    assert snapshot["insert.backend"]["calls"] == 2
+    assert snapshot["insert.backend"]["items"] == len(sigs) + 1
+    assert snapshot["query.get"]["queries"] == 6
+    assert snapshot["query.get"]["candidates"] >= 7
+    assert snapshot["query.rerank"]["results"] == sum(len(r) for r in results)
+    assert snapshot["query.hash"]["seconds"] >= 0
+    assert calls.count("query.rerank") == 5
+    assert LSH(0.6, 64).metrics is None
+
+def skewed_sigs(width, n=60, bits=64):
+    """Signatures that all agree on the first `width` values and are random elsewhere."""
+    rng = np.random.RandomState(1)
+    sigs = rng.randint(0, 1 << 32, size=(n, bits)).astype(np.uint64)
+    sigs[:, :width] = sigs[0, :width]
+    return sigs
+
+@pytest.mark.parametrize("t", ["pickle", "sql", "array"])
+def test_bucket_cap_stop(t):
+    sigs = np.tile(make_sigs(1), (30, 1))
+    lsh = LSH(0.6, 64, t=t, bucket_cap=10)
+    lsh.insert_many(range(25), sigs[:25])
+    for i in range(25, 30):
+        lsh.insert(i, sigs[i])
+    res = lsh.query(sigs[0])
+    assert sorted(res) == list(range(10))
+    assert res.capped and not res.truncated
+    stats = lsh.stats()
+    assert stats["full_buckets"] == lsh.b
+    assert all(band["max"] == 10 for band in stats["bands"])
+
+@pytest.mark.parametrize("t", ["pickle", "sql", "array"])
+def test_bucket_cap_reservoir(t):
+    sigs = np.tile(make_sigs(1), (200, 1))
+    lsh = LSH(0.6, 64, t=t, bucket_cap=10, cap_policy="reservoir")
+    lsh.insert_many(range(100), sigs[:100])
+    lsh.insert_many(range(100, 200), sigs[100:])
+    assert all(band["max"] == 10 and band["entries"] == 10 for band in lsh.stats()["bands"])
+    assert any(key >= 10 for key in lsh.query(sigs[0]))
+    assert lsh.full[next(iter(lsh.full))] == 200
+
+@pytest.mark.parametrize("t", ["pickle", "sql", "array"])
+def test_bucket_cap_split(t):
+    lsh = LSH(0.6, 64, t=t, bucket_cap=10, cap_policy="split")
+    sigs = skewed_sigs(lsh.r)
+    lsh.insert_many(range(len(sigs)), sigs)
+    first = lsh.stats()["bands"][0]
+    assert first["entries"] == len(sigs)
+    assert first["max"] == 10
+    stop = LSH(0.6, 64, t=t, bucket_cap=10)
+    stop.insert_many(range(len(sigs)), sigs)
+    assert stop.stats()["bands"][0]["entries"] == 10
+    for i, sig in enumerate(sigs):
+        res = lsh.query(sig)
+        assert i in res and res.capped
+        assert set(lsh.query(sig, max_candidates=100)) == set(res)
+
+def test_max_candidates_stops_early():
+    sigs = make_sigs()
+    lsh = LSH(0.6, 64, t="array")
+    lsh.insert_many(range(len(sigs)), sigs)
+    full = lsh.query_many(sigs)
+    limited = lsh.query_many(sigs, max_candidates=1)
+    assert any(res.truncated for res in limited)
+    for got, gold in zip(limited, full):
+        assert set(got) <= set(gold)
+        assert not gold.truncated
+        if got.truncated:
+            assert len(got) >= 1
+    assert set(lsh.query(sigs[0], max_candidates=10 ** 6)) == set(full[0])
+
+@pytest.mark.parametrize("t", ["pickle", "sql", "array"])
+def test_query_many_workers_matches_serial(t):
+    sigs = make_sigs()
+    lsh = LSH(0.6, 64, t=t, store_signatures=True)
+    lsh.insert_many(range(len(sigs)), sigs)
+    for got, gold in zip(lsh.query_many(sigs, workers=4), lsh.query_many(sigs)):
+        assert sorted(got) == sorted(gold)
+    for got, gold in zip(lsh.query_many(sigs, k=3, workers=3), lsh.query_many(sigs, k=3)):
+        assert got == gold
+
+def test_pickle_lookup_does_not_add_buckets():
+    sigs = make_sigs()
+    lsh = LSH(0.6, 64)
+    lsh.insert_many(range(10), sigs[:10])
+    sizes = [len(table) for table in lsh.data.tables]
+    lsh.query_many(sigs[10:])
+    assert [len(table) for table in lsh.data.tables] == sizes
+
+@pytest.mark.parametrize("t", ["pickle", "sql", "array"])
+def test_concurrent_inserts_and_queries(t):
+    import threading
+    sigs = make_sigs(200)
+    lsh = LSH(0.6, 64, t=t)
+    lsh.insert_many(range(100), sigs[:100])
+    errors = []
+
+    def query():
+        try:
+            for _ in range(5):
+                for i, res in enumerate(lsh.query_many(sigs[:100], workers=2)):
+                    assert i in res
+        except Exception as e:
+            errors.append(e)
+
+    def insert():
+        try:
+            for i in range(100, 200):
+                lsh.insert(i, sigs[i])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=query) for _ in range(3)] + [threading.Thread(target=insert)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    for i, res in enumerate(lsh.query_many(sigs)):
+        assert i in res
@@ -0,0 +1,127 @@
+import numpy as np
+import quick_knn.min_hash as min_hash
+from quick_knn.min_hash import MinHash, OnePermutationMinHash, EMPTY, jaccard
+
+def loop_signature(mh, tokens):
+    sig = None
+    for token in tokens:
+        sig = mh.signature(token.encode('utf-8'), sig)
+    return sig
+
+def test_call_matches_token_loop():
+    mh = MinHash(128, seed=7)
+    tokens = {f"token-{i}" for i in range(500)}
+    np.testing.assert_array_equal(mh(tokens), loop_signature(mh, tokens))
+
+def test_call_chunks_match_token_loop():
+    mh = MinHash(64, seed=3)
+    tokens = [f"{i}" for i in range(100)]
+    chunk = min_hash.CHUNK
+    min_hash.CHUNK = 64 * 7
+    try:
+        sig = mh(tokens)
+    finally:
+        min_hash.CHUNK = chunk
+    np.testing.assert_array_equal(sig, loop_signature(mh, tokens))
+
+def test_call_updates_old():
+    mh = MinHash(32)
+    first = mh({"a", "b"})
+    both = mh({"c", "d"}, first)
+    np.testing.assert_array_equal(both, mh({"a", "b", "c", "d"}))
+
+def test_call_empty_returns_old():
+    mh = MinHash(32)
+    assert mh(set()) is None
+
+def test_signature_batch_matches_call():
+    mh = MinHash(64, seed=11)
+    docs = [{f"{j}" for j in range(i, i + 20 + i)} for i in range(30)]
+    sigs = mh.signature_batch(docs)
+    assert sigs.shape == (len(docs), 64)
+    for doc, sig in zip(docs, sigs):
+        np.testing.assert_array_equal(sig, mh(doc))
+
+def test_signature_batch_chunks_across_documents():
+    mh = MinHash(32, seed=2)
+    docs = [[f"{j}" for j in range(i * 3, i * 3 + 5)] for i in range(10)]
+    chunk = min_hash.CHUNK
+    min_hash.CHUNK = 32 * 4
+    try:
+        sigs = mh.signature_batch(docs)
+    finally:
+        min_hash.CHUNK = chunk
+    for doc, sig in zip(docs, sigs):
+        np.testing.assert_array_equal(sig, mh(doc))
+
+def test_signature_batch_empty_document():
+    mh = MinHash(16)
+    sigs = mh.signature_batch([{"a"}, set()])
+    np.testing.assert_array_equal(sigs[1], mh.default)
+
+def test_signature_batch_processes():
+    mh = MinHash(32, seed=5)
+    docs = [{f"{j}" for j in range(i, i + 10)} for i in range(9)]
+    np.testing.assert_array_equal(mh.signature_batch(docs, processes=2), mh.signature_batch(docs))
+
+def test_one_permutation_incremental_matches_whole_set():
+    oph = OnePermutationMinHash(64, seed=3)
+    tokens = [f"{i}" for i in range(200)]
+    partial = oph(tokens[:50])
+    np.testing.assert_array_equal(oph(tokens[50:], partial), oph(tokens))
+
+def test_one_permutation_densifies_all_bins():
+    oph = OnePermutationMinHash(128)
+    sig = oph({"a", "b", "c"})
+    assert len(sig) == len(oph) == 128
+    assert not np.any(sig == EMPTY)
+
+def test_one_permutation_estimates_jaccard():
+    oph = OnePermutationMinHash(512, seed=4)
+    s1 = {f"{i}" for i in range(1000)}
+    s2 = {f"{i}" for i in range(500, 1500)}
+    gold = len(s1 & s2) / len(s1 | s2)
+    np.testing.assert_allclose(jaccard(oph(s1), oph(s2)), gold, atol=0.08)
+
+def test_width_32_matches_full_values():
+    tokens = {f"{i}" for i in range(100)}
+    full = MinHash(64, seed=9)(tokens)
+    small = MinHash(64, seed=9, width=32)(tokens)
+    assert small.dtype == np.uint32
+    np.testing.assert_array_equal(small, full)
+
+def test_pack_lanes_round_trip():
+    for width in (1, 2, 4, 8):
+        lanes = np.random.randint(0, 1 << width, size=(3, 64)).astype(np.uint8)
+        packed = min_hash.pack_lanes(lanes, width)
+        assert packed.shape == (3, 64 * width // 8)
+        np.testing.assert_array_equal(min_hash.unpack_lanes(packed, width), lanes)
+
+def test_b_bit_jaccard_is_corrected():
+    s1 = {f"{i}" for i in range(1000)}
+    s2 = {f"{i}" for i in range(500, 1500)}
+    gold = len(s1 & s2) / len(s1 | s2)
+    for width in (1, 2, 4, 8):
+        mh = MinHash(1024, seed=6, width=width)
+        sig1, sig2 = mh(s1), mh(s2)
+        assert sig1.nbytes == 1024 * width // 8
+        np.testing.assert_allclose(jaccard(sig1, sig2, width), gold, atol=0.08)
+
+def test_integer_tokens_skip_sha1():
+    mh = MinHash(64)
+    tokens = np.array([3, 17, 99, 17], dtype=np.uint32)
+    np.testing.assert_array_equal(mh(tokens), mh.signature_hashes(tokens))
+    batch = mh.signature_batch([tokens, tokens[:2]])
+    np.testing.assert_array_equal(batch[0], mh(tokens))
+    np.testing.assert_array_equal(batch[1], mh(tokens[:2]))
+
+def test_token_cache_matches_uncached():
+    import pickle
+    cached = MinHash(64, cache=4)
+    plain = MinHash(64)
+    docs = [{"a", "b", "c"}, {"b", "c", "d", "e", "f"}, {"a"}]
+    np.testing.assert_array_equal(cached.signature_batch(docs), plain.signature_batch(docs))
+    assert cached.token_hash.cache_info().currsize == 4
+    restored = pickle.loads(pickle.dumps(cached))
+    assert restored.token_hash.cache_info().currsize == 0
+    np.testing.assert_array_equal(restored(docs[1]), plain(docs[1]))
@@ -0,0 +1,81 @@
+import numpy as np
+from quick_knn.lsh import LSH
+from quick_knn.random_hyperplane import RandomHyperplanes, CSR, pack_bits, unpack_bits, popcount, cosine, POPCOUNT
+
+def test_pack_bits_round_trip():
+    sigs = np.random.randint(0, 2, size=(7, 100)).astype(np.uint8)
+    packed = pack_bits(sigs)
+    assert packed.dtype == np.uint64
+    assert packed.shape == (7, 2)
+    np.testing.assert_array_equal(unpack_bits(packed, 100), sigs)
+
+def test_popcount_matches_table():
+    words = np.random.randint(0, 1 << 62, size=(4, 3)).astype(np.uint64)
+    gold = POPCOUNT[words.view(np.uint8)].reshape(4, 3, -1).sum(axis=-1)
+    np.testing.assert_array_equal(popcount(words), gold)
+
+def test_packed_cosine_matches_unpacked():
+    rh = RandomHyperplanes(100, 20)
+    data = np.random.randn(30, 20)
+    sigs = rh(data)
+    rh.packed = True
+    packed = rh(data)
+    np.testing.assert_allclose(cosine(packed[0], packed, bits=100), cosine(sigs[0], sigs))
+
+def test_lsh_packed_matches_unpacked():
+    rh = RandomHyperplanes(64, 10)
+    sigs = rh(np.random.randn(50, 10))
+    packed = pack_bits(sigs)
+    lsh = LSH(0.7, 64)
+    packed_lsh = LSH(0.7, 64, packed=True)
+    for i, (sig, p) in enumerate(zip(sigs, packed)):
+        lsh.insert(i, sig)
+        packed_lsh.insert(i, p)
+    for sig, p in zip(sigs, packed):
+        assert sorted(lsh.query(sig)) == sorted(packed_lsh.query(p))
+
+def test_signature_stream_matches_signature(tmpdir):
+    rh = RandomHyperplanes(70, 12, packed=True)
+    data = np.random.randn(103, 12).astype(np.float32)
+    gold = rh(data)
+    np.testing.assert_array_equal(rh.signature_stream(data, chunk=10), gold)
+    path = str(tmpdir.join("data.npy"))
+    np.save(path, data)
+    out = str(tmpdir.join("sigs.npy"))
+    rh.signature_stream(path, out=out, chunk=16)
+    np.testing.assert_array_equal(np.load(out), gold)
+    blocks = (data[i:i + 25] for i in range(0, len(data), 25))
+    np.testing.assert_array_equal(rh.signature_stream(blocks, chunk=10), gold)
+
+def to_csr(dense):
+    values, indices, indptr = [], [], [0]
+    for row in dense:
+        nz = np.flatnonzero(row)
+        indices.extend(nz)
+        values.extend(row[nz])
+        indptr.append(len(indices))
+    return CSR(np.array(values), np.array(indices), np.array(indptr))
+
+def test_csr_input_matches_dense():
+    dense = np.random.randn(15, 40) * (np.random.rand(15, 40) < 0.2)
+    dense[4] = 0
+    for projection in ("gaussian", "sparse"):
+        rh = RandomHyperplanes(96, 40, projection=projection, density=0.3)
+        np.testing.assert_array_equal(rh(to_csr(dense)), rh(dense))
+
+def test_sparse_projection_is_seeded():
+    data = np.random.randn(5, 30)
+    rh1 = RandomHyperplanes(64, 30, projection="sparse", density=0.5, seed=3)
+    rh2 = RandomHyperplanes(64, 30, projection="sparse", density=0.5, seed=3)
+    assert rh1.planes is None
+    np.testing.assert_array_equal(rh1(data), rh2(data))
+    rows = rh1.rows(np.arange(30))
+    assert set(np.unique(rows)) <= {-1.0, 0.0, 1.0}
+
+def test_gaussian_projection_is_seeded():
+    data = np.random.randn(5, 30)
+    rh1 = RandomHyperplanes(64, 30, seed=3)
+    rh2 = RandomHyperplanes(64, 30, seed=3)
+    np.testing.assert_array_equal(rh1.planes, rh2.planes)
+    np.testing.assert_array_equal(rh1(data), rh2(data))
+    assert not np.array_equal(RandomHyperplanes(64, 30, seed=4).planes, rh1.planes)
@@ -0,0 +1,26 @@
+import numpy as np
+from quick_knn.min_hash import MinHash, jaccard
+from quick_knn.shingle import char_ngrams, word_ngrams, word_hashes, codepoints
+
+def test_char_ngrams_are_distinct_windows():
+    assert len(char_ngrams("abab")) == 2
+    assert len(char_ngrams("a")) == 0
+    np.testing.assert_array_equal(char_ngrams("ABab", n=2), char_ngrams("abab", n=2))
+    assert char_ngrams("abc", dtype=np.uint64).dtype == np.uint64
+
+def test_word_hashes_ignore_position_and_spacing():
+    hashes = word_hashes(codepoints(" to be\tor  not to\nbe "))
+    assert len(hashes) == 6
+    assert hashes[0] == hashes[4] and hashes[1] == hashes[5]
+    assert len(set(hashes[:4].tolist())) == 4
+    np.testing.assert_array_equal(word_ngrams("to be or"), word_ngrams("or  be to"))
+    assert len(word_ngrams("to be to be", n=2)) == 2
+    assert len(word_ngrams("   ")) == 0
+
+def test_shingles_sign_with_min_hash():
+    mh = MinHash(256)
+    a = "the quick brown fox jumps over the lazy dog"
+    b = "the quick brown fox jumped over the lazy dog"
+    sa, sb = set(char_ngrams(a, 3).tolist()), set(char_ngrams(b, 3).tolist())
+    exact = len(sa & sb) / len(sa | sb)
+    assert abs(jaccard(mh(char_ngrams(a, 3)), mh(char_ngrams(b, 3))) - exact) < 0.15